@@ -8,6 +8,7 @@ See LICENSE.md file in the project root for full license information.
 
 
 import argparse
+import logging
 import os
 import string
 import sys
@@ -15,10 +16,19 @@ import time
 from pathlib import Path
 
 import imageio
+import numpy as np
 
 from correct_images import corrections
 from correct_images.corrector import Corrector
 from correct_images.parser import CorrectConfig
+from correct_images.tools.bin_statistics import (
+    BIN_STATISTICS_FILENAME,
+    BinStatistics,
+    attenuation_from_bin_statistics,
+)
+from correct_images.tools.diagnostics import DIAGNOSTIC_FIGURES, render_diagnostics
+from correct_images.tools.parse_cache import ParseCache, inputs_key
+from correct_images.tools.scheduler import cpu_workers, run_shared
 from oplab import (
     CameraSystem,
     Console,
@@ -59,6 +69,23 @@ def main(args=None):
         default="",
         help="Expected suffix for correct_images configuration and output folders.",
     )
+    subparser_correct.add_argument(
+        "-r",
+        "--resume",
+        dest="resume",
+        action="store_true",
+        help="Only correct the images that are missing or outdated in the output folder.",
+    )
+    subparser_correct.add_argument(
+        "-j",
+        "--camera-workers",
+        dest="camera_workers",
+        type=int,
+        default=None,
+        help="Number of cameras corrected at once. The CPUs are shared among them "
+        "by their number of images and priority. Defaults to the number of "
+        "cameras, up to the number of CPUs minus one.",
+    )
     subparser_correct.set_defaults(func=call_correct)
 
     # subparser parse
@@ -89,6 +116,16 @@ def main(args=None):
         default="",
         help="Expected suffix for correct_images configuration and output folders.",
     )
+    subparser_parse.add_argument(
+        "-j",
+        "--camera-workers",
+        dest="camera_workers",
+        type=int,
+        default=None,
+        help="Number of cameras corrected at once. The CPUs are shared among them "
+        "by their number of images and priority. Defaults to the number of "
+        "cameras, up to the number of CPUs minus one.",
+    )
     subparser_parse.set_defaults(func=call_parse)
 
     # subparser process
@@ -109,6 +146,23 @@ def main(args=None):
         default="",
         help="Expected suffix for correct_images configuration and output folders.",
     )
+    subparser_process.add_argument(
+        "-r",
+        "--resume",
+        dest="resume",
+        action="store_true",
+        help="Only correct the images that are missing or outdated in the output folder.",
+    )
+    subparser_process.add_argument(
+        "-j",
+        "--camera-workers",
+        dest="camera_workers",
+        type=int,
+        default=None,
+        help="Number of cameras corrected at once. The CPUs are shared among them "
+        "by their number of images and priority. Defaults to the number of "
+        "cameras, up to the number of CPUs minus one.",
+    )
     subparser_process.set_defaults(func=call_process)
 
     # subparser rescale image
@@ -124,6 +178,65 @@ def main(args=None):
     )
     subparser_rescale.set_defaults(func=call_rescale)
 
+    # subparser diagnostics
+    subparser_diagnostics = subparsers.add_parser(
+        "diagnostics", help="Render the diagnostic figures stored by parse"
+    )
+    subparser_diagnostics.add_argument(
+        "path", help="Folder of the correction parameters written by parse"
+    )
+    subparser_diagnostics.add_argument(
+        "--dpi",
+        dest="dpi",
+        type=int,
+        default=600,
+        help="Resolution of the figures.",
+    )
+    subparser_diagnostics.add_argument(
+        "--figures",
+        dest="figures",
+        nargs="+",
+        default=None,
+        help="Figures to render, among " + ", ".join(DIAGNOSTIC_FIGURES) + ".",
+    )
+    subparser_diagnostics.set_defaults(func=call_diagnostics, suffix="")
+
+    # subparser merge
+    subparser_merge = subparsers.add_parser(
+        "merge",
+        help="Merge the bin statistics of several parse runs and refit the "
+        "correction parameters",
+    )
+    subparser_merge.add_argument(
+        "path",
+        nargs="+",
+        help="Bin statistics files, or folders of correction parameters written "
+        "by parse, to merge.",
+    )
+    subparser_merge.add_argument(
+        "-o",
+        "--output",
+        dest="output",
+        required=True,
+        help="Folder where the merged statistics and correction parameters are "
+        "written.",
+    )
+    subparser_merge.add_argument(
+        "--fitting-method",
+        dest="fitting_method",
+        default=None,
+        choices=["batch", "reference"],
+        help="Curve fitting method. Defaults to the one used by parse.",
+    )
+    subparser_merge.add_argument(
+        "--mean-smoothing",
+        dest="mean_smoothing",
+        action="store_true",
+        help="Fit the mean image of each altitude bin even if parse used another "
+        "smoothing method. Without it, merge refuses such statistics.",
+    )
+    subparser_merge.set_defaults(func=call_merge, suffix="")
+
     if len(sys.argv) == 1 and args is None:
         # Show help if no args provided
         parser.print_help(sys.stderr)
@@ -173,10 +286,10 @@ def call_parse(args):
                 Console.info("\t", path, " [OK]")
 
     time_string = time.strftime("%Y%m%d_%H%M%S", time.localtime())
-    Console.set_logging_file(
-        get_processed_folder(path)
-        / ("log/" + time_string + "_correct_images_parse.log")
+    args.log_file = get_processed_folder(path) / (
+        "log/" + time_string + "_correct_images_parse.log"
     )
+    Console.set_logging_file(args.log_file)
 
     # Populating the configuration and camerasystem lists for each dive path
     # The camera system is pulled first from <config> folder if available, if not from <raw> folder
@@ -225,6 +338,7 @@ def call_parse(args):
         correct_config = correct_config_list[0]
 
     camerasystem = camerasystem_list[0]
+    jobs = []
     for camera in camerasystem.cameras:
         # check if the camera also exists in the configuration
         if camera.name not in [
@@ -236,13 +350,22 @@ def call_parse(args):
                 "] defined in <camera.yaml> but not found in configuration. Skipping.",
             )
         else:
-            Console.info("Parsing for camera", camera.name)
-            # Create a Corrector object for each camera with empty configuration
-            # The configuration and the paths will be populated later on a per-dive basis
-            corrector = Corrector("parse", args.force, args.suffix, camera, correct_config=None)
-            # call new list-compatible implementation of parse()
-            corrector.parse(path_list, correct_config_list)
-            corrector.cleanup()
+            # The work of a camera grows with its number of images in all
+            # dives and with their size
+            dive_cameras = [
+                c
+                for cs in camerasystem_list
+                for c in cs.cameras
+                if c.name == camera.name
+            ]
+            num_images = sum(len(c.image_list) for c in dive_cameras)
+            weight = (
+                num_images
+                * image_size(dive_cameras)
+                * camera_priority(correct_config, camera.name)
+            )
+            jobs.append((weight, (camera, path_list, correct_config_list, args)))
+    run_shared(parse_camera, jobs, camera_workers(args, len(jobs)))
 
     Console.info(
         "Parse completed for all cameras. Please run process to develop",
@@ -263,28 +386,94 @@ def call_process(args):
     path = Path(args.path).resolve()
 
     time_string = time.strftime("%Y%m%d_%H%M%S", time.localtime())
-    Console.set_logging_file(
-        get_processed_folder(path)
-        / ("log/" + time_string + "_correct_images_process.log")
+    args.log_file = get_processed_folder(path) / (
+        "log/" + time_string + "_correct_images_process.log"
     )
+    Console.set_logging_file(args.log_file)
 
     correct_config, camerasystem = load_configuration_and_camera_system(
         path, args.suffix
     )
 
+    jobs = []
     for camera in camerasystem.cameras:
-        Console.info("Processing for camera", camera.name)
-
         if len(camera.image_list) == 0:
-            Console.info("No images found for the camera at the path provided")
+            Console.info(
+                "No images found for camera", camera.name, "at the path provided"
+            )
             continue
-        else:
-            corrector = Corrector("process", args.force, args.suffix, camera, correct_config, path)
-            if corrector.camera_found:
-                corrector.process()
+        weight = (
+            len(camera.image_list)
+            * image_size([camera])
+            * camera_priority(correct_config, camera.name)
+        )
+        jobs.append((weight, (camera, correct_config, path, args)))
+    run_shared(process_camera, jobs, camera_workers(args, len(jobs)))
     Console.info("Process completed for all cameras")
 
 
+def camera_workers(args, num_cameras):
+    """Number of cameras corrected at once, from the --camera-workers
+    argument or, by default, all of them up to the number of CPUs"""
+    if getattr(args, "camera_workers", None) is not None:
+        return max(args.camera_workers, 1)
+    return min(num_cameras, cpu_workers())
+
+
+def image_size(cameras):
+    """Number of values of an image of the first of cameras that has images,
+    or 1 if it cannot be read"""
+    for camera in cameras:
+        if len(camera.image_list) == 0:
+            continue
+        try:
+            height, width, channels = camera.image_properties
+            return height * width * channels
+        except Exception as e:
+            Console.warn("Cannot read the image size of camera", camera.name, e)
+        break
+    return 1
+
+
+def camera_priority(correct_config, camera_name):
+    """Priority of a camera in correct_images.yaml, 1 if it is not set"""
+    for camera_config in correct_config.configs.camera_configs:
+        if camera_config.camera_name == camera_name:
+            return camera_config.priority
+    return 1.0
+
+
+def set_worker_logging_file(log_file):
+    """Log to the file of the command in the worker processes of
+    run_shared, which do not inherit it"""
+    handlers = logging.getLogger().handlers
+    if not any(isinstance(h, logging.FileHandler) for h in handlers):
+        Console.set_logging_file(log_file)
+
+
+def parse_camera(camera, path_list, correct_config_list, args):
+    """Compute the correction parameters of a camera over all dives"""
+    set_worker_logging_file(args.log_file)
+    Console.info("Parsing for camera", camera.name)
+    # Create a Corrector object for the camera with empty configuration
+    # The configuration and the paths will be populated later on a per-dive basis
+    corrector = Corrector("parse", args.force, args.suffix, camera, correct_config=None)
+    # call new list-compatible implementation of parse()
+    corrector.parse(path_list, correct_config_list)
+    corrector.cleanup()
+
+
+def process_camera(camera, correct_config, path, args):
+    """Correct the images of a camera"""
+    set_worker_logging_file(args.log_file)
+    Console.info("Processing for camera", camera.name)
+    corrector = Corrector(
+        "process", args.force, args.suffix, camera, correct_config, path, args.resume
+    )
+    if corrector.camera_found:
+        corrector.process()
+
+
 def call_correct(args):
     """Perform parse and process in one go. Can be used for small datasets
 
@@ -328,6 +517,111 @@ def call_rescale(args):
     Console.info("Rescaling completed for all cameras ...")
 
 
+def call_diagnostics(args):
+    """Render the diagnostic figures stored by parse
+
+    Parameters
+    -----------
+    args : parse_args object
+        User provided arguments for the folder of the correction parameters
+    """
+    render_diagnostics(Path(args.path).resolve(), args.figures, args.dpi)
+    Console.info("Diagnostic figures rendered")
+
+
+def call_merge(args):
+    """Merge the bin statistics of several parse runs, e.g. of several dives
+    or of shards of a dive, and refit the correction parameters from them
+
+    Parameters
+    -----------
+    args : parse_args object
+        User provided arguments for the statistics to merge and the output
+        folder
+    """
+    bin_statistics = None
+    paths = []
+    for path in args.path:
+        Console.info("Merging bin statistics", path)
+        path = Path(path).resolve()
+        if path.is_dir():
+            path = path / BIN_STATISTICS_FILENAME
+        paths.append(path)
+        statistics = BinStatistics.load(path)
+        if bin_statistics is None:
+            bin_statistics = statistics
+        else:
+            bin_statistics.merge(statistics)
+    Console.info(
+        "Merged",
+        bin_statistics.count,
+        "images in",
+        len(bin_statistics.accumulators),
+        "bins",
+    )
+    settings = bin_statistics.settings
+    if settings is None:
+        Console.warn(
+            "The bin statistics do not record the settings of parse. They are",
+            "assumed to use the mean smoothing and the batch fitting.",
+        )
+        settings = {}
+    # The bin statistics only hold the mean of each bin, so merge can only
+    # reproduce the mean smoothing
+    smoothing = settings.get("smoothing", "mean")
+    if smoothing != "mean":
+        if not args.mean_smoothing:
+            Console.quit(
+                "The bin statistics were parsed with the",
+                smoothing,
+                "smoothing, but merge can only fit the mean of each altitude bin.",
+                "Run merge with --mean-smoothing to fit the mean anyway.",
+            )
+        Console.warn("Fitting the mean of each altitude bin instead of the", smoothing)
+    if not settings.get("single_pass", False):
+        Console.info(
+            "The corrected mean and std are computed from the bin statistics, as",
+            "with single_pass, instead of reading the images again as parse did.",
+        )
+    fitting_method = args.fitting_method or settings.get("fitting_method", "batch")
+
+    output = Path(args.output).resolve()
+    output.mkdir(parents=True, exist_ok=True)
+    filenames = [
+        BIN_STATISTICS_FILENAME,
+        "attenuation_parameters.npy",
+        "correction_gains.npy",
+        "image_corrected_mean.npy",
+        "image_corrected_std.npy",
+    ]
+    parse_cache = ParseCache(output, filenames)
+    # Write new files instead of overwriting cached ones through hard links
+    parse_cache.clear()
+    bin_statistics.settings = dict(
+        settings, smoothing="mean", single_pass=True, fitting_method=fitting_method
+    )
+    bin_statistics.save(output / BIN_STATISTICS_FILENAME)
+
+    (
+        attenuation_parameters,
+        correction_gains,
+        corrected_mean,
+        corrected_std,
+    ) = attenuation_from_bin_statistics(
+        bin_statistics,
+        fitting_method,
+        stride=settings.get("fitting_stride", 1),
+        upsampling=settings.get("fitting_upsampling", "bilinear"),
+    )
+    np.save(output / "attenuation_parameters.npy", attenuation_parameters)
+    np.save(output / "correction_gains.npy", correction_gains)
+    np.save(output / "image_corrected_mean.npy", corrected_mean)
+    np.save(output / "image_corrected_std.npy", corrected_std)
+    # Recorded so that process can check the parameters against its settings
+    parse_cache.store(ParseCache.record(bin_statistics.settings, inputs_key(paths)))
+    Console.info("Merged correction parameters saved to", output)
+
+
 def load_configuration_and_camera_system(path, suffix=None):
     """Generate correct_config and camera system objects from input config
     yaml files
@@ -1,8 +1,14 @@
+from .attenuation import GainMapCache  # noqa
 from .attenuation import attenuation_correct  # noqa
+from .attenuation import attenuation_gain_map  # noqa
 from .attenuation import calculate_attenuation_parameters  # noqa
 from .attenuation import calculate_correction_gains  # noqa
+from .attenuation import gain_map_correct  # noqa
 from .attenuation import save_attenuation_plots  # noqa
+from .attenuation import validate_upsampled_parameters  # noqa
 from .debayer import debayer  # noqa
+from .fused import colour_correct  # noqa
+from .fused import manual_balance_uint16  # noqa
 from .gamma import gamma_correct  # noqa
 from .manual_balance import manual_balance  # noqa
 from .pixel_stat import pixel_stat  # noqa
@@ -6,16 +6,24 @@ Licensed under the BSD 3-Clause License.
 See LICENSE.md file in the project root for full license information.
 """
 
+import threading
+from collections import OrderedDict
 from pathlib import Path
 
+import cv2
 import joblib
 import numpy as np
-import psutil
+import pandas as pd
 from matplotlib import pyplot as plt
 from tqdm import tqdm
 
-from correct_images.tools.curve_fitting import curve_fitting
+from correct_images.tools.curve_fitting import (
+    curve_fitting,
+    curve_fitting_batch,
+    plot_curve_fitting,
+)
 from correct_images.tools.joblib_tqdm import tqdm_joblib
+from correct_images.tools.scheduler import cpu_workers, max_concurrent_jobs
 from oplab import Console
 
 
@@ -79,6 +87,118 @@ def attenuation_correct(
     return img_float32
 
 
+def attenuation_gain_map(
+    altitude: float, atn_crr_params: np.ndarray, gain: np.ndarray
+) -> np.ndarray:
+    """Compute the per-pixel factor that attenuation_correct applies to an
+    image taken at a constant altitude
+
+    Parameters
+    -----------
+    altitude : float
+        altitude of the image
+    atn_crr_params : numpy.ndarray
+        attenuation coefficients
+    gain : numpy.ndarray
+        gain value for the image
+
+    Returns
+    -------
+    numpy.ndarray
+        Gain map, with one layer per channel
+    """
+    gain_map = gain / (
+        atn_crr_params[..., 0] * np.exp(atn_crr_params[..., 1] * altitude)
+        + atn_crr_params[..., 2]
+    )
+    return gain_map.astype(np.float32)
+
+
+def gain_map_correct(img: np.ndarray, gain_map: np.ndarray) -> np.ndarray:
+    """Apply a gain map from attenuation_gain_map to an input image
+
+    Parameters
+    -----------
+    img : numpy.ndarray
+        input image
+    gain_map : numpy.ndarray
+        gain map, with one layer per channel
+
+    Returns
+    -------
+    numpy.ndarray
+        Corrected image
+    """
+    img_float32 = img.astype(np.float32)
+    if len(img_float32.shape) == 3:
+        img_float32 *= gain_map.transpose((1, 2, 0))
+    else:
+        img_float32 *= gain_map[0]
+    return img_float32
+
+
+class GainMapCache:
+    __slots__ = [
+        "atn_crr_params",
+        "gain",
+        "step",
+        "max_bytes",
+        "hits",
+        "misses",
+        "_maps",
+        "_lock",
+    ]
+
+    def __init__(self, atn_crr_params, gain, step=0.01, max_bytes=2**30):
+        """Least recently used cache of the gain maps of attenuation_gain_map,
+        keyed by altitude rounded to a multiple of step (in metres).
+
+        Images at the same rounded altitude share a gain map, so correcting
+        them only takes a multiplication per pixel. The gain map is that of
+        the rounded altitude, so the correction differs from the exact one by
+        at most the change of the attenuation over step / 2. The least
+        recently used maps are dropped to keep the cache below max_bytes.
+        The cache can be shared between threads.
+        """
+        self.atn_crr_params = atn_crr_params
+        self.gain = gain
+        self.step = step
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._maps = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __call__(self, altitude):
+        """Get the gain map for an altitude."""
+        key = int(round(altitude / self.step))
+        with self._lock:
+            gain_map = self._maps.get(key)
+            if gain_map is not None:
+                self._maps.move_to_end(key)
+                self.hits += 1
+                return gain_map
+            self.misses += 1
+        gain_map = attenuation_gain_map(key * self.step, self.atn_crr_params, self.gain)
+        with self._lock:
+            self._maps[key] = gain_map
+            while self._maps and self.nbytes > self.max_bytes:
+                self._maps.popitem(last=False)
+        return gain_map
+
+    def __len__(self):
+        return len(self._maps)
+
+    @property
+    def nbytes(self):
+        return sum(gain_map.nbytes for gain_map in self._maps.values())
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.0
+
+
 # compute gain values for each pixel for a targeted altitude using the
 # attenuation parameters
 def calculate_correction_gains(
@@ -127,6 +247,10 @@ def calculate_attenuation_parameters(
     image_width: int,
     image_channels: int,
     output_folder: Path,
+    fitting_method: str = "batch",
+    memory_budget: int = None,
+    stride: int = 1,
+    upsampling: str = "bilinear",
 ):
     """Compute attenuation parameters for all images
 
@@ -140,6 +264,23 @@ def calculate_attenuation_parameters(
         height of an image
     image_width : int
         width of an image
+    image_channels : int
+        number of channels of an image
+    output_folder : Path
+        folder where the intensity curve figures are written, or None to not
+        write them
+    fitting_method : str
+        "batch" to fit all pixels at once with the vectorised solver, or
+        "reference" to fit each pixel with scipy.optimize.least_squares
+    memory_budget : int
+        memory, in bytes, that the "reference" fitting jobs can use. Defaults
+        to the available memory
+    stride : int
+        size of the square pixel blocks pooled into one curve fit. With a
+        stride larger than 1 the curves are fitted on a coarse grid and the
+        parameters are upsampled to the full image resolution
+    upsampling : str
+        "bilinear" or "bicubic" interpolation of the coarse parameters
 
     Returns
     -------
@@ -147,24 +288,55 @@ def calculate_attenuation_parameters(
         attenuation_parameters
     """
 
+    if stride > 1:
+        coarse_height = -(-image_height // stride)
+        coarse_width = -(-image_width // stride)
+        Console.info(
+            "Fitting attenuation curves on a",
+            coarse_height,
+            "x",
+            coarse_width,
+            "grid with stride",
+            stride,
+        )
+        coarse_images, coarse_distances = pool_bins(
+            images, distances, image_height, image_width, image_channels, stride
+        )
+        coarse_parameters = calculate_attenuation_parameters(
+            coarse_images,
+            coarse_distances,
+            coarse_height,
+            coarse_width,
+            image_channels,
+            None,
+            fitting_method,
+            memory_budget,
+        )
+        return upsample_parameters(
+            coarse_parameters, image_height, image_width, stride, upsampling
+        )
+
+    if fitting_method == "batch":
+        return calculate_attenuation_parameters_batch(
+            images,
+            distances,
+            image_height,
+            image_width,
+            image_channels,
+            output_folder,
+        )
+    elif fitting_method != "reference":
+        Console.quit("Curve fitting method not recognised:", fitting_method)
+
     image_attenuation_parameters = np.empty(
         (image_channels, image_height, image_width, 3), dtype=np.float32
     )
 
-    # Check available RAM and allocate threads accordingly
-    mem = psutil.virtual_memory()
-    available_bytes = mem.available  # in bytes
+    # Each job gets a copy of the images and distances. Allocate as many jobs
+    # as fit in memory, keeping one CPU alive
     required_bytes = image_channels * image_height * image_width * 4 * len(images)
-    num_jobs = int(available_bytes / required_bytes)*2
-
-    # Keep one alive!
-    cpus = psutil.cpu_count() - 1
-
-    if num_jobs > cpus:
-        num_jobs = cpus
-    elif num_jobs <= 0:
-        num_jobs = 1
-        Console.warn("You might have not enough available RAM to continue.")
+    cpus = cpu_workers()
+    num_jobs = max_concurrent_jobs(required_bytes, memory_budget, cpus)
 
     if num_jobs < cpus - 1:
         Console.info("Assigning", num_jobs, "jobs to your CPU to save RAM")
@@ -177,18 +349,12 @@ def calculate_attenuation_parameters(
             channel_str = "c_" + str(i_channel) + "_"
         else:
             channel_str = ""
-        figure_paths = []
-        slope = image_height / image_width
-        for y in range(image_height):
-            x_diag = round(y / slope)
-            for x in range(image_width):
-                if x == x_diag:
-                    # On image diagonal -> generate path so figure is written to file
-                    filename = f"intensities_curve_{channel_str}x_{x:04}_y_{y:04}.png"
-                    figure_paths.append(output_folder / Path(filename))
-                else:
-                    # Not on diagonal -> don't output figure / generate path for file
-                    figure_paths.append(None)
+        if output_folder is not None:
+            figure_paths = curve_figure_paths(
+                image_height, image_width, channel_str, output_folder
+            )
+        else:
+            figure_paths = [None] * (image_height * image_width)
         with tqdm_joblib(tqdm(desc="Curve fitting", total=image_height * image_width)):
             results = joblib.Parallel(n_jobs=num_jobs, verbose=0)(
                 [
@@ -212,8 +378,309 @@ def calculate_attenuation_parameters(
     return image_attenuation_parameters
 
 
+def curve_figure_paths(
+    image_height: int, image_width: int, channel_str: str, output_folder: Path
+) -> list:
+    """List the intensity curve figure path of every pixel of a channel
+
+    Only pixels on the image diagonal get a path, the rest are None.
+    """
+    figure_paths = []
+    slope = image_height / image_width
+    for y in range(image_height):
+        x_diag = round(y / slope)
+        for x in range(image_width):
+            if x == x_diag:
+                # On image diagonal -> generate path so figure is written to file
+                filename = f"intensities_curve_{channel_str}x_{x:04}_y_{y:04}.png"
+                figure_paths.append(output_folder / Path(filename))
+            else:
+                # Not on diagonal -> don't output figure / generate path for file
+                figure_paths.append(None)
+    return figure_paths
+
+
+def calculate_attenuation_parameters_batch(
+    images: np.ndarray,
+    distances: np.ndarray,
+    image_height: int,
+    image_width: int,
+    image_channels: int,
+    output_folder: Path,
+):
+    """Compute attenuation parameters for all pixels at once
+
+    Uses the vectorised solver in curve_fitting_batch instead of one
+    scipy.optimize.least_squares call per pixel.
+
+    Parameters
+    -----------
+    images : numpy.ndarray
+        image memmap reshaped as a vector
+    distances : numpy.ndarray
+        distance memmap reshaped as a vector
+    image_height : int
+        height of an image
+    image_width : int
+        width of an image
+    image_channels : int
+        number of channels of an image
+    output_folder : Path
+        folder where the intensity curve figures are written, or None to not
+        write them
+
+    Returns
+    -------
+    numpy.ndarray
+        attenuation_parameters
+    """
+    image_attenuation_parameters = np.empty(
+        (image_channels, image_height, image_width, 3), dtype=np.float32
+    )
+    for i_channel in range(image_channels):
+        Console.info("Curve fitting channel", i_channel, "of", image_channels)
+        attenuation_parameters = curve_fitting_batch(
+            distances, images[:, :, i_channel]
+        )
+        image_attenuation_parameters[i_channel] = attenuation_parameters.reshape(
+            [image_height, image_width, 3]
+        )
+
+        if output_folder is None:
+            continue
+        if image_channels > 1:
+            channel_str = "c_" + str(i_channel) + "_"
+        else:
+            channel_str = ""
+        figure_paths = curve_figure_paths(
+            image_height, image_width, channel_str, output_folder
+        )
+        diagonal_pixels = [i for i, p in enumerate(figure_paths) if p is not None]
+        with tqdm_joblib(
+            tqdm(desc="Curve fitting plots", total=len(diagonal_pixels))
+        ):
+            joblib.Parallel(n_jobs=cpu_workers(), verbose=0)(
+                joblib.delayed(plot_curve_fitting)(
+                    distances[:, i_pixel],
+                    images[:, i_pixel, i_channel],
+                    attenuation_parameters[i_pixel],
+                    figure_paths[i_pixel],
+                )
+                for i_pixel in diagonal_pixels
+            )
+    return image_attenuation_parameters
+
+
+UPSAMPLING_METHODS = {"bilinear": cv2.INTER_LINEAR, "bicubic": cv2.INTER_CUBIC}
+
+
+def _block_mean(values, valid, image_height, image_width, stride):
+    # Mean of the valid values of each stride x stride block of an image
+    padded_height = -(-image_height // stride) * stride
+    padded_width = -(-image_width // stride) * stride
+    sums = np.zeros((padded_height, padded_width), dtype=np.float64)
+    counts = np.zeros((padded_height, padded_width), dtype=np.float64)
+    sums[:image_height, :image_width] = np.where(valid, values, 0)
+    counts[:image_height, :image_width] = valid
+    shape = (padded_height // stride, stride, padded_width // stride, stride)
+    sums = sums.reshape(shape).sum(axis=(1, 3))
+    counts = counts.reshape(shape).sum(axis=(1, 3))
+    # Blocks without valid values are left at 0, as empty bins
+    return np.divide(sums, counts, out=np.zeros_like(sums), where=counts > 0)
+
+
+def pool_bins(images, distances, image_height, image_width, image_channels, stride):
+    """Average the bin images and distances over square pixel blocks
+
+    Only valid samples, positive and finite, are averaged, so that empty bins
+    and missing distances do not bias the block means.
+
+    Parameters
+    -----------
+    images : numpy.ndarray
+        bin images, of shape (bins, height * width, channels)
+    distances : numpy.ndarray
+        bin distances, of shape (bins, height * width)
+    image_height : int
+        height of an image
+    image_width : int
+        width of an image
+    image_channels : int
+        number of channels of an image
+    stride : int
+        size of the pixel blocks
+
+    Returns
+    -------
+    tuple
+        pooled images, of shape (bins, coarse pixels, channels), and pooled
+        distances, of shape (bins, coarse pixels)
+    """
+    num_bins = len(images)
+    coarse_pixels = (-(-image_height // stride)) * (-(-image_width // stride))
+    coarse_images = np.zeros((num_bins, coarse_pixels, image_channels), np.float32)
+    coarse_distances = np.zeros((num_bins, coarse_pixels), np.float32)
+    for idx_bin in range(num_bins):
+        distance = np.asarray(distances[idx_bin]).reshape(image_height, image_width)
+        distance_valid = np.isfinite(distance) & (distance > 0)
+        coarse_distances[idx_bin] = _block_mean(
+            distance, distance_valid, image_height, image_width, stride
+        ).reshape(-1)
+        for i_channel in range(image_channels):
+            image = np.asarray(images[idx_bin, :, i_channel]).reshape(
+                image_height, image_width
+            )
+            valid = distance_valid & np.isfinite(image) & (image > 0)
+            coarse_images[idx_bin, :, i_channel] = _block_mean(
+                image, valid, image_height, image_width, stride
+            ).reshape(-1)
+    return coarse_images, coarse_distances
+
+
+def upsample_parameters(
+    coarse_parameters, image_height, image_width, stride, upsampling="bilinear"
+):
+    """Interpolate attenuation parameters fitted on a coarse grid to the full
+    image resolution
+
+    Each coarse parameter is placed at the centre of its pixel block. The
+    interpolated parameters are clipped to the bounds of the curve fit.
+
+    Parameters
+    -----------
+    coarse_parameters : numpy.ndarray
+        parameters of shape (channels, coarse height, coarse width, 3)
+    image_height : int
+        height of an image
+    image_width : int
+        width of an image
+    stride : int
+        size of the pixel blocks of the coarse grid
+    upsampling : str
+        "bilinear" or "bicubic"
+
+    Returns
+    -------
+    numpy.ndarray
+        parameters of shape (channels, height, width, 3)
+    """
+    if upsampling not in UPSAMPLING_METHODS:
+        Console.quit(
+            "Upsampling method",
+            upsampling,
+            "not supported. Use",
+            list(UPSAMPLING_METHODS),
+        )
+    image_channels, coarse_height, coarse_width, _ = coarse_parameters.shape
+    parameters = np.empty((image_channels, image_height, image_width, 3), np.float32)
+    for i_channel in range(image_channels):
+        for i_param in range(3):
+            upsampled = cv2.resize(
+                np.ascontiguousarray(
+                    coarse_parameters[i_channel, :, :, i_param], dtype=np.float32
+                ),
+                (coarse_width * stride, coarse_height * stride),
+                interpolation=UPSAMPLING_METHODS[upsampling],
+            )
+            parameters[i_channel, :, :, i_param] = upsampled[:image_height, :image_width]
+    # Bicubic interpolation can overshoot the bounds of the fit
+    parameters[..., 0] = np.maximum(parameters[..., 0], 1e-6)
+    parameters[..., 1] = np.minimum(parameters[..., 1], 0)
+    parameters[..., 2] = np.maximum(parameters[..., 2], 0)
+    return parameters
+
+
+def validate_upsampled_parameters(
+    images,
+    distances,
+    attenuation_parameters,
+    image_height,
+    image_width,
+    image_channels,
+    num_pixels=1000,
+    seed=0,
+):
+    """Compare upsampled attenuation parameters with full resolution fits on
+    a random subset of pixels
+
+    The error of a pixel is the root mean square difference between the full
+    resolution and the upsampled curves, at the altitudes of its valid bins,
+    relative to the mean of the full resolution curve.
+
+    Parameters
+    -----------
+    images : numpy.ndarray
+        bin images, of shape (bins, height * width, channels)
+    distances : numpy.ndarray
+        bin distances, of shape (bins, height * width)
+    attenuation_parameters : numpy.ndarray
+        upsampled parameters, of shape (channels, height, width, 3)
+    image_height : int
+        height of an image
+    image_width : int
+        width of an image
+    image_channels : int
+        number of channels of an image
+    num_pixels : int
+        number of pixels to fit at full resolution
+    seed : int
+        seed of the random pixel selection
+
+    Returns
+    -------
+    pandas.DataFrame
+        one row per channel and pixel, with the full resolution and upsampled
+        parameters and the relative error
+    """
+    rng = np.random.default_rng(seed)
+    num_pixels = min(num_pixels, image_height * image_width)
+    pixels = np.sort(
+        rng.choice(image_height * image_width, size=num_pixels, replace=False)
+    )
+    altitudes = np.asarray(distances[:, pixels], dtype=np.float32)
+    rows = []
+    for i_channel in range(image_channels):
+        intensities = np.asarray(images[:, pixels, i_channel], dtype=np.float32)
+        full = curve_fitting_batch(altitudes, intensities)
+        upsampled = attenuation_parameters[i_channel].reshape(-1, 3)[pixels]
+        valid = (
+            np.isfinite(altitudes)
+            & (altitudes > 0)
+            & np.isfinite(intensities)
+            & (intensities > 0)
+        )
+        full_curves = full[:, 0] * np.exp(full[:, 1] * altitudes) + full[:, 2]
+        upsampled_curves = (
+            upsampled[:, 0] * np.exp(upsampled[:, 1] * altitudes) + upsampled[:, 2]
+        )
+        counts = np.maximum(valid.sum(axis=0), 1)
+        rms = np.sqrt(
+            np.where(valid, (full_curves - upsampled_curves) ** 2, 0).sum(axis=0)
+            / counts
+        )
+        mean = np.where(valid, full_curves, 0).sum(axis=0) / counts
+        relative_error = np.divide(rms, mean, out=np.zeros_like(rms), where=mean > 0)
+        rows.append(
+            pd.DataFrame(
+                {
+                    "channel": i_channel,
+                    "x": pixels % image_width,
+                    "y": pixels // image_width,
+                    "a_full": full[:, 0],
+                    "b_full": full[:, 1],
+                    "c_full": full[:, 2],
+                    "a_upsampled": upsampled[:, 0],
+                    "b_upsampled": upsampled[:, 1],
+                    "c_upsampled": upsampled[:, 2],
+                    "relative_error": relative_error,
+                }
+            )
+        )
+    return pd.concat(rows, ignore_index=True)
+
+
 def save_attenuation_plots(
-    output_dir, attn=None, gains=None, img_mean=None, img_std=None
+    output_dir, attn=None, gains=None, img_mean=None, img_std=None, dpi=600
 ):
     output_dir = Path(output_dir)
 
@@ -225,7 +692,7 @@ def save_attenuation_plots(
         plt.imshow(gains[0, :, :])
         plt.colorbar()
         plt.title("Gain")
-        plt.savefig(output_dir / "gain.png", dpi=600)
+        plt.savefig(output_dir / "gain.png", dpi=dpi)
         plt.close(fig)
 
     if attn is not None:
@@ -233,21 +700,21 @@ def save_attenuation_plots(
         plt.imshow(attn[0, :, :, 0])
         plt.colorbar()
         plt.title("Attenuation coeff 0")
-        plt.savefig(output_dir / "attenuation_coeff_0.png", dpi=600)
+        plt.savefig(output_dir / "attenuation_coeff_0.png", dpi=dpi)
         plt.close(fig)
 
         fig = plt.figure()
         plt.imshow(attn[0, :, :, 1])
         plt.colorbar()
         plt.title("Attenuation coeff 1")
-        plt.savefig(output_dir / "attenuation_coeff_1.png", dpi=600)
+        plt.savefig(output_dir / "attenuation_coeff_1.png", dpi=dpi)
         plt.close(fig)
 
         fig = plt.figure()
         plt.imshow(attn[0, :, :, 2])
         plt.colorbar()
         plt.title("Attenuation coeff 2")
-        plt.savefig(output_dir / "attenuation_coeff_2.png", dpi=600)
+        plt.savefig(output_dir / "attenuation_coeff_2.png", dpi=dpi)
         plt.close(fig)
 
     if img_mean is not None:
@@ -258,7 +725,7 @@ def save_attenuation_plots(
             plt.imshow(img_mean[:, :])
         plt.colorbar()
         plt.title("Mean 0")
-        plt.savefig(output_dir / "image_corrected_mean_0.png", dpi=600)
+        plt.savefig(output_dir / "image_corrected_mean_0.png", dpi=dpi)
         plt.close(fig)
 
         if len(img_mean.shape) == 3:
@@ -267,7 +734,7 @@ def save_attenuation_plots(
                 plt.imshow(img_mean[:, :, 1])
                 plt.colorbar()
                 plt.title("Mean 1")
-                plt.savefig(output_dir / "image_corrected_mean_1.png", dpi=600)
+                plt.savefig(output_dir / "image_corrected_mean_1.png", dpi=dpi)
                 plt.close(fig)
 
             if img_mean.shape[2] > 2:
@@ -275,7 +742,7 @@ def save_attenuation_plots(
                 plt.imshow(img_mean[:, :, 2])
                 plt.colorbar()
                 plt.title("Mean 2")
-                plt.savefig(output_dir / "image_corrected_mean_2.png", dpi=600)
+                plt.savefig(output_dir / "image_corrected_mean_2.png", dpi=dpi)
                 plt.close(fig)
 
     if img_std is not None:
@@ -286,7 +753,7 @@ def save_attenuation_plots(
             plt.imshow(img_std[:, :])
         plt.colorbar()
         plt.title("Std 0")
-        plt.savefig(output_dir / "image_corrected_std_0.png", dpi=600)
+        plt.savefig(output_dir / "image_corrected_std_0.png", dpi=dpi)
         plt.close(fig)
 
         if len(img_std.shape) == 3:
@@ -295,12 +762,12 @@ def save_attenuation_plots(
                 plt.imshow(img_std[:, :, 0])
                 plt.colorbar()
                 plt.title("Std 1")
-                plt.savefig(output_dir / "image_corrected_std_1.png", dpi=600)
+                plt.savefig(output_dir / "image_corrected_std_1.png", dpi=dpi)
                 plt.close(fig)
             if img_std.shape[2] > 2:
                 fig = plt.figure()
                 plt.imshow(img_std[:, :, 0])
                 plt.colorbar()
                 plt.title("Std 2")
-                plt.savefig(output_dir / "image_corrected_std_2.png", dpi=600)
+                plt.savefig(output_dir / "image_corrected_std_2.png", dpi=dpi)
                 plt.close(fig)
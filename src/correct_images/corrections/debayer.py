@@ -38,6 +38,28 @@ def debayer(image: np.ndarray, pattern: str) -> np.ndarray:
     image16_float = image.astype(np.float32) * (2**16 - 1)
     image16 = image16_float.clip(0, 2**16 - 1).astype(np.uint16)
 
+    corrected_rgb_img = debayer_uint16(image16, pattern)
+
+    # Scale down to unitary
+    corrected_rgb_img = corrected_rgb_img.astype(np.float32) * (2 ** (-16))
+    return corrected_rgb_img
+
+
+def debayer_uint16(image16: np.ndarray, pattern: str) -> np.ndarray:
+    """Perform edge-aware debayering of a 16-bit image
+
+    Parameters
+    -----------
+    image16 : numpy.ndarray
+        uint16 image data to be debayered
+    pattern : string
+        bayer pattern
+
+    Returns
+    -------
+    numpy.ndarray
+        Debayered uint16 image
+    """
     corrected_rgb_img = None
     if pattern == "rggb" or pattern == "RGGB":
         corrected_rgb_img = cv2.cvtColor(image16, cv2.COLOR_BAYER_BG2RGB_EA)
@@ -49,7 +71,4 @@ def debayer(image: np.ndarray, pattern: str) -> np.ndarray:
         corrected_rgb_img = cv2.cvtColor(image16, cv2.COLOR_BAYER_GR2RGB_EA)
     else:
         Console.quit("Bayer pattern not supported (", pattern, ")")
-
-    # Scale down to unitary
-    corrected_rgb_img = corrected_rgb_img.astype(np.float32) * (2 ** (-16))
     return corrected_rgb_img
@@ -0,0 +1,393 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (c) 2023, University of Southampton
+All rights reserved.
+Licensed under the BSD 3-Clause License.
+See LICENSE.md file in the project root for full license information.
+"""
+
+from functools import lru_cache
+
+import cv2
+import numpy as np
+from numba import njit, prange
+
+from .debayer import debayer_uint16
+from .undistort import rectification_maps
+
+# Below this value gamma_correct is linear, if the whole image is below it
+GAMMA_LINEAR_THRESHOLD = 0.0031308
+# Number of intervals of the gamma lookup tables over [0, 1]
+GAMMA_LUT_SIZE = 2**16
+# Attenuation correction modes of the kernel
+ATTENUATE_NONE = 0
+ATTENUATE_PARAMETERS = 1
+ATTENUATE_GAIN_MAP = 2
+# Fractional bits of the fixed-point gains of manual_balance_uint16, and
+# extra fractional bits of its intensities and subtractors
+GAIN_FRACTION_BITS = 16
+INTENSITY_FRACTION_BITS = 16
+
+
+@njit
+def _gamma_to_uint8_exact(value, linear):
+    # Same operations as gamma_correct and the conversion to 8 bits
+    if linear:
+        value = np.float32(12.92) * value
+    else:
+        value = np.float32(1.055) * value ** np.float32(1 / 1.5) - np.float32(0.055)
+    value = value * np.float32(255)
+    if value < 0:
+        value = np.float32(0)
+    elif value > 255:
+        value = np.float32(255)
+    return np.uint8(value)
+
+
+@njit
+def _gamma_to_uint8(value, lut, linear):
+    # The gamma curve is increasing, so if both ends of the interval of the
+    # value give the same 8-bit output, so does the value. Otherwise, compute
+    # it exactly
+    idx = int(value * GAMMA_LUT_SIZE)
+    if idx < 0 or idx >= GAMMA_LUT_SIZE or lut[idx] != lut[idx + 1]:
+        return _gamma_to_uint8_exact(value, linear)
+    return lut[idx]
+
+
+@njit
+def _build_gamma_lut(linear):
+    lut = np.empty(GAMMA_LUT_SIZE + 1, dtype=np.uint8)
+    for i in range(GAMMA_LUT_SIZE + 1):
+        lut[i] = _gamma_to_uint8_exact(np.float32(i / GAMMA_LUT_SIZE), linear)
+    return lut
+
+
+@lru_cache(maxsize=2)
+def gamma_lut(linear):
+    """Get the 8-bit output of gamma_correct at GAMMA_LUT_SIZE + 1 equally
+    spaced values between 0 and 1"""
+    return _build_gamma_lut(linear)
+
+
+@njit(parallel=True)
+def _colour_correct_kernel(
+    image,
+    attenuate,
+    distance,
+    parameters,
+    gains,
+    gain_map,
+    mean,
+    std,
+    target_mean,
+    target_std,
+    swap_channels,
+    to_uint8,
+    lut,
+    linear,
+    out_scale,
+    out,
+):
+    height, width, channels = image.shape
+    row_max = np.zeros(height, dtype=np.float32)
+    for i in prange(height):
+        for j in range(width):
+            for k in range(channels):
+                value = image[i, j, k]
+                if attenuate == ATTENUATE_GAIN_MAP:
+                    # gain_map_correct
+                    value = np.float32(value) * gain_map[k, i, j]
+                elif attenuate == ATTENUATE_PARAMETERS:
+                    # attenuation_correct
+                    p = parameters[k, i, j]
+                    value = np.float32(
+                        gains[k, i, j]
+                        / (p[0] * np.exp(p[1] * distance[i, j]) + p[2])
+                        * np.float64(value)
+                    )
+                # pixel_stat
+                value = (value - mean[i, j, k]) / std[i, j, k] * target_std
+                value = value + target_mean
+                if value < 0:
+                    value = np.float32(0)
+                elif value > 1:
+                    value = np.float32(1)
+                k_out = channels - 1 - k if swap_channels else k
+                if to_uint8:
+                    row_max[i] = max(row_max[i], value)
+                    out[i, j, k_out] = _gamma_to_uint8(value, lut, linear)
+                else:
+                    # Scale to the output type, e.g. to 16 bits for debayering
+                    out[i, j, k_out] = value * out_scale
+    return row_max
+
+
+# Serial variants of the kernels, for callers that already run one image per
+# thread or process. prange runs as range when parallel is off
+_colour_correct_kernel_serial = njit(_colour_correct_kernel.py_func)
+
+
+@njit(parallel=True)
+def _gamma_kernel(image, scale, lut, linear, out):
+    height, width, channels = image.shape
+    for i in prange(height):
+        for j in range(width):
+            for k in range(channels):
+                value = np.float32(image[i, j, k]) * np.float32(scale)
+                out[i, j, k] = _gamma_to_uint8(value, lut, linear)
+
+
+_gamma_kernel_serial = njit(_gamma_kernel.py_func)
+
+
+def _gamma_uint8(image, scale, parallel=True):
+    """Apply gamma_correct to an image and convert it to 8 bits"""
+    linear = bool(image.max() * scale < GAMMA_LINEAR_THRESHOLD)
+    image = image.reshape(image.shape[0], image.shape[1], -1)
+    out = np.empty(image.shape, dtype=np.uint8)
+    kernel = _gamma_kernel if parallel else _gamma_kernel_serial
+    kernel(image, scale, gamma_lut(linear), linear, out)
+    return out
+
+
+def colour_correct(
+    image,
+    distance,
+    attenuation_parameters,
+    gains,
+    mean,
+    std,
+    brightness,
+    contrast,
+    image_type,
+    camera_params_file_path=None,
+    undistort_fixed_point=False,
+    gain_map=None,
+    parallel=True,
+):
+    """Apply the colour correction of process to an image, fusing the
+    corrections in compiled kernels that make a single pass over memory
+
+    This is equivalent to applying attenuation_correct (if distance is not
+    None) or gain_map_correct (if gain_map is not None), pixel_stat, debayer or the channel swap, distortion_correct (if
+    camera_params_file_path is not None), gamma_correct and the conversion to
+    8 bits in sequence. Results can differ by one intensity level, due to the
+    order of floating point operations.
+
+    Parameters
+    -----------
+    image : numpy.ndarray
+        image data, with intensities between 0 and 1
+    distance : numpy.ndarray
+        distance matrix corresponding to the image, or None to skip the
+        attenuation correction
+    attenuation_parameters : numpy.ndarray
+        attenuation coefficients
+    gains : numpy.ndarray
+        correction gains
+    mean : numpy.ndarray
+        image mean, after the attenuation correction if it is applied
+    std : numpy.ndarray
+        image std, after the attenuation correction if it is applied
+    brightness : float
+        desired mean in 0-100 scale
+    contrast : float
+        desired std in 0-100 scale
+    image_type : str
+        grayscale, rgb, bgr or the bayer pattern of the image
+    camera_params_file_path : Path
+        camera parameters file to correct the distortion, or None
+    undistort_fixed_point : bool
+        use fixed-point remap tables to correct the distortion
+    gain_map : numpy.ndarray
+        gain map from attenuation_gain_map, used instead of distance,
+        attenuation_parameters and gains
+    parallel : bool
+        split the image between threads. Set it to False when images are
+        already corrected concurrently, e.g. by the workers of process
+
+    Returns
+    -------
+    numpy.ndarray
+        Corrected 8-bit image
+    """
+    height, width = image.shape[0], image.shape[1]
+    image = image.reshape(height, width, -1)
+    channels = image.shape[2]
+    is_bayer = image_type not in ["grayscale", "rgb", "bgr"]
+    # Unused arrays are replaced by placeholders of the type the kernel expects
+    attenuate = ATTENUATE_NONE
+    if gain_map is not None:
+        attenuate = ATTENUATE_GAIN_MAP
+        gain_map = np.asarray(gain_map, dtype=np.float32)
+    else:
+        gain_map = np.zeros((1, 1, 1), dtype=np.float32)
+    if distance is not None and attenuate == ATTENUATE_NONE:
+        attenuate = ATTENUATE_PARAMETERS
+        distance = np.asarray(distance).reshape(height, width)
+        attenuation_parameters = np.asarray(attenuation_parameters)
+        gains = np.asarray(gains)
+    else:
+        distance = np.zeros((1, 1))
+        attenuation_parameters = np.zeros((1, 1, 1, 3), dtype=np.float32)
+        gains = np.zeros((1, 1, 1))
+    kernel_args = (
+        image,
+        attenuate,
+        distance,
+        attenuation_parameters,
+        gains,
+        gain_map,
+        np.asarray(mean, dtype=np.float32).reshape(height, width, channels),
+        np.asarray(std, dtype=np.float32).reshape(height, width, channels),
+        np.float32(brightness / 100.0),
+        np.float32(contrast / 100.0),
+        image_type == "rgb",
+    )
+    kernel = _colour_correct_kernel if parallel else _colour_correct_kernel_serial
+
+    if is_bayer:
+        image16 = np.empty((height, width, 1), dtype=np.uint16)
+        kernel(
+            *kernel_args, False, gamma_lut(False), False, np.float32(2**16 - 1), image16
+        )
+        image_rgb = debayer_uint16(image16[:, :, 0], image_type)
+        scale = 2 ** (-16)
+    elif camera_params_file_path is not None:
+        image_rgb = np.empty(image.shape, dtype=np.float32)
+        kernel(
+            *kernel_args, False, gamma_lut(False), False, np.float32(1), image_rgb
+        )
+        scale = 1.0
+    else:
+        out = np.empty(image.shape, dtype=np.uint8)
+        row_max = kernel(
+            *kernel_args, True, gamma_lut(False), False, np.float32(1), out
+        )
+        if row_max.max() < GAMMA_LINEAR_THRESHOLD:
+            # As gamma_correct, use the linear segment if all values are in it
+            kernel(
+                *kernel_args, True, gamma_lut(True), True, np.float32(1), out
+            )
+        return out.reshape(height, width) if channels == 1 else out
+
+    if camera_params_file_path is not None:
+        map_x, map_y = rectification_maps(
+            camera_params_file_path, undistort_fixed_point
+        )
+        image_rgb = image_rgb.astype(np.float32) * np.float32(scale)
+        image_rgb = cv2.remap(image_rgb, map_x, map_y, cv2.INTER_LINEAR)
+        scale = 1.0
+    out = _gamma_uint8(image_rgb, scale, parallel)
+    return out.reshape(height, width) if out.shape[2] == 1 else out
+
+
+@lru_cache(maxsize=1)
+def uint16_to_uint8_lut():
+    """Get the 8-bit output of each 16-bit intensity, in units of 2**-16, as
+    the conversion to 8 bits of process. Each entry is the output at the top
+    of its interval, so that the clipped maximum gives 255"""
+    return (((np.arange(2**16, dtype=np.uint32) + 1) * 255) >> 16).astype(np.uint8)
+
+
+@njit(parallel=True)
+def _manual_balance_kernel(
+    image, gains, subtractors, swap_channels, to_uint8, lut, out
+):
+    height, width, channels = image.shape
+    for i in prange(height):
+        for j in range(width):
+            for k in range(channels):
+                value = np.int64(0)
+                for m in range(channels):
+                    m_in = channels - 1 - m if swap_channels else m
+                    intensity = np.int64(image[i, j, m_in]) << INTENSITY_FRACTION_BITS
+                    value += gains[k, m] * (intensity - subtractors[m])
+                # Truncate to 16 bits, as the conversion to 8 bits
+                value = value >> (GAIN_FRACTION_BITS + INTENSITY_FRACTION_BITS)
+                if value < 0:
+                    value = 0
+                elif value > 65535:
+                    value = 65535
+                if to_uint8:
+                    out[i, j, k] = lut[value]
+                else:
+                    out[i, j, k] = value
+
+
+_manual_balance_kernel_serial = njit(_manual_balance_kernel.py_func)
+
+
+def manual_balance_uint16(
+    image,
+    gain_matrix_rgb,
+    subtractors_rgb,
+    image_type,
+    camera_params_file_path=None,
+    undistort_fixed_point=False,
+    parallel=True,
+):
+    """Apply the manual balance of process to a 16-bit image with integer
+    operations only
+
+    This is equivalent to applying debayer or the channel swap,
+    manual_balance, distortion_correct (if camera_params_file_path is not
+    None) and the conversion to 8 bits in sequence, but the image stays in
+    uint16 throughout: it is debayered as is, balanced with fixed-point gains
+    and subtractors, and converted to 8 bits with a lookup table. Results can
+    differ from the float corrections by one intensity level.
+
+    Parameters
+    -----------
+    image : numpy.ndarray
+        uint16 image data, with intensities in units of 2**-16, as returned
+        by Loader.load_uint16
+    gain_matrix_rgb : numpy.ndarray
+        3x3 matrix with the colour gains
+    subtractors_rgb : numpy.ndarray
+        3x1 vector with the colour subtractors, in units of 1
+    image_type : str
+        grayscale, rgb, bgr or the bayer pattern of the image
+    camera_params_file_path : Path
+        camera parameters file to correct the distortion, or None
+    undistort_fixed_point : bool
+        use fixed-point remap tables to correct the distortion
+    parallel : bool
+        split the image between threads
+
+    Returns
+    -------
+    numpy.ndarray
+        Corrected 8-bit image
+    """
+    height, width = image.shape[0], image.shape[1]
+    if image_type not in ["grayscale", "rgb", "bgr"]:
+        image = debayer_uint16(image.reshape(height, width), image_type)
+    image = image.reshape(height, width, -1)
+    channels = image.shape[2]
+    gains = np.rint(
+        np.asarray(gain_matrix_rgb, dtype=np.float64)[:channels, :channels]
+        * 2**GAIN_FRACTION_BITS
+    ).astype(np.int64)
+    # Subtractors in the units of the image, with extra fractional bits
+    subtractors = np.rint(
+        np.asarray(subtractors_rgb, dtype=np.float64)[:channels]
+        * 2 ** (16 + INTENSITY_FRACTION_BITS)
+    ).astype(np.int64)
+    kernel_args = (image, gains, subtractors, image_type == "rgb")
+    lut = uint16_to_uint8_lut()
+    kernel = _manual_balance_kernel if parallel else _manual_balance_kernel_serial
+
+    if camera_params_file_path is None:
+        out = np.empty(image.shape, dtype=np.uint8)
+        kernel(*kernel_args, True, lut, out)
+    else:
+        balanced = np.empty(image.shape, dtype=np.uint16)
+        kernel(*kernel_args, False, lut, balanced)
+        map_x, map_y = rectification_maps(
+            camera_params_file_path, undistort_fixed_point
+        )
+        balanced = cv2.remap(balanced, map_x, map_y, cv2.INTER_LINEAR)
+        out = lut[balanced]
+    return out.reshape(height, width) if channels == 1 else out
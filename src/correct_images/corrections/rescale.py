@@ -11,16 +11,43 @@ from pathlib import Path
 
 try:
     # Try using the v2 API directly to avoid a warning from imageio >= 2.16.2
-    from imageio.v2 import imwrite, imread
+    from imageio.v2 import imread, imwrite
 except ImportError:
-    from imageio import imwrite, imread
+    from imageio import imread, imwrite
+
+import cv2
+import joblib
 import numpy as np
 import pandas as pd
 from PIL import Image
-from tqdm import trange
+from tqdm import tqdm
 
+from correct_images.tools.image_index import path_stems
+from correct_images.tools.joblib_tqdm import tqdm_joblib
 from oplab import Console, MonoCamera, get_processed_folder
 
+# PIL and OpenCV interpolation flags for each interpolation method
+INTERPOLATION_METHODS = {
+    "bicubic": (Image.BICUBIC, cv2.INTER_CUBIC),
+    "bilinear": (Image.BILINEAR, cv2.INTER_LINEAR),
+    "nearest_neighbour": (Image.NEAREST, cv2.INTER_NEAREST),
+    "lanczos": (Image.LANCZOS, cv2.INTER_LANCZOS4),
+}
+RESCALE_BACKENDS = ["pil", "opencv"]
+
+
+def _resize(image, size, method, backend):
+    if backend == "opencv":
+        return cv2.resize(image, size, interpolation=method)
+    return image.resize(size, resample=method)
+
+
+def _crop(image, box, backend):
+    if backend == "opencv":
+        left, upper, right, lower = box
+        return image[upper:lower, left:right]
+    return image.crop(box)
+
 
 def rescale(
     image_array: np.ndarray,
@@ -30,6 +57,7 @@ def rescale(
     f_x: float,
     f_y: float,
     maintain_pixels: bool,
+    backend: str = "pil",
 ) -> np.ndarray:
     image_shape = image_array.shape
     image_height = image_shape[0]
@@ -39,16 +67,7 @@ def rescale(
     vertical_rescale = pixel_height / target_pixel_size_m
     horizontal_rescale = pixel_width / target_pixel_size_m
 
-    method = None
-    if interpolate_method == "bicubic":
-        method = Image.BICUBIC
-    elif interpolate_method == "bilinear":
-        method = Image.BILINEAR
-    elif interpolate_method == "nearest_neighbour":
-        method = Image.NEAREST
-    elif interpolate_method == "lanczos":
-        method = Image.LANCZOS
-    else:
+    if interpolate_method not in INTERPOLATION_METHODS:
         Console.error("The requested rescaling method is not implemented.")
         Console.error("Valid methods are: ")
         Console.error("  * bicubic")
@@ -56,8 +75,16 @@ def rescale(
         Console.error("  * nearest_neighbour")
         Console.error("  * lanczos")
         Console.quit("Rescaling method not implemented.")
+    if backend not in RESCALE_BACKENDS:
+        Console.quit(
+            "Rescaling backend", backend, "not implemented. Use", RESCALE_BACKENDS
+        )
+    method = INTERPOLATION_METHODS[interpolate_method][RESCALE_BACKENDS.index(backend)]
 
-    image_rgb = Image.fromarray(image_array, "RGB")
+    if backend == "opencv":
+        image_rgb = np.ascontiguousarray(image_array)
+    else:
+        image_rgb = Image.fromarray(image_array, "RGB")
 
     if maintain_pixels:
         if vertical_rescale < 1 or horizontal_rescale < 1:
@@ -65,9 +92,9 @@ def rescale(
                 int(image_width * horizontal_rescale),
                 int(image_height * vertical_rescale),
             )
-            image_rgb = image_rgb.resize(size, resample=method)
+            image_rgb = _resize(image_rgb, size, method, backend)
             size = (image_width, image_height)
-            image_rgb = image_rgb.resize(size, resample=method)
+            image_rgb = _resize(image_rgb, size, method, backend)
         else:
             crop_width = int((1 / horizontal_rescale) * image_width)
             crop_height = int((1 / vertical_rescale) * image_height)
@@ -80,22 +107,92 @@ def rescale(
 
             # crop the image to the center
             box = (box_left, box_upper, box_right, box_lower)
-            cropped_image = image_rgb.crop(box)
+            cropped_image = _crop(image_rgb, box, backend)
 
             # resize the cropped image to the size of original image
             size = (image_width, image_height)
-            image_rgb = cropped_image.resize(size, resample=method)
+            image_rgb = _resize(cropped_image, size, method, backend)
     else:
         size = (
             int(image_width * horizontal_rescale),
             int(image_height * vertical_rescale),
         )
-        image_rgb = image_rgb.resize(size, resample=method)
+        image_rgb = _resize(image_rgb, size, method, backend)
 
     image = np.array(image_rgb, dtype=np.uint8)
     return image
 
 
+def write_rescaled_image(image_path, image, output_format=None, compression=None):
+    """Write a rescaled image
+
+    Parameters
+    ----------
+    image_path : Path
+        Output image path, with the extension of the source image
+    image : numpy.ndarray
+        RGB image
+    output_format : str
+        png, jpg or tif to write the image with OpenCV in that format, or None
+        to write it as PNG keeping the source image name
+    compression : int
+        PNG compression level (0-9), JPEG quality (0-100) or TIFF compression
+        scheme (e.g. 1 for none, 5 for LZW). None uses the default of the format
+
+    Returns
+    -------
+    Path
+        Path to the written image
+    """
+    if output_format is None:
+        imwrite(image_path, image, format="PNG-FI")
+        return image_path
+    image_path = Path(image_path).with_suffix("." + output_format)
+    params = []
+    if compression is not None:
+        flag = {
+            "png": cv2.IMWRITE_PNG_COMPRESSION,
+            "jpg": cv2.IMWRITE_JPEG_QUALITY,
+            "tif": cv2.IMWRITE_TIFF_COMPRESSION,
+        }[output_format]
+        params = [flag, int(compression)]
+    if image.ndim == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
+    if not cv2.imwrite(str(image_path), image, params):
+        Console.quit("Could not write image", image_path)
+    return image_path
+
+
+def rescale_image(
+    source_image_path,
+    output_image_path,
+    interpolate_method,
+    target_pixel_size_m,
+    altitude,
+    f_x,
+    f_y,
+    maintain_pixels,
+    backend="pil",
+    output_format=None,
+    compression=None,
+):
+    """Read, rescale and write an image. See rescale for the parameters"""
+    image = imread(source_image_path).astype("uint8")
+    rescaled_image = rescale(
+        image,
+        interpolate_method,
+        target_pixel_size_m,
+        altitude,
+        f_x,
+        f_y,
+        maintain_pixels,
+        backend,
+    )
+    return write_rescaled_image(
+        output_image_path, rescaled_image, output_format, compression
+    )
+
+
 def rescale_images(
     imagenames_list,
     image_directory,
@@ -106,35 +203,44 @@ def rescale_images(
     f_x,
     f_y,
     maintain_pixels,
+    backend="pil",
+    output_format=None,
+    compression=None,
+    num_workers=-2,
 ):
     Console.info("Rescaling images...")
 
-    for idx in trange(len(imagenames_list)):
-        image_name = imagenames_list[idx]
-        source_image_path = Path(image_directory) / image_name
-        output_image_path = Path(output_directory) / image_name
-        image_path_list = dataframe["relative_path"]
-        trimmed_path_list = [
-            path for path in image_path_list if Path(path).stem in image_name
-        ]
-        trimmed_dataframe = dataframe.loc[
-            dataframe["relative_path"].isin(trimmed_path_list)
-        ]
-        altitude = trimmed_dataframe["altitude [m]"]
-        if len(altitude) > 0:
-            image = imread(source_image_path).astype("uint8")
-            rescaled_image = rescale(
-                image,
+    if output_format not in [None, "png", "jpg", "tif"]:
+        Console.quit("Rescale output format", output_format, "not supported")
+
+    # Altitude of each image, looked up by filename stem
+    altitudes = dict(
+        zip(path_stems(dataframe["relative_path"]), dataframe["altitude [m]"])
+    )
+    tasks = []
+    for image_name in imagenames_list:
+        altitude = altitudes.get(Path(image_name).stem)
+        if altitude is None:
+            Console.warn("Did not get distance values for image: " + image_name)
+            continue
+        tasks.append(
+            joblib.delayed(rescale_image)(
+                Path(image_directory) / image_name,
+                Path(output_directory) / image_name,
                 interpolate_method,
                 target_pixel_size_m,
-                altitude,
+                float(altitude),
                 f_x,
                 f_y,
                 maintain_pixels,
+                backend,
+                output_format,
+                compression,
             )
-            imwrite(output_image_path, rescaled_image, format="PNG-FI")
-        else:
-            Console.warn("Did not get distance values for image: " + image_name)
+        )
+
+    with tqdm_joblib(tqdm(desc="Rescaling images", total=len(tasks))):
+        joblib.Parallel(n_jobs=num_workers, verbose=0)(tasks)
 
 
 def rescale_camera(path, camera_system, camera):
@@ -204,5 +310,9 @@ def rescale_camera(path, camera_system, camera):
         focal_length_x,
         focal_length_y,
         maintain_pixels,
+        camera.backend,
+        camera.output_format,
+        camera.compression,
+        camera.num_workers,
     )
     return True
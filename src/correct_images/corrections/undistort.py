@@ -6,13 +6,52 @@ Licensed under the BSD 3-Clause License.
 See LICENSE.md file in the project root for full license information.
 """
 
+from functools import lru_cache
+from pathlib import Path
+
 import cv2
 
 from oplab import MonoCamera
 
 
+@lru_cache(maxsize=8)
+def _cached_rectification_maps(camera_params_file_path, mtime_ns, fixed_point):
+    # mtime_ns is only part of the cache key, so that an edited calibration
+    # file is read again
+    monocam = MonoCamera(camera_params_file_path)
+    map_x, map_y = monocam.rectification_maps
+    if fixed_point:
+        map_x, map_y = cv2.convertMaps(map_x, map_y, cv2.CV_16SC2)
+    return map_x, map_y
+
+
+def rectification_maps(camera_params_file_path, fixed_point=False):
+    """Get the undistortion remap tables for a camera calibration file
+
+    The tables are computed once per process for each calibration file and
+    reused until the file is modified.
+
+    Parameters
+    -----------
+    camera_params_file_path: str
+        Path to the camera parameters file
+    fixed_point : bool
+        Return CV_16SC2 fixed-point maps instead of CV_32FC1 maps. These are
+        faster to remap with, at the cost of 1/32 pixel interpolation accuracy
+
+    Returns
+    -------
+    tuple
+        map_x, map_y to be used with cv2.remap
+    """
+    path = Path(camera_params_file_path).resolve()
+    return _cached_rectification_maps(
+        str(path), path.stat().st_mtime_ns, bool(fixed_point)
+    )
+
+
 # correct image for distortions using camera calibration parameters
-def distortion_correct(camera_params_file_path, image):
+def distortion_correct(camera_params_file_path, image, fixed_point=False):
     """Perform distortion correction for images
 
     Parameters
@@ -21,8 +60,8 @@ def distortion_correct(camera_params_file_path, image):
         Path to the camera parameters file
     image : numpy.ndarray
         image data to be corrected for distortion
-    dst_bit : int
-        target bitdepth for output image
+    fixed_point : bool
+        Use fixed-point (CV_16SC2) remap tables
 
     Returns
     -------
@@ -30,8 +69,7 @@ def distortion_correct(camera_params_file_path, image):
         Image
     """
 
-    monocam = MonoCamera(camera_params_file_path)
-    map_x, map_y = monocam.rectification_maps
+    map_x, map_y = rectification_maps(camera_params_file_path, fixed_point)
     # ret_image = np.clip(image, 0, 2 ** dst_bit - 1)
     ret_image = cv2.remap(image, map_x, map_y, cv2.INTER_LINEAR)
     return ret_image
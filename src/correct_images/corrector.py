@@ -7,8 +7,10 @@ See LICENSE.md file in the project root for full license information.
 """
 
 import copy
+import hashlib
 import os
 import random
+import tempfile
 from pathlib import Path
 
 try:
@@ -17,27 +19,63 @@ try:
 except ImportError:
     from imageio import imwrite
 
-import joblib
 import matplotlib
 import numpy as np
 import pandas as pd
-from matplotlib import pyplot as plt
-from tqdm import tqdm, trange
+from joblib.externals.loky import get_reusable_executor
 
 # fmt: off
 from auv_nav.tools.time_conversions import read_timezone
 from correct_images import corrections
 from correct_images.loaders import depth_map, loader
-from correct_images.tools.file_handlers import trim_csv_files, write_output_image
-from correct_images.tools.joblib_tqdm import tqdm_joblib
-from correct_images.tools.memmap import create_memmap, open_memmap
+from correct_images.loaders.rosbag import BagIndex
+from correct_images.tools.bin_statistics import (
+    BIN_STATISTICS_FILENAME,
+    BinStatistics,
+    compute_bin_statistics,
+    compute_corrected_statistics,
+    corrected_statistics_from_bins,
+)
+from correct_images.tools.diagnostics import Diagnostics
+from correct_images.tools.file_handlers import (
+    encode_output_image,
+    trim_csv_files,
+    write_output_image,
+)
+from correct_images.tools.image_index import build_image_index, merge_filelist
+from correct_images.tools.manifest import Manifest
+from correct_images.tools.memmap import (
+    MemmapImageLoader,
+    ScratchSpace,
+    create_memmap,
+    open_memmap,
+    storage_scale,
+)
 from correct_images.tools.numerical import (
-    RunningMeanStd,
     image_mean_std_trimmed,
     median_array,
+    pixel_histogram,
     ransac_mean_std,
     running_mean_std,
 )
+from correct_images.tools.parse_cache import PARSE_KEY_FILENAME, ParseCache, inputs_key
+from correct_images.tools.pipeline import run_pipeline
+from correct_images.tools.scheduler import (
+    HISTOGRAM_SMOOTHING,
+    MAX_BIN_SIZE_GB,
+    MAX_HISTOGRAM_IMAGES,
+    MEMMAP_SMOOTHING,
+    Task,
+    available_memory,
+    available_scratch,
+    cpu_workers,
+    estimate_bin_footprint,
+    max_bin_images,
+    run_now,
+    run_scheduled,
+    shared_resources,
+)
+from correct_images.tools.shards import ShardWriter
 from oplab import (
     Console,
     Mission,
@@ -66,6 +104,101 @@ def try_remove(filename, verbose=False):
             pass
 
 
+# Correction parameters published to the worker processes as read-only memmaps
+SHARED_PARAMETERS = [
+    "image_attenuation_parameters",
+    "correction_gains",
+    "image_corrected_mean",
+    "image_corrected_std",
+    "image_raw_mean",
+    "image_raw_std",
+]
+
+# Images corrected per worker between two updates of the number of workers
+CORRECTION_ROUND_IMAGES = 32
+
+# Corrector of each worker process, set once by init_correction_worker
+_worker_corrector = None
+
+
+def init_correction_worker(corrector, shared_parameters):
+    """Set the Corrector of a worker process, and open the correction
+    parameters as read-only memmaps
+
+    Parameters
+    ----------
+    corrector : Corrector
+        Corrector without the shared parameters
+    shared_parameters : dict
+        Path to the .npy file of each shared parameter
+    """
+    global _worker_corrector
+    for name, path in shared_parameters.items():
+        setattr(corrector, name, np.load(path, mmap_mode="r"))
+    corrector.create_gain_map_cache()
+    _worker_corrector = corrector
+
+
+def correct_image_in_worker(idx):
+    """Read and correct an image in a worker process"""
+    return _worker_corrector.correct_image(idx, _worker_corrector.read_image(idx))
+
+
+# Arguments of compute_distance_bin shared by all the bins of a worker process
+_worker_distance_bin_args = None
+
+
+def init_distance_bin_worker(corrector, images_map, distances_map, bin_args):
+    """Set the Corrector of a worker process computing altitude bins, and
+    open the memmaps the bins are written to
+
+    Parameters
+    ----------
+    corrector : Corrector
+        Corrector
+    images_map : tuple
+        Filename and shape of the memmap of bin images
+    distances_map : tuple
+        Filename and shape of the memmap of bin distances
+    bin_args : tuple
+        idxs, max_bin_size, max_bin_size_gb and distance_vector arguments of
+        compute_distance_bin, and optionally the filename, shape and dtype of
+        the image cache and the rows of each bin in it
+    """
+    global _worker_corrector, _worker_distance_bin_args
+    _worker_corrector = corrector
+    idxs, max_bin_size, max_bin_size_gb, distance_vector, *cache_args = bin_args
+    image_cache = None
+    bin_rows = None
+    if cache_args:
+        (cache_fn, cache_shape, cache_dtype), bin_rows = cache_args
+        image_cache = np.memmap(
+            cache_fn, dtype=cache_dtype, mode="r", shape=cache_shape
+        )
+    _worker_distance_bin_args = (
+        idxs,
+        np.memmap(images_map[0], dtype=np.float32, mode="r+", shape=images_map[1]),
+        np.memmap(
+            distances_map[0], dtype=np.float32, mode="r+", shape=distances_map[1]
+        ),
+        max_bin_size,
+        max_bin_size_gb,
+        distance_vector,
+        image_cache,
+        bin_rows,
+    )
+
+
+def compute_distance_bin_in_worker(idx_bin):
+    """Compute an altitude bin in a worker process"""
+    idxs, images_map, distances_map, *args = _worker_distance_bin_args
+    _worker_corrector.compute_distance_bin(
+        idxs, idx_bin, images_map, distances_map, *args
+    )
+    images_map.flush()
+    distances_map.flush()
+
+
 # -----------------------------------------
 def copy_file_if_exists(original_file: Path, dest_dir: Path):
     """Copy a file if it exists.
@@ -93,6 +226,7 @@ class Corrector:
         camera=None,
         correct_config=None,
         path=None,
+        resume=False,
     ):
         """Constructor for the Corrector class
 
@@ -109,6 +243,9 @@ class Corrector:
             parameters
         path : Path
             path to the dive folder where image directory is present
+        resume : bool
+            in process, keep the images corrected by a previous run with the
+            same configuration and only correct the missing or outdated ones
         """
 
         self.camera = camera
@@ -117,6 +254,7 @@ class Corrector:
         self.processed_image_list = []
         self.altitude_list = []
         self.depth_map_list = []
+        self.depth_map_means = None
 
         # Members for folder paths
         self.output_dir_path = None
@@ -134,17 +272,24 @@ class Corrector:
         self.image_corrected_std = None
         self.image_raw_mean = None
         self.image_raw_std = None
+        self.gain_map_cache = None
+        self.integer_pipeline = False
+        self.manifest = None
+        self.config_hash = None
+        self.shard_writer = None
 
         # From get image list
         self.altitude_csv_path = None
         self.trimmed_csv_path = None
         self.camera_params_file_path = None
 
-        self.memmaps_to_remove = []
+        # Folder of the memmaps of parse, set by load_configuration
+        self.scratch = None
 
         assert mode in ["parse", "process"]
         self.mode = mode
         self.force = force
+        self.resume = resume
 
         # if path is None then user must define it externally and call set_path
         if path is not None:
@@ -158,9 +303,9 @@ class Corrector:
             self.load_configuration(self.correct_config)
 
     def cleanup(self):
-        Console.info("Check if any memmaps have not been deleted yet, and delete if so")
-        for fn in self.memmaps_to_remove:
-            try_remove(fn, verbose=True)
+        if self.scratch is not None:
+            Console.info("Removing the memmaps that have not been deleted yet")
+            self.scratch.close()
 
     def set_path(self, path):
         """Set the path for the corrector"""
@@ -216,9 +361,62 @@ class Corrector:
         )
         self.smoothing = self.correct_config.color_correction.smoothing
         self.window_size = self.correct_config.color_correction.window_size
+        self.fitting_method = self.correct_config.color_correction.fitting_method
+        self.fitting_stride = self.correct_config.color_correction.fitting_stride
+        self.fitting_upsampling = (
+            self.correct_config.color_correction.fitting_upsampling
+        )
+        self.fitting_validation_pixels = (
+            self.correct_config.color_correction.fitting_validation_pixels
+        )
+        self.single_pass = self.correct_config.color_correction.single_pass
+        self.histogram_bins = self.correct_config.color_correction.histogram_bins
+        self.fused_kernel = self.correct_config.color_correction.fused_kernel
+        self.gain_cache_step = self.correct_config.color_correction.gain_cache_step
+        self.gain_cache_size = self.correct_config.color_correction.gain_cache_size
+        self.depth_map_store = self.correct_config.color_correction.depth_map_store
+        self.depth_map_dtype = self.correct_config.color_correction.depth_map_dtype
+        self.memory_budget = self.correct_config.color_correction.memory_budget
+        self.scratch_budget = self.correct_config.color_correction.scratch_budget
+        self.scratch_root = self.correct_config.color_correction.scratch_root
+        self.scratch_dtype = self.correct_config.color_correction.scratch_dtype
+        if self.scratch is None:
+            self.scratch = ScratchSpace(
+                self.scratch_root,
+                (
+                    self.scratch_budget * 1024**3
+                    if self.scratch_budget is not None
+                    else None
+                ),
+                self.scratch_dtype,
+            )
+        self.store_bin_statistics = (
+            self.correct_config.color_correction.store_bin_statistics
+        )
+        self.cache_images = self.correct_config.color_correction.cache_images
+        self.diagnostics_mode = self.correct_config.color_correction.diagnostics
+        self.diagnostics_figures = (
+            self.correct_config.color_correction.diagnostics_figures
+        )
+        self.diagnostics_dpi = self.correct_config.color_correction.diagnostics_dpi
         self.cameraconfigs = self.correct_config.configs.camera_configs
         self.undistort = self.correct_config.output_settings.undistort_flag
+        self.undistort_fixed_point = (
+            self.correct_config.output_settings.undistort_fixed_point
+        )
         self.output_format = self.correct_config.output_settings.compression_parameter
+        self.read_workers = self.correct_config.output_settings.read_workers
+        self.compute_workers = (
+            self.correct_config.output_settings.compute_workers or cpu_workers()
+        )
+        self.write_workers = self.correct_config.output_settings.write_workers
+        self.queue_size = (
+            self.correct_config.output_settings.queue_size or 2 * self.compute_workers
+        )
+        self.fsync = self.correct_config.output_settings.fsync
+        self.compute_backend = self.correct_config.output_settings.compute_backend
+        self.shard_format = self.correct_config.output_settings.shard_format
+        self.shard_size = self.correct_config.output_settings.shard_size
 
         # Load camera parameters
         cam_idx = self.get_camera_idx()
@@ -248,6 +446,7 @@ class Corrector:
             self.color_gain_matrix_rgb = np.array(
                 self.cameraconfigs[cam_idx].color_gain_matrix_rgb
             )
+            self.integer_pipeline = self.cameraconfigs[cam_idx].integer_pipeline
 
         # Create output directories and needed attributes
         self.create_output_directories()
@@ -264,6 +463,7 @@ class Corrector:
             self.corrected_std_filepath = p / "image_corrected_std.npy"
             self.raw_mean_filepath = p / "image_raw_mean.npy"
             self.raw_std_filepath = p / "image_raw_std.npy"
+            self.bin_statistics_filepath = p / BIN_STATISTICS_FILENAME
 
         # Define image loader
         # Use default loader
@@ -320,7 +520,39 @@ class Corrector:
 
         if self.correction_method == "colour_correction":
             self.get_altitude_and_depth_maps()
-            self.generate_attenuation_correction_parameters()
+            parse_cache = ParseCache(
+                self.attenuation_parameters_folder,
+                [p.name for p in self.parse_output_filepaths()],
+            )
+            record = parse_cache.record(
+                self.parse_settings(),
+                inputs_key(
+                    self.camera_image_list,
+                    self.altitude_list,
+                    self.depth_map_list,
+                    self.camera.bagfile_list,
+                ),
+            )
+            # Force regenerates the parameters even if they are cached
+            if not self.force and parse_cache.restore(record):
+                Console.info(
+                    "Correction parameters are up to date with the images,",
+                    "navigation and configuration. Skipping parse.",
+                )
+            else:
+                if self.parameters_exist:
+                    if not self.force:
+                        Console.quit(
+                            "Parameters exist for current configuration.",
+                            "Run parse with Force (-F flag)...",
+                        )
+                    Console.warn(
+                        "Code will overwrite existing parameters for",
+                        "current configuration...",
+                    )
+                parse_cache.clear()
+                self.generate_attenuation_correction_parameters()
+                parse_cache.store(record)
 
             for i in range(len(path_list)):  # for each dive
                 path = get_processed_folder(path_list[i])
@@ -336,6 +568,7 @@ class Corrector:
                 copy_file_if_exists(self.corrected_std_filepath, dest_dir)
                 copy_file_if_exists(self.raw_mean_filepath, dest_dir)
                 copy_file_if_exists(self.raw_std_filepath, dest_dir)
+                copy_file_if_exists(attn_dir / PARSE_KEY_FILENAME, dest_dir)
         elif self.correction_method == "manual_balance":
             Console.info("run process for manual_balance")
 
@@ -405,11 +638,85 @@ class Corrector:
                     "Please run parse before process...",
                 )
             Console.info("Correction parameters loaded")
+            self.check_parse_settings()
             Console.info("Running process for colour correction...")
         else:
             Console.info("Running process with manual colour balancing...")
         self.process_correction()
 
+    def parse_output_filepaths(self):
+        """Files written by parse for the colour correction"""
+        return [
+            self.attenuation_params_filepath,
+            self.correction_gains_filepath,
+            self.corrected_mean_filepath,
+            self.corrected_std_filepath,
+            self.raw_mean_filepath,
+            self.raw_std_filepath,
+            self.images_map_filepath,
+            self.distances_map_filepath,
+            self.bin_statistics_filepath,
+        ]
+
+    def parse_settings(self):
+        """Configuration that determines the correction parameters of parse"""
+        return {
+            "camera_name": self.camera_name,
+            "correction_method": self.correction_method,
+            "distance_metric": self.distance_metric,
+            "parse_altitude_min": self.parse_altitude_min,
+            "parse_altitude_max": self.parse_altitude_max,
+            "smoothing": self.smoothing,
+            "window_size": self.window_size,
+            "fitting_method": self.fitting_method,
+            "fitting_stride": self.fitting_stride,
+            "fitting_upsampling": self.fitting_upsampling,
+            "single_pass": self.single_pass,
+            "histogram_bins": self.histogram_bins,
+            "depth_map_dtype": self.depth_map_dtype,
+            "bit_depth": self.loader.bit_depth,
+            # The bins of these smoothing methods are stored at this precision
+            "scratch_dtype": self.scratch_dtype
+            if self.smoothing in ["median", "mean_trimmed"]
+            else None,
+        }
+
+    def check_parse_settings(self):
+        """Check that the correction parameters were computed by parse with
+        the settings of the current configuration"""
+        record = ParseCache(self.attenuation_parameters_folder).read()
+        if record is None:
+            Console.warn(
+                "No",
+                PARSE_KEY_FILENAME,
+                "found with the correction parameters. They cannot be checked",
+                "against the current configuration.",
+            )
+            return
+        settings = ParseCache.record(self.parse_settings(), "")["settings"]
+        changed = [
+            key
+            for key in sorted(set(settings) | set(record["settings"]))
+            if settings.get(key) != record["settings"].get(key)
+        ]
+        if changed:
+            for key in changed:
+                Console.warn(
+                    "  ",
+                    key,
+                    ": parse used",
+                    record["settings"].get(key),
+                    "but the configuration is",
+                    settings.get(key),
+                )
+            if not self.force:
+                Console.quit(
+                    "The correction parameters were computed with other settings.",
+                    "Run parse again, or process with Force (-F flag) to use them",
+                    "anyway.",
+                )
+            Console.warn("Using correction parameters computed with other settings")
+
     # create directories for storing intermediate image and distance_matrix
     # numpy files, correction parameters and corrected output images
     def create_output_directories(self):
@@ -455,21 +762,14 @@ class Corrector:
         self.output_images_folder = self.output_dir_path / developed_folder_str
 
         if self.mode == "parse":
+            # Existing parameters are checked against the parse cache once
+            # the images and navigation are read
+            self.parameters_exist = False
             if not self.attenuation_parameters_folder.exists():
                 self.attenuation_parameters_folder.mkdir(parents=True)
             else:
                 file_list = list(self.attenuation_parameters_folder.glob("*.npy"))
-                if len(file_list) > 0:
-                    if not self.force:
-                        Console.quit(
-                            "Parameters exist for current configuration.",
-                            "Run parse with Force (-F flag)...",
-                        )
-                    else:
-                        Console.warn(
-                            "Code will overwrite existing parameters for",
-                            "current configuration...",
-                        )
+                self.parameters_exist = len(file_list) > 0
 
         if self.mode == "process":
             if not self.output_images_folder.exists():
@@ -477,7 +777,12 @@ class Corrector:
             else:
                 file_list = list(self.output_images_folder.glob("*.*"))
                 if len(file_list) > 0:
-                    if not self.force:
+                    if self.resume:
+                        Console.info(
+                            "Resuming process in the existing folder of corrected",
+                            "images...",
+                        )
+                    elif not self.force:
                         Console.quit(
                             "Corrected images exist for current configuration.",
                             "Run process with Force (-F flag)...",
@@ -537,6 +842,13 @@ class Corrector:
                 self.loader.set_bagfile_list_and_topic(
                     self.camera.bagfile_list, self.camera.topic
                 )
+                # Index the images once, so that each one is read directly
+                # from the bagfile that holds it
+                self.loader.bag_index = BagIndex.load_or_build(
+                    self.path_processed / ("bag_index_" + self.camera_name + ".csv"),
+                    self.camera.bagfile_list,
+                    self.camera.topic,
+                )
 
             if self.distance_path == "json_renav_*":
                 Console.info(
@@ -590,43 +902,26 @@ class Corrector:
                         self.trimmed_csv_path,
                     )
 
-            # Check images exist:
-            valid_idx = []
             if "relative_path" not in dataframe:
                 Console.error("CSV FILE:", self.altitude_csv_path)
                 Console.quit(
                     "Your CSV navigation file does not have a relative_path column"
                 )
-            for idx, entry in enumerate(dataframe["relative_path"]):
-                if self.camera.extension == "bag":
-                    valid_idx.append(idx)
-                else:
-                    im_path = self.path_raw / entry
-                    if im_path.exists():
-                        valid_idx.append(idx)
-            filtered_dataframe = dataframe.iloc[valid_idx]
-            filtered_dataframe.reset_index(drop=True)
-            # WARNING: if the column does not contain any 'None' entry, it will be
-            # parsed as float, and the .str() accesor will fail
-            filtered_dataframe["altitude [m]"] = filtered_dataframe[
-                "altitude [m]"
-            ].astype(str)
-            filtered_dataframe = filtered_dataframe[
-                ~filtered_dataframe["altitude [m]"].str.contains("None")
-            ]  # drop rows with None altitude
-            distance_list = filtered_dataframe["altitude [m]"].tolist()
-            for _, row in filtered_dataframe.iterrows():
-                alt = float(row["altitude [m]"])
-                if alt > altitude_min and alt < altitude_max:
-                    if self.camera.extension == "bag":
-                        self.camera_image_list.append(row["timestamp [s]"])
-                    else:
-                        self.camera_image_list.append(
-                            self.path_raw / row["relative_path"]
-                        )
-                    self.altitude_list.append(alt)
+            # Images in bagfiles are not checked for existence
+            image_index, num_images = build_image_index(
+                dataframe,
+                self.path_raw,
+                altitude_min,
+                altitude_max,
+                check_exists=self.camera.extension != "bag",
+            )
+            if self.camera.extension == "bag":
+                self.camera_image_list = image_index["timestamp [s]"].tolist()
+            else:
+                self.camera_image_list = [Path(p) for p in image_index["image_path"]]
+            self.altitude_list = image_index["altitude [m]"].tolist()
 
-            if len(distance_list) == 0:
+            if num_images == 0:
                 Console.error("No images exist / can be found!")
                 Console.error(
                     "Check the file",
@@ -643,7 +938,7 @@ class Corrector:
             Console.info(
                 len(self.altitude_list),
                 "of",
-                len(distance_list),
+                num_images,
                 "images remaining after applying altitude filter",
             )
         else:
@@ -702,6 +997,23 @@ class Corrector:
                     del self.camera_image_list[idx]
             assert(len(self.camera_image_list) == len(self.depth_map_list))
 
+            if self.depth_map_store:
+                store = depth_map.build_depth_map_store(
+                    self.depth_map_list,
+                    path_depth
+                    / "depth_map_store_{}_{}x{}_{}.npy".format(
+                        self.camera_name,
+                        self.image_width,
+                        self.image_height,
+                        self.depth_map_dtype,
+                    ),
+                    self.image_width,
+                    self.image_height,
+                    self.depth_map_dtype,
+                )
+                self.depth_map_means = store.means
+                self.depth_map_list = store.items()
+
             Console.info("Depth maps loaded")
             return
 
@@ -717,6 +1029,14 @@ class Corrector:
                 "Insufficient number of images to compute attenuation ",
                 "parameters...",
             )
+        # Figures are stored as data and rendered once the parameters are saved
+        self.diagnostics = Diagnostics(
+            self.attenuation_parameters_folder,
+            self.diagnostics_mode,
+            self.diagnostics_figures,
+            self.diagnostics_dpi,
+        )
+        self.diagnostics.reset()
 
         # create empty matrices to store image correction parameters
         self.image_raw_mean = np.empty(
@@ -751,8 +1071,43 @@ class Corrector:
             * 4.0
             / (1024.0**3)
         )
-        max_bin_size_gb = 50.0
-        max_bin_size = int(max_bin_size_gb / image_size_gb)
+        # Memory and scratch disk shared by the altitude bins computed at once
+        if self.memory_budget is not None:
+            memory_budget = self.memory_budget * 1024**3
+        else:
+            memory_budget = 0.8 * available_memory()
+        self.scratch.open()
+        if self.scratch_budget is not None:
+            scratch_budget = self.scratch_budget * 1024**3
+        else:
+            scratch_budget = 0.9 * available_scratch(self.scratch.root)
+        Console.info(
+            "Altitude bins can use {:.1f} GB of memory and {:.1f} GB of scratch".format(
+                memory_budget / 1024**3, scratch_budget / 1024**3
+            ),
+            "disk",
+        )
+        # Bins copied to a memmap are sampled to fit in the budgets on their
+        # own, and in MAX_BIN_SIZE_GB
+        max_bin_size = max(
+            min(
+                max_bin_images(
+                    memory_budget,
+                    scratch_budget,
+                    len(self.camera_image_list),
+                    self.image_height,
+                    self.image_width,
+                    self.image_channels,
+                    self.smoothing,
+                    self.histogram_bins,
+                    bool(self.depth_map_list),
+                    np.dtype(self.bin_storage_dtype()).itemsize,
+                ),
+                int(MAX_BIN_SIZE_GB / image_size_gb),
+            ),
+            10,
+        )
+        max_bin_size_gb = max_bin_size * image_size_gb
 
         self.bin_band = 0.1
         hist_bins = np.arange(
@@ -766,10 +1121,13 @@ class Corrector:
         if self.depth_map_list and self.distance_metric == "depth_map":
             Console.info("Computing depth map histogram with", hist_bins.size, "bins")
 
-            distance_vector = np.zeros((len(self.depth_map_list), 1))
-            for i, dm_file in enumerate(self.depth_map_list):
-                dm_np = depth_map.loader(dm_file, self.image_width, self.image_height)
-                distance_vector[i] = dm_np.mean()
+            if self.depth_map_means is not None:
+                distance_vector = self.depth_map_means.reshape(-1, 1)
+            else:
+                distance_vector = np.zeros((len(self.depth_map_list), 1))
+                for i, dm_file in enumerate(self.depth_map_list):
+                    dm_np = depth_map.loader(dm_file)
+                    distance_vector[i] = dm_np.mean()
 
         elif self.altitude_list and self.distance_metric == "altitude":
             Console.info("Computing altitude histogram with", hist_bins.size, "bins")
@@ -802,35 +1160,209 @@ class Corrector:
                     self.image_channels,
                 ),
                 dtype=np.float32,
+                scratch=self.scratch,
             )
-            self.memmaps_to_remove.append(images_fn)
 
             distances_fn, distances_map = open_memmap(
                 shape=(len(hist_bins) - 1, self.image_height * self.image_width),
                 dtype=np.float32,
+                scratch=self.scratch,
             )
-            self.memmaps_to_remove.append(distances_fn)
 
-            with tqdm_joblib(
-                tqdm(
-                    desc="Computing altitude histogram",
-                    total=hist_bins.size - 1,
+            # Read every image once, in list order, into its bin accumulator
+            use_single_pass = (
+                self.single_pass and self.distance_metric == "altitude"
+            )
+            if self.single_pass and not use_single_pass:
+                Console.warn(
+                    "single_pass is only available for the altitude distance",
+                    "metric. Images will be read again to compute the corrected",
+                    "mean and std.",
+                )
+            # The exact smoothing methods and the corrected mean and std read
+            # the images decoded by the same pass from a scratch memmap
+            cache_rows, bin_rows, cache_corrected = self.plan_image_cache(
+                idxs, hist_bins.size - 1, max_bin_size, use_single_pass
+            )
+            cache = None
+            cache_fn = None
+            if cache_rows is not None:
+                cache_shape = [int(cache_rows.max()) + 1, self.image_height]
+                cache_shape += [self.image_width, self.image_channels]
+                if self.image_channels == 1:
+                    cache_shape = cache_shape[:-1]
+                cache_dtype = np.dtype(self.bin_storage_dtype())
+                cache_nbytes = int(np.prod(cache_shape)) * cache_dtype.itemsize
+                # Unless scratch_budget is set, the cache is limited as the
+                # memmap of a bin
+                cache_budget = scratch_budget
+                if self.scratch_budget is None:
+                    cache_budget = min(cache_budget, MAX_BIN_SIZE_GB * 1024**3)
+                if cache_nbytes + self.scratch.used() <= cache_budget:
+                    cache_fn, cache_map = open_memmap(
+                        cache_shape, cache_dtype, scratch=self.scratch
+                    )
+                    del cache_map
+                    cache = (cache_fn, tuple(cache_shape), cache_dtype)
+                else:
+                    Console.warn(
+                        "The decoded images need {:.1f} GB of scratch disk, more than"
+                        " the {:.1f} GB available.".format(
+                            cache_nbytes / 1024**3, cache_budget / 1024**3
+                        ),
+                        "Images will be read again for each bin and to compute",
+                        "the corrected mean and std.",
+                    )
+                    cache_rows = None
+                    bin_rows = {}
+                    cache_corrected = False
+            # The approximate smoothing methods build the histogram of each
+            # bin in the same pass, in as many workers as fit in memory
+            histogram_smoothing = self.smoothing in HISTOGRAM_SMOOTHING
+            pass_workers = cpu_workers()
+            if histogram_smoothing:
+                largest_bin = np.bincount(idxs[idxs >= 0], minlength=1).max()
+                histogram_memory = estimate_bin_footprint(
+                    min(int(largest_bin), MAX_HISTOGRAM_IMAGES),
+                    self.image_height,
+                    self.image_width,
+                    self.image_channels,
+                    self.smoothing,
+                    self.histogram_bins,
+                    bool(self.depth_map_list),
+                )[0]
+                pass_workers = max(
+                    1, min(pass_workers, int(memory_budget // histogram_memory))
                 )
+            bin_statistics = None
+            if (
+                self.smoothing == "mean"
+                or histogram_smoothing
+                or use_single_pass
+                or self.store_bin_statistics
+                or cache is not None
             ):
-                joblib.Parallel(n_jobs=-2, verbose=0)(
-                    # Do not prefer="threads" as in certain cases this can cause the
-                    # program to crash when calling plt.imshow() in compute_distance_bin
-                    joblib.delayed(self.compute_distance_bin)(
+                bin_statistics = BinStatistics.from_images(
+                    hist_bins,
+                    (self.image_height, self.image_width, self.image_channels),
+                    compute_bin_statistics(
+                        self.camera_image_list,
                         idxs,
+                        hist_bins.size - 1,
+                        self.loader,
+                        self.depth_map_list if self.depth_map_list else None,
+                        self.image_width,
+                        self.image_height,
+                        n_jobs=pass_workers,
+                        cache=cache,
+                        cache_rows=cache_rows,
+                        smoothing=self.smoothing,
+                        histogram_bins=self.histogram_bins,
+                    ),
+                    idxs,
+                    distance_vector,
+                    self.parse_settings(),
+                )
+                # Saved so that dives or shards can be merged with
+                # correct_images merge without reading the images again
+                Console.info("Saving bin statistics to", self.bin_statistics_filepath)
+                bin_statistics.save(self.bin_statistics_filepath)
+
+            if self.smoothing == "mean" or histogram_smoothing:
+                for idx_bin, accumulator in sorted(
+                    bin_statistics.accumulators.items()
+                ):
+                    if accumulator.count < 10:
+                        continue
+                    if self.depth_map_list:
+                        bin_distances_sample = accumulator.distance_mean
+                        distance_bin_sample = bin_distances_sample.mean()
+                    else:
+                        (
+                            distance_bin_sample,
+                            bin_distances_sample,
+                        ) = self.get_altitude_bin_sample(
+                            idxs, idx_bin, distance_vector
+                        )
+                    self.store_distance_bin(
                         idx_bin,
+                        accumulator.mean
+                        if self.smoothing == "mean"
+                        else accumulator.smoothed,
+                        bin_distances_sample,
+                        distance_bin_sample,
                         images_map,
                         distances_map,
-                        max_bin_size,
-                        max_bin_size_gb,
-                        distance_vector,
                     )
-                    for idx_bin in range(hist_bins.size - 1)
+            else:
+                # Predict the footprint of each bin, so that only as many
+                # bins run at once as fit in the budgets
+                tasks = []
+                for idx_bin in range(hist_bins.size - 1):
+                    num_images = int(np.count_nonzero(idxs == idx_bin))
+                    if num_images < 10:
+                        # compute_distance_bin skips these bins
+                        continue
+                    if self.smoothing in MEMMAP_SMOOTHING:
+                        num_images = min(num_images, max_bin_size)
+                    memory, scratch = estimate_bin_footprint(
+                        num_images,
+                        self.image_height,
+                        self.image_width,
+                        self.image_channels,
+                        self.smoothing,
+                        self.histogram_bins,
+                        bool(self.depth_map_list),
+                        np.dtype(self.bin_storage_dtype()).itemsize,
+                    )
+                    if idx_bin in bin_rows:
+                        # The bin is read from the image cache
+                        scratch = 0
+                    tasks.append(Task(idx_bin, memory, scratch))
+                max_workers = cpu_workers()
+                bin_args = (idxs, max_bin_size, max_bin_size_gb, distance_vector)
+                if cache is not None:
+                    bin_args += (cache, bin_rows)
+                initargs = (
+                    self,
+                    (images_fn, images_map.shape),
+                    (distances_fn, distances_map.shape),
+                    bin_args,
                 )
+                if max_workers == 1:
+                    init_distance_bin_worker(*initargs)
+                    run_scheduled(
+                        tasks,
+                        lambda idx_bin: run_now(
+                            compute_distance_bin_in_worker, idx_bin
+                        ),
+                        memory_budget,
+                        scratch_budget,
+                        max_workers,
+                        desc="Computing altitude histogram",
+                    )
+                else:
+                    # Use the loky processes of joblib, as forked processes
+                    # can deadlock in numba and BLAS
+                    executor = get_reusable_executor(
+                        max_workers=max_workers,
+                        initializer=init_distance_bin_worker,
+                        initargs=initargs,
+                        reuse=False,
+                    )
+                    try:
+                        run_scheduled(
+                            tasks,
+                            lambda idx_bin: executor.submit(
+                                compute_distance_bin_in_worker, idx_bin
+                            ),
+                            memory_budget,
+                            scratch_budget,
+                            max_workers,
+                            desc="Computing altitude histogram",
+                        )
+                    finally:
+                        executor.shutdown(wait=True)
 
             # Save images map and distances map
             np.save(self.images_map_filepath, images_map)
@@ -844,10 +1376,19 @@ class Corrector:
                     self.image_height,
                     self.image_width,
                     self.image_channels,
-                    self.attenuation_parameters_folder,
+                    None,
+                    self.fitting_method,
+                    memory_budget,
+                    self.fitting_stride,
+                    self.fitting_upsampling,
                 )
             )
+            if self.fitting_stride > 1 and self.fitting_validation_pixels > 0:
+                self.validate_coarse_fitting(images_map, distances_map)
 
+            self.diagnostics.save_curves(
+                images_map, distances_map, self.image_attenuation_parameters
+            )
             self.plot_all_attenuation_curves(images_map, distances_map)
 
             # delete memmap handles
@@ -862,9 +1403,8 @@ class Corrector:
                 self.image_attenuation_parameters,
             )
 
-            corrections.save_attenuation_plots(
-                self.attenuation_parameters_folder,
-                attn=self.image_attenuation_parameters,
+            self.diagnostics.save(
+                "parameters", "attn", attn=self.image_attenuation_parameters
             )
 
             # compute correction gains per channel
@@ -884,10 +1424,7 @@ class Corrector:
             # Save correction gains
             np.save(self.correction_gains_filepath, self.correction_gains)
 
-            corrections.save_attenuation_plots(
-                self.attenuation_parameters_folder,
-                gains=self.correction_gains,
-            )
+            self.diagnostics.save("parameters", "gains", gains=self.correction_gains)
 
             # Useful if fails, to reload precomputed numpyfiles.
             # TODO: offer as a new step.
@@ -895,88 +1432,29 @@ class Corrector:
             #   self.attenuation_params_filepath)
             # self.correction_gains = np.load(self.correction_gains_filepath)
 
-            # apply gains to images
-            Console.info("Applying attenuation corrections to images...")
-            image_properties = [
-                self.image_height,
-                self.image_width,
-                self.image_channels,
-            ]
-            runner = RunningMeanStd(image_properties)
-
-            """
-            memmap_filename, memmap_handle = open_memmap(
-                shape=(
-                    len(self.camera_image_list),
-                    self.image_height,
-                    self.image_width,
-                    self.image_channels,
-                ),
-                dtype=np.float32,
-            )
-            """
-
-            # DEBUG: can be removed
-            # Console.error("depth_map_list size", len(self.depth_map_list))
-            # Console.error("camera_image_list size", len(self.camera_image_list))
-            ###################################################################################################
-            for i in trange(len(self.camera_image_list)):
-                # Load the image
-                img = self.loader(self.camera_image_list[i])
-
-                # Load the distance matrix
-                if not self.depth_map_list:
-                    # TODO: Show the depth_map creation
-                    # if self.depth_map_list is None:
-                    # Generate matrices on the fly
-                    distance = distance_vector[i]
-                    distance_mtx = np.empty((self.image_height, self.image_width))
-                    distance_mtx.fill(distance)
-                else:
-                    distance_mtx = depth_map.loader(
-                        self.depth_map_list[i],
-                        self.image_width,
-                        self.image_height,
-                    )
-                # TODO: Show the size of the produced distance_mtx
-                # Correct the image
-                corrected_img = corrections.attenuation_correct(
-                    img,
-                    distance_mtx,
+            if use_single_pass:
+                Console.info("Applying attenuation corrections to bin statistics...")
+                (
+                    image_corrected_mean,
+                    image_corrected_std,
+                ) = corrected_statistics_from_bins(
+                    bin_statistics,
                     self.image_attenuation_parameters,
                     self.correction_gains,
                 )
-                # TODO: Inspect the corrected image after attenuation correction
-                # Before calling compute, let's show the corrected_img dimensions
-                # Console.error("corrected_img.shape", corrected_img.shape)
-                runner.compute(corrected_img)
-                """
-                memmap_handle[i] = corrected_img.reshape(
-                    self.image_height, self.image_width, self.image_channels
+            elif cache_corrected:
+                (
+                    image_corrected_mean,
+                    image_corrected_std,
+                ) = self.corrected_mean_std_from_images(
+                    distance_vector, cache, cache_rows
                 )
-                """
-            # Compute mean and std using RANSAC
-            """
-            image_corrected_mean_ransac, image_corrected_std_ransac = ransac_mean_std(
-                memmap_handle, max_iterations=1000, threshold=0.1, sample_size=2
-            )
-            # This is the last time we need the memmap_handle.
-            # We probably should call try_remove(memmap_filename) here.
-
-            image_corrected_mean_ransac = image_corrected_mean_ransac.reshape(
-                self.image_height, self.image_width, self.image_channels
-            )
-            image_corrected_std_ransac = image_corrected_std_ransac.reshape(
-                self.image_height, self.image_width, self.image_channels
-            )
-            """
-
-            image_corrected_mean = runner.mean.reshape(
-                self.image_height, self.image_width, self.image_channels
-            )
-            image_corrected_std = runner.std.reshape(
-                self.image_height, self.image_width, self.image_channels
-            )
+            else:
+                (
+                    image_corrected_mean,
+                    image_corrected_std,
+                ) = self.corrected_mean_std_from_images(distance_vector)
+            try_remove(cache_fn)
 
             # save parameters for process
             np.save(
@@ -999,8 +1477,9 @@ class Corrector:
             )  # TODO: make member
             """
 
-            corrections.save_attenuation_plots(
-                self.attenuation_parameters_folder,
+            self.diagnostics.save(
+                "statistics",
+                "corrected",
                 img_mean=image_corrected_mean,
                 img_std=image_corrected_std,
             )
@@ -1042,50 +1521,174 @@ class Corrector:
                 image_raw_std,
             )
 
-            corrections.save_attenuation_plots(
-                self.attenuation_parameters_folder,
-                img_mean=image_raw_mean,
-                img_std=image_raw_std,
+            self.diagnostics.save(
+                "statistics", "raw", img_mean=image_raw_mean, img_std=image_raw_std
             )
 
         Console.info("Correction parameters saved")
+        self.diagnostics.finish()
 
-    def plot_all_attenuation_curves(self, images_map, distances_map):
-        fig = plt.figure()
+    def corrected_mean_std_from_images(
+        self, distance_vector, cache=None, cache_rows=None
+    ):
+        """Compute the mean and std of the attenuation corrected images,
+        reading every image again, or reading them from the image cache if
+        cache and cache_rows are given"""
+        # apply gains to images
+        Console.info("Applying attenuation corrections to images...")
+        image_properties = [
+            self.image_height,
+            self.image_width,
+            self.image_channels,
+        ]
+        # Chunks of images are corrected in parallel and their statistics
+        # merged in order, so the result does not depend on the CPU count
+        image_list = self.camera_image_list
+        loader = self.loader
+        if cache is not None:
+            image_list = [int(row) for row in cache_rows]
+            loader = MemmapImageLoader(*cache)
+        runner = compute_corrected_statistics(
+            image_list,
+            distance_vector if not self.depth_map_list else None,
+            loader,
+            self.image_attenuation_parameters,
+            self.correction_gains,
+            image_properties,
+            self.depth_map_list if self.depth_map_list else None,
+            n_jobs=cpu_workers(),
+        )
+
+        image_corrected_mean = runner.mean.reshape(
+            self.image_height, self.image_width, self.image_channels
+        )
+        image_corrected_std = runner.std.reshape(
+            self.image_height, self.image_width, self.image_channels
+        )
+        return image_corrected_mean, image_corrected_std
 
-        images_map[images_map == 0] = np.NaN
-        distances_map[distances_map == 0] = np.NaN
+    def validate_coarse_fitting(self, images_map, distances_map):
+        """Compare the upsampled attenuation parameters with full resolution
+        fits of a random subset of pixels, and save the report to
+        fitting_validation.csv in the attenuation parameters folder"""
+        Console.info(
+            "Validating the upsampled parameters on",
+            self.fitting_validation_pixels,
+            "pixels",
+        )
+        report = corrections.validate_upsampled_parameters(
+            images_map,
+            distances_map,
+            self.image_attenuation_parameters,
+            self.image_height,
+            self.image_width,
+            self.image_channels,
+            self.fitting_validation_pixels,
+        )
+        report.to_csv(
+            Path(self.attenuation_parameters_folder) / "fitting_validation.csv",
+            index=False,
+        )
+        for i_channel, errors in report.groupby("channel")["relative_error"]:
+            Console.info(
+                "Channel {} relative curve error: median {:.4f}, "
+                "95th percentile {:.4f}, max {:.4f}".format(
+                    i_channel,
+                    errors.median(),
+                    errors.quantile(0.95),
+                    errors.max(),
+                )
+            )
 
-        pixel_range = range(
+    def plot_all_attenuation_curves(self, images_map, distances_map):
+        """Store the samples and fitted curves of one pixel in a hundred for
+        the attenuation plot"""
+        if not self.diagnostics.enabled("attenuation_plot"):
+            return
+        pixels = np.arange(
             0,
             self.image_height * self.image_width,
             (self.image_height * self.image_width) // 100,
         )
-        for i_channel in range(self.image_channels):
-            with tqdm(desc="Attenuation plot", total=len(pixel_range)) as pbar:
-                for i_pixel in pixel_range:
-                    i_pixel_height = i_pixel // self.image_width
-                    i_pixel_width = i_pixel % self.image_width
-                    p0, p1, p2 = self.image_attenuation_parameters[
-                        i_channel, i_pixel_height, i_pixel_width
-                    ]
-                    xs = np.arange(2, 10, 0.1)
-                    plt.plot(
-                        xs,
-                        p0 * np.exp(p1 * xs) + p2,
-                        color="black",
-                        alpha=0.1,
-                    )
-                    plt.plot(
-                        distances_map[:, i_pixel],
-                        images_map[:, i_pixel, i_channel],
-                        ",",
-                        color="blue",
-                        alpha=0.1,
-                    )
-                    pbar.update(1)
-        plt.savefig(self.attenuation_plot_filepath, dpi=600)
-        plt.close(fig)
+        altitudes = np.array(distances_map[:, pixels])
+        intensities = np.array(images_map[:, pixels])
+        # Bins without images are not plotted
+        altitudes[altitudes == 0] = np.nan
+        intensities[intensities == 0] = np.nan
+        params = self.image_attenuation_parameters.reshape(
+            self.image_channels, -1, 3
+        )[:, pixels]
+        self.diagnostics.save(
+            "attenuation_plot",
+            "all",
+            altitudes=altitudes,
+            intensities=intensities,
+            params=params,
+        )
+
+    def bin_storage_dtype(self):
+        """Type of the memmaps of the altitude bins: the storage type of the
+        scratch space, or float32 for ransac_mean, which only reads float32"""
+        if self.smoothing == "ransac_mean":
+            return np.float32
+        return self.scratch.dtype
+
+    def plan_image_cache(self, idxs, num_bins, max_bin_size, use_single_pass):
+        """Choose where the streaming pass stores each decoded image in the
+        image cache, a scratch memmap sorted by bin
+
+        The bins of the exact smoothing methods are contiguous slices of the
+        cache, randomly sampled to max_bin_size images. If the cache stores
+        the images without loss, i.e. as float32, the corrected mean and std
+        are not computed from the bin statistics, and cache_images is set,
+        every image is cached so that they are not read again.
+
+        Returns
+        -------
+        tuple
+            Row of each image in the cache, or -1, or None if no image is
+            cached; the first and last row of each bin smoothed from the
+            cache; and whether the corrected mean and std read the cache
+        """
+        idxs = np.asarray(idxs).reshape(-1)
+        cache_bins = self.smoothing in MEMMAP_SMOOTHING
+        cache_corrected = (
+            self.cache_images
+            and not use_single_pass
+            and np.dtype(self.bin_storage_dtype()) == np.float32
+        )
+        if not cache_bins and not cache_corrected:
+            return None, {}, False
+        cache_rows = np.full(len(idxs), -1, dtype=np.int64)
+        bin_rows = {}
+        row = 0
+        for idx_bin in range(num_bins):
+            members = np.where(idxs == idx_bin)[0]
+            smoothed = cache_bins and len(members) >= 10
+            if smoothed and len(members) > max_bin_size:
+                Console.info(
+                    "Random sampling altitude bin",
+                    idx_bin,
+                    "to",
+                    max_bin_size,
+                    "images",
+                )
+                # The sample comes first in the bin
+                members = np.array(random.sample(list(members), len(members)))
+            if smoothed:
+                bin_rows[idx_bin] = (row, row + min(len(members), max_bin_size))
+            if not cache_corrected:
+                members = members[:max_bin_size] if smoothed else members[:0]
+            cache_rows[members] = np.arange(row, row + len(members))
+            row += len(members)
+        if cache_corrected:
+            # Images outside the bins are also corrected
+            outside = np.where(cache_rows < 0)[0]
+            cache_rows[outside] = np.arange(row, row + len(outside))
+            row += len(outside)
+        if row == 0:
+            return None, {}, False
+        return cache_rows, bin_rows, cache_corrected
 
     def compute_distance_bin(
         self,
@@ -1096,6 +1699,8 @@ class Corrector:
         max_bin_size,
         max_bin_size_gb,
         distance_vector,
+        image_cache=None,
+        bin_rows=None,
     ):
         dimensions = [self.image_height, self.image_width, self.image_channels]
         tmp_idxs = np.where(idxs == idx_bin)[0]
@@ -1104,28 +1709,49 @@ class Corrector:
             bin_images = [self.camera_image_list[i] for i in tmp_idxs]
             bin_distances_sample = None
             bin_images_sample = None
+            # The image cache holds the images of the bin, already sampled
+            cached = image_cache is not None and idx_bin in bin_rows
+
+            def bin_memmap():
+                if cached:
+                    start, stop = bin_rows[idx_bin]
+                    return None, image_cache[start:stop]
+                return create_memmap(
+                    bin_images,
+                    dimensions,
+                    loader=self.loader,
+                    scratch=self.scratch,
+                    dtype=self.bin_storage_dtype(),
+                )
 
             # Random sample if memmap has to be created
-            if self.smoothing != "mean" and len(bin_images) > max_bin_size:
+            if (
+                self.smoothing in ["mean_trimmed", "median", "ransac_mean"]
+                and len(bin_images) > max_bin_size
+                and not cached
+            ):
                 Console.info(
                     "Random sampling altitude bin to fit in",
                     max_bin_size_gb,
                     "Gb",
                 )
                 bin_images = random.sample(bin_images, max_bin_size)
+            # Histogram counts are 16 bit
+            max_histogram_size = np.iinfo(np.uint16).max
+            if (
+                self.smoothing in ["mean_trimmed_approx", "median_approx"]
+                and len(bin_images) > max_histogram_size
+            ):
+                Console.info(
+                    "Random sampling altitude bin to", max_histogram_size, "images"
+                )
+                bin_images = random.sample(bin_images, max_histogram_size)
 
             if not self.depth_map_list:
-                # Generate matrices on the fly
-                distance_bin = distance_vector[tmp_idxs]
-                distance_bin_sample = distance_bin.mean()
-                if distance_bin_sample <= 0 or np.isnan(distance_bin_sample):
-                    Console.warn("The mean distance is equal or lower than zero!")
-                    Console.warn("Printing the entire vector:", distance_bin)
-                    Console.warn("Printing the mean:", distance_bin_sample)
-                    distance_bin_sample = self.altitude_min + self.bin_band * idx_bin
-
-                bin_distances_sample = np.empty((self.image_height, self.image_width))
-                bin_distances_sample.fill(distance_bin_sample)
+                (
+                    distance_bin_sample,
+                    bin_distances_sample,
+                ) = self.get_altitude_bin_sample(idxs, idx_bin, distance_vector)
             else:
                 bin_distances = [self.depth_map_list[i] for i in tmp_idxs]
                 bin_distances_sample = running_mean_std(
@@ -1140,32 +1766,27 @@ class Corrector:
             if self.smoothing == "mean":
                 bin_images_sample = running_mean_std(bin_images, loader=self.loader)[0]
             elif self.smoothing == "mean_trimmed":
-                memmap_filename, memmap_handle = create_memmap(
-                    bin_images,
-                    dimensions,
-                    loader=self.loader,
-                )
-                self.memmaps_to_remove.append(memmap_filename)
-                bin_images_sample = image_mean_std_trimmed(memmap_handle)[0]
+                memmap_filename, memmap_handle = bin_memmap()
+                scale = storage_scale(memmap_handle.dtype)
+                bin_images_sample = image_mean_std_trimmed(memmap_handle)[0] / scale
                 del memmap_handle
                 try_remove(memmap_filename)
             elif self.smoothing == "median":
-                memmap_filename, memmap_handle = create_memmap(
-                    bin_images,
-                    dimensions,
-                    loader=self.loader,
-                )
-                self.memmaps_to_remove.append(memmap_filename)
-                bin_images_sample = median_array(memmap_handle)
+                memmap_filename, memmap_handle = bin_memmap()
+                scale = storage_scale(memmap_handle.dtype)
+                bin_images_sample = median_array(memmap_handle) / scale
                 del memmap_handle
                 try_remove(memmap_filename)
+            elif self.smoothing == "mean_trimmed_approx":
+                bin_images_sample = pixel_histogram(
+                    bin_images, loader=self.loader, num_bins=self.histogram_bins
+                ).mean_trimmed()
+            elif self.smoothing == "median_approx":
+                bin_images_sample = pixel_histogram(
+                    bin_images, loader=self.loader, num_bins=self.histogram_bins
+                ).median
             elif self.smoothing == "ransac_mean":
-                memmap_filename, memmap_handle = create_memmap(
-                    bin_images,
-                    dimensions,
-                    loader=self.loader,
-                )
-                self.memmaps_to_remove.append(memmap_filename)
+                memmap_filename, memmap_handle = bin_memmap()
                 bin_images_sample = ransac_mean_std(
                     memmap_handle, max_iterations=1000, threshold=0.1, sample_size=2
                 )[0]
@@ -1174,36 +1795,57 @@ class Corrector:
             else:
                 raise ValueError("Smoothing method not recognized")
 
-            base_path = Path(self.attenuation_parameters_folder)
-
-            fig = plt.figure()
-            plt.imshow(bin_images_sample)
-            plt.colorbar()
-            plt.title(f"Image bin {idx_bin}, altitude: {distance_bin_sample:.2f}")
-            fig_name = base_path / (
-                f"bin_image_{idx_bin:02}_{distance_bin_sample:05.2f}m.png"
+            self.store_distance_bin(
+                idx_bin,
+                bin_images_sample,
+                bin_distances_sample,
+                distance_bin_sample,
+                images_map,
+                distances_map,
             )
-            # Console.info("Saved figure at", fig_name)
-            plt.savefig(fig_name, dpi=600)
-            plt.close(fig)
-
-            fig = plt.figure()
-            plt.imshow(bin_distances_sample)
-            plt.colorbar()
-            plt.title(f"Distance bin {idx_bin}, altitude: {distance_bin_sample:.2f}")
-            fig_name = base_path / (
-                f"bin_distance_sample_{idx_bin:02}_{distance_bin_sample:05.2f}m.png"
-            )
-            # Console.info("Saved figure at", fig_name)
-            plt.savefig(fig_name, dpi=600)
-            plt.close(fig)
 
-            images_map[idx_bin] = bin_images_sample.reshape(
-                [self.image_height * self.image_width, self.image_channels]
-            )
-            distances_map[idx_bin] = bin_distances_sample.reshape(
-                [self.image_height * self.image_width]
-            )
+    def get_altitude_bin_sample(self, idxs, idx_bin, distance_vector):
+        """Get the mean altitude of a bin and the matching distance matrix"""
+        tmp_idxs = np.where(idxs == idx_bin)[0]
+        # Generate matrices on the fly
+        distance_bin = distance_vector[tmp_idxs]
+        distance_bin_sample = distance_bin.mean()
+        if distance_bin_sample <= 0 or np.isnan(distance_bin_sample):
+            Console.warn("The mean distance is equal or lower than zero!")
+            Console.warn("Printing the entire vector:", distance_bin)
+            Console.warn("Printing the mean:", distance_bin_sample)
+            distance_bin_sample = self.parse_altitude_min + self.bin_band * idx_bin
+
+        bin_distances_sample = np.empty((self.image_height, self.image_width))
+        bin_distances_sample.fill(distance_bin_sample)
+        return distance_bin_sample, bin_distances_sample
+
+    def store_distance_bin(
+        self,
+        idx_bin,
+        bin_images_sample,
+        bin_distances_sample,
+        distance_bin_sample,
+        images_map,
+        distances_map,
+    ):
+        """Store the image and distance samples of a bin in the images and
+        distances maps, and their figure data"""
+        self.diagnostics.save(
+            "bins",
+            f"{idx_bin:02}",
+            image=bin_images_sample,
+            distance=bin_distances_sample,
+            idx_bin=idx_bin,
+            altitude=distance_bin_sample,
+        )
+
+        images_map[idx_bin] = bin_images_sample.reshape(
+            [self.image_height * self.image_width, self.image_channels]
+        )
+        distances_map[idx_bin] = bin_distances_sample.reshape(
+            [self.image_height * self.image_width]
+        )
 
     # execute the corrections of images using the gain values in case of
     # attenuation correction or static color balance
@@ -1229,49 +1871,258 @@ class Corrector:
             "images for color, distortion, gamma corrections...",
         )
 
-        with tqdm_joblib(
-            tqdm(desc="Correcting images", total=len(self.camera_image_list))
-        ):
-            self.processed_image_list = joblib.Parallel(n_jobs=-2, verbose=0)(
-                joblib.delayed(self.process_image)(idx)
-                for idx in range(0, len(self.camera_image_list))
+        self.create_gain_map_cache()
+
+        # Images are recorded in the manifest as they are written. When
+        # resuming, skip those already corrected with the same configuration
+        self.config_hash = self.correction_hash()
+        output_exists = os.path.exists
+        if self.shard_format != "none":
+            # Images are appended to shards, under their usual names
+            self.shard_writer = ShardWriter(
+                self.output_images_folder,
+                self.shard_format,
+                self.shard_size * 1024**2,
+                self.fsync,
             )
+            output_exists = self.shard_writer.exists
+        self.manifest = Manifest(
+            self.output_images_folder / "manifest.csv",
+            resume=self.resume,
+            output_exists=output_exists,
+        )
+        image_indices = [
+            idx
+            for idx, image_path in enumerate(self.camera_image_list)
+            if self.manifest.output_path(image_path, self.config_hash) is None
+        ]
+        if self.resume:
+            Console.info(
+                len(self.camera_image_list) - len(image_indices),
+                "images are up to date.",
+                len(image_indices),
+                "images will be corrected.",
+            )
+
+        if self.loader.bag_index is not None:
+            # Read the images in the order they are stored in the bagfiles
+            order = self.loader.bag_index.order(
+                [self.camera_image_list[idx] for idx in image_indices],
+                self.loader.tz_offset_s,
+            )
+            image_indices = [image_indices[i] for i in order]
 
-        # write a filelist.csv containing image filenames and navigation
-        image_names = []
-        for path in self.processed_image_list:
-            if path is not None:
-                image_names.append(Path(path).stem)
-        d = {"image_names": image_names, "relative_path": self.processed_image_list}
-        dataframe = pd.DataFrame(d)
-
-        orig_dataframe = pd.read_csv(self.altitude_csv_path)
-        orig_dataframe["raw_relative_path"] = orig_dataframe["relative_path"]
-
-        # Merge the two dataframes when image filenames are the same
-        output_df = orig_dataframe.copy()
-        for index, row in output_df.iterrows():
-            current_image_name = Path(row["relative_path"]).stem
-            # find current_image_name in dataframe
-            res = dataframe.loc[dataframe["image_names"] == current_image_name]
-            if not res.empty:
-                # update relative_path
-                output_df.at[index, "relative_path"] = Path(
-                    res["relative_path"].values[0]
-                ).name
-                # Check if path is absolute:
-                if Path(row["relative_path"]).is_absolute():
-                    # update raw_relative_path to relative
-                    output_df.at[index, "raw_relative_path"] = Path(
-                        row["relative_path"]
-                    ).relative_to(self.path_raw)
+        # Images are read and corrected by several workers at once, so each
+        # one is decoded and corrected with serial kernels
+        self.loader.parallel = False
+        try:
+            if self.compute_backend == "processes":
+                self.process_correction_in_workers(image_indices)
             else:
-                # remove row
-                output_df.drop(index, inplace=True)
+                for round_indices in self.correction_rounds(image_indices):
+                    # Reading, correcting and writing images overlap in
+                    # separate stages
+                    run_pipeline(
+                        round_indices,
+                        [
+                            (self.read_image, self.read_workers),
+                            (self.correct_image, self.compute_workers),
+                            (self.write_image, self.write_workers),
+                        ],
+                        queue_size=self.queue_size,
+                        desc="Correcting images",
+                    )
+        finally:
+            if self.shard_writer is not None:
+                self.shard_writer.close()
+
+        if self.gain_map_cache is not None and self.compute_backend != "processes":
+            Console.info(
+                "Gain map cache:",
+                self.gain_map_cache.hits,
+                "hits,",
+                self.gain_map_cache.misses,
+                "misses ({:.1f}% hit rate)".format(100 * self.gain_map_cache.hit_rate),
+            )
+
+        # write a filelist.csv containing image filenames and navigation, from
+        # the images recorded in the manifest
+        self.processed_image_list = [
+            self.manifest.output_path(image_path, self.config_hash)
+            for image_path in self.camera_image_list
+        ]
+        output_df = merge_filelist(
+            pd.read_csv(self.altitude_csv_path),
+            self.processed_image_list,
+            self.path_raw,
+        )
         filelist_path = self.output_images_folder / "filelist.csv"
         output_df.to_csv(filelist_path)
         Console.info("Processing of images is completed")
 
+    def create_gain_map_cache(self):
+        """Create the cache of gain maps used to correct images at a constant
+        altitude, if the corrections use them"""
+        self.gain_map_cache = None
+        if (
+            self.correction_method == "colour_correction"
+            and self.distance_metric == "altitude"
+            and self.gain_cache_step > 0
+            and self.image_attenuation_parameters is not None
+        ):
+            self.gain_map_cache = corrections.GainMapCache(
+                self.image_attenuation_parameters,
+                self.correction_gains,
+                self.gain_cache_step,
+                self.gain_cache_size * 2**20,
+            )
+
+    def correction_hash(self):
+        """Hash the configuration and parameters that determine the corrected
+        images, to tell whether an image corrected before is up to date
+
+        Returns
+        --------
+        str
+            SHA-256 hex digest
+        """
+        h = hashlib.sha256()
+        settings = [
+            self.correction_method,
+            getattr(self, "distance_metric", None),
+            getattr(self, "brightness", None),
+            getattr(self, "contrast", None),
+            getattr(self, "color_gain_matrix_rgb", None),
+            getattr(self, "subtractors_rgb", None),
+            getattr(self, "fused_kernel", None),
+            getattr(self, "gain_cache_step", None),
+            getattr(self, "depth_map_dtype", None),
+            self._type,
+            self.loader.bit_depth,
+            self.undistort,
+            self.undistort_fixed_point,
+            self.output_format,
+        ]
+        if self.integer_pipeline:
+            settings.append("integer_pipeline")
+        h.update(repr(settings).encode())
+        for name in SHARED_PARAMETERS:
+            value = getattr(self, name)
+            if value is not None:
+                h.update(name.encode())
+                h.update(np.ascontiguousarray(value))
+        if self.undistort:
+            h.update(Path(self.camera_params_file_path).read_bytes())
+        return h.hexdigest()
+
+    def process_correction_in_workers(self, image_indices):
+        """Read and correct the images in a pool of worker processes, and write
+        them from threads of this process
+
+        The correction parameters are saved once to .npy files that every
+        worker opens as read-only memmaps, so they are neither pickled with
+        each task nor copied in each worker. Tasks only carry the image index.
+
+        Parameters
+        -----------
+        image_indices : list
+            indices of the images to correct
+
+        Returns
+        --------
+        list
+            paths to the written images
+        """
+        worker_corrector = copy.copy(self)
+        # Each worker creates its own cache from the shared parameters
+        worker_corrector.gain_map_cache = None
+        # Images are written and recorded by this process only
+        worker_corrector.manifest = None
+        worker_corrector.shard_writer = None
+        with tempfile.TemporaryDirectory(prefix="correct_images_") as tmp:
+            shared_parameters = {}
+            for name in SHARED_PARAMETERS:
+                value = getattr(self, name)
+                if value is None:
+                    continue
+                path = Path(tmp) / (name + ".npy")
+                np.save(path, value)
+                shared_parameters[name] = path
+                setattr(worker_corrector, name, None)
+            executor = None
+            executor_workers = None
+
+            def correct_in_worker(idx):
+                return executor.submit(correct_image_in_worker, idx).result()
+
+            paths = []
+            try:
+                for round_indices in self.correction_rounds(image_indices):
+                    if executor_workers != self.compute_workers:
+                        if executor is not None:
+                            executor.shutdown(wait=True)
+                        # Use the loky processes of joblib, as forked processes
+                        # can deadlock in numba and BLAS
+                        executor = get_reusable_executor(
+                            max_workers=self.compute_workers,
+                            initializer=init_correction_worker,
+                            initargs=(worker_corrector, shared_parameters),
+                            reuse=False,
+                        )
+                        executor_workers = self.compute_workers
+                    paths += run_pipeline(
+                        round_indices,
+                        [
+                            (correct_in_worker, self.compute_workers),
+                            (self.write_image, self.write_workers),
+                        ],
+                        queue_size=self.queue_size,
+                        desc="Correcting images",
+                    )
+                return paths
+            finally:
+                if executor is not None:
+                    executor.shutdown(wait=True)
+
+    def correction_rounds(self, image_indices):
+        """Split the images to correct in rounds
+
+        When the cameras are corrected at once by run_shared, and
+        compute_workers is not set, the number of workers follows the CPU
+        share of the camera before each round, so that it grows as the other
+        cameras finish. Otherwise all the images are corrected in one round.
+
+        Parameters
+        -----------
+        image_indices : list
+            indices of the images to correct
+
+        Yields
+        -------
+        list
+            indices of the images of each round
+        """
+        output_settings = None
+        if self.correct_config is not None:
+            output_settings = self.correct_config.output_settings
+        if (
+            output_settings is None
+            or output_settings.compute_workers
+            or not shared_resources()
+        ):
+            yield image_indices
+            return
+        start = 0
+        while start < len(image_indices):
+            workers = cpu_workers()
+            if workers != self.compute_workers:
+                Console.info("Correcting images with", workers, "workers")
+            self.compute_workers = workers
+            self.queue_size = output_settings.queue_size or 2 * workers
+            stop = start + CORRECTION_ROUND_IMAGES * workers
+            yield image_indices[start:stop]
+            start = stop
+
     def process_image(self, idx):
         """Execute series of corrections for an image
 
@@ -1280,15 +2131,29 @@ class Corrector:
         idx : int
             index to the list of image numpy files
         """
+        return self.write_image(idx, self.correct_image(idx, self.read_image(idx)))
+
+    def read_image(self, idx):
+        """Load an image and its distance matrix, if needed by the corrections
+
+        Parameters
+        -----------
+        idx : int
+            index to the list of image numpy files
 
+        Returns
+        --------
+        tuple
+            image and distance matrix. The distance matrix is None if the
+            corrections do not use it
+        """
+        if self.correction_method == "manual_balance" and self.integer_pipeline:
+            # Keep the image in 16-bit integers
+            return self.loader.load_uint16(self.camera_image_list[idx]), None
         # load image and convert to float
         image = self.loader(self.camera_image_list[idx])
-        image_rgb = None
-        # print("loader:", image.dtype, np.max(image), np.min(image))
-
-        # apply corrections
+        distance_matrix = None
         if self.correction_method == "colour_correction":
-            distance_matrix = None
             if self.distance_metric == "depth_map":
                 distance_matrix = depth_map.loader(
                     self.depth_map_list[idx],
@@ -1302,10 +2167,76 @@ class Corrector:
                         "available indices in the altitude vector",
                     )
                     return None
-                distance = self.altitude_list[idx]
-                distance_matrix = np.empty((self.image_height, self.image_width))
-                distance_matrix.fill(distance)
-            if distance_matrix is not None:
+                if self.gain_map_cache is None:
+                    distance = self.altitude_list[idx]
+                    distance_matrix = np.empty(
+                        (self.image_height, self.image_width)
+                    )
+                    distance_matrix.fill(distance)
+        return image, distance_matrix
+
+    def correct_image(self, idx, image_and_distance):
+        """Apply the corrections to an image
+
+        Parameters
+        -----------
+        idx : int
+            index to the list of image numpy files
+        image_and_distance : tuple
+            image and distance matrix, as returned by read_image
+
+        Returns
+        --------
+        numpy.ndarray
+            corrected 8-bit image
+        """
+        image, distance_matrix = image_and_distance
+        image_rgb = None
+
+        # With a constant altitude, use the cached gain map of the altitude
+        # instead of computing the attenuation of every pixel
+        gain_map = None
+        if self.gain_map_cache is not None:
+            gain_map = self.gain_map_cache(self.altitude_list[idx])
+        attenuate = distance_matrix is not None or gain_map is not None
+
+        if self.correction_method == "colour_correction" and self.fused_kernel:
+            if attenuate:
+                mean, std = self.image_corrected_mean, self.image_corrected_std
+            else:
+                mean, std = self.image_raw_mean, self.image_raw_std
+            return corrections.colour_correct(
+                image,
+                distance_matrix,
+                self.image_attenuation_parameters,
+                self.correction_gains,
+                mean,
+                std,
+                self.brightness,
+                self.contrast,
+                self._type,
+                self.camera_params_file_path if self.undistort else None,
+                self.undistort_fixed_point,
+                gain_map,
+                parallel=False,
+            )
+
+        if self.correction_method == "manual_balance" and self.integer_pipeline:
+            return corrections.manual_balance_uint16(
+                image,
+                self.color_gain_matrix_rgb,
+                self.subtractors_rgb,
+                self._type,
+                self.camera_params_file_path if self.undistort else None,
+                self.undistort_fixed_point,
+                parallel=False,
+            )
+
+        # apply corrections
+        if self.correction_method == "colour_correction":
+            if gain_map is not None:
+                image = corrections.gain_map_correct(image, gain_map)
+            elif distance_matrix is not None:
                 image = corrections.attenuation_correct(
                     image,
                     distance_matrix,
@@ -1313,7 +2244,7 @@ class Corrector:
                     self.correction_gains,
                 )
 
-            if distance_matrix is not None:
+            if attenuate:
                 image = corrections.pixel_stat(
                     image,
                     self.image_corrected_mean,
@@ -1362,7 +2293,7 @@ class Corrector:
         # apply distortion corrections
         if self.undistort:
             image_rgb = corrections.distortion_correct(
-                self.camera_params_file_path, image_rgb
+                self.camera_params_file_path, image_rgb, self.undistort_fixed_point
             )
 
         # apply gamma corrections to rgb images for colour correction
@@ -1373,8 +2304,23 @@ class Corrector:
         image_rgb *= 255
         image_rgb = image_rgb.clip(0, 255).astype(np.uint8)
         # print('clip:', image_rgb.dtype, np.max(image_rgb), np.min(image_rgb))
+        return image_rgb
+
+    def write_image(self, idx, image_rgb):
+        """Write a corrected image to the output folder
 
-        # write to output files
+        Parameters
+        -----------
+        idx : int
+            index to the list of image numpy files
+        image_rgb : numpy.ndarray
+            corrected 8-bit image
+
+        Returns
+        --------
+        Path
+            path to the written image
+        """
         try:
             if self.camera.extension == "bag":
                 image_filename = (
@@ -1384,9 +2330,21 @@ class Corrector:
                 image_filename = Path(self.camera_image_list[idx]).stem
         except FileNotFoundError:
             image_filename = self.camera_name + "_" + str(self.camera_image_list[idx])
-        return write_output_image(
-            image_rgb,
-            image_filename,
-            self.output_images_folder,
-            self.output_format,
-        )
+        if self.shard_writer is not None:
+            output_path = self.shard_writer.write(
+                image_filename + "." + self.output_format,
+                encode_output_image(image_rgb, self.output_format),
+            )
+        else:
+            output_path = write_output_image(
+                image_rgb,
+                image_filename,
+                self.output_images_folder,
+                self.output_format,
+                self.fsync,
+            )
+        if self.manifest is not None:
+            self.manifest.add(
+                self.camera_image_list[idx], self.config_hash, output_path
+            )
+        return output_path
@@ -17,6 +17,21 @@ except ImportError:
 from oplab import Console
 
 
+def _bit_depth(image):
+    read_bit_depth = None
+    if image.dtype == 'uint8':
+        read_bit_depth = 8
+    elif image.dtype == 'uint16':
+        read_bit_depth = 16
+    elif image.dtype == 'uint32':
+        read_bit_depth = 32
+    elif image.dtype == 'uint64':
+        read_bit_depth = 64
+    else:
+        Console.quit("Image dtype not implemented:", image.dtype)
+    return read_bit_depth
+
+
 def loader(image_filepath, image_width=None, image_height=None, src_bit=8):
     """Default image loader using imageio
 
@@ -37,20 +52,7 @@ def loader(image_filepath, image_width=None, image_height=None, src_bit=8):
     # Clip the image to remove any unwanted data
     image = imread(str(image_filepath))
 
-    # Check bit depth
-    read_bit_depth = None
-    if image.dtype == 'uint8':
-        read_bit_depth = 8
-    elif image.dtype == 'uint16':
-        read_bit_depth = 16
-    elif image.dtype == 'uint32':
-        read_bit_depth = 32
-    elif image.dtype == 'uint64':
-        read_bit_depth = 64
-    else:
-        Console.quit("Image dtype not implemented:", image.dtype)
-
-    bit_shift = read_bit_depth - src_bit
+    bit_shift = _bit_depth(image) - src_bit
     if bit_shift > 0:
         image = np.right_shift(image, bit_shift).astype(np.float32)
     else:
@@ -58,3 +60,29 @@ def loader(image_filepath, image_width=None, image_height=None, src_bit=8):
     image = image * 2 ** (-src_bit)
     #print("Image min/max: ", np.min(image), np.max(image), np.min(image2), np.max(image2), src_bit)
     return image
+
+
+def loader_uint16(image_filepath, src_bit=8):
+    """Load an image as 16-bit integers, without converting it to float
+
+    Parameters
+    ----------
+    image_filepath : Path
+        Image file path
+    src_bit : int
+        Number of significant bits of the image
+
+    Returns
+    -------
+    np.ndarray
+        uint16 image, with the intensities of loader in units of 2**-16
+    """
+    image = imread(str(image_filepath))
+    # The src_bit most significant bits, aligned to the top of 16 bits
+    bit_shift = _bit_depth(image) - src_bit
+    if bit_shift > 0:
+        image = np.right_shift(image, bit_shift)
+    if src_bit > 16:
+        image = np.right_shift(image, src_bit - 16)
+        src_bit = 16
+    return np.left_shift(image.astype(np.uint16), 16 - src_bit)
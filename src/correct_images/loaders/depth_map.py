@@ -6,18 +6,47 @@ Licensed under the BSD 3-Clause License.
 See LICENSE.md file in the project root for full license information.
 """
 
+import os
+from collections import namedtuple
+from pathlib import Path
+
+import cv2
+import joblib
 import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+from correct_images.tools.joblib_tqdm import tqdm_joblib
+from correct_images.tools.manifest import file_stat
+from correct_images.tools.scheduler import cpu_workers
+from oplab import Console
+
+# Reference to a depth map in a DepthMapStore, used in place of its filename
+StoredDepthMap = namedtuple("StoredDepthMap", ["store", "index"])
+
+
+def resize_depth_map(depth_map, image_width, image_height):
+    """Resize a depth map to the image resolution. Nearest neighbour
+    interpolation is used so that pixels without depth (zeros) are not blended
+    with valid ones."""
+    if depth_map.shape[:2] == (image_height, image_width):
+        return depth_map
+    return cv2.resize(
+        depth_map.astype(np.float32),
+        (image_width, image_height),
+        interpolation=cv2.INTER_NEAREST,
+    )
 
 
-def loader(depth_map_filename, image_width, image_height):
+def loader(depth_map_filename, image_width=None, image_height=None):
     """Depth map image loader
 
     Parameters
     ----------
-    depth_map_filename : Path
-        Image file path
+    depth_map_filename : Path or StoredDepthMap
+        Image file path, or reference to a depth map in a DepthMapStore
     image_width : int
-        Image height
+        Image width. If given, the depth map is resized to the image size
     image_height : int
         Image height
 
@@ -26,4 +55,148 @@ def loader(depth_map_filename, image_width, image_height):
     np.ndarray
         Loaded depth map in matrix form (numpy)
     """
-    return np.load(depth_map_filename)
+    if isinstance(depth_map_filename, StoredDepthMap):
+        store, index = depth_map_filename
+        return np.asarray(store[index], dtype=np.float32)
+    depth_map = np.load(depth_map_filename)
+    if image_width is not None and image_height is not None:
+        depth_map = resize_depth_map(depth_map, image_width, image_height)
+    return depth_map
+
+
+class DepthMapStore:
+    """Depth maps packed in a single memory-mapped stack.
+
+    The depth maps are resized to the image resolution once, when the store is
+    built, so reading one is a slice of the stack with no decoding. An index
+    CSV file next to the stack holds the source file, size and modification
+    time and the mean of each depth map.
+    """
+
+    def __init__(self, path):
+        """Open a store built by build_depth_map_store
+
+        Parameters
+        ----------
+        path : Path
+            Path to the stack .npy file
+        """
+        self.path = Path(path)
+        self.index = pd.read_csv(self.index_path(self.path))
+        self.means = self.index["mean"].to_numpy(dtype=np.float64)
+        self._maps = None
+
+    @staticmethod
+    def index_path(path):
+        return Path(path).with_suffix(".csv")
+
+    @property
+    def maps(self):
+        """Memory-mapped stack of depth maps, opened on first use"""
+        if self._maps is None:
+            self._maps = np.load(self.path, mmap_mode="r")
+        return self._maps
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, index):
+        return self.maps[index]
+
+    def __getstate__(self):
+        # Pickle by path, e.g. when sending the store to worker processes,
+        # instead of copying the whole stack
+        state = self.__dict__.copy()
+        state["_maps"] = None
+        return state
+
+    def items(self):
+        """References to the depth maps in the store, to use with loader"""
+        return [StoredDepthMap(self, i) for i in range(len(self))]
+
+    def matches(self, depth_map_list, image_width, image_height, dtype):
+        """Check if the store holds the given depth maps, unchanged since it
+        was built, with the given size and type"""
+        if len(self) != len(depth_map_list):
+            return False
+        try:
+            maps = self.maps
+        except (OSError, ValueError):
+            return False
+        if maps.shape[1:] != (image_height, image_width) or maps.dtype != dtype:
+            return False
+        stats = np.array([file_stat(p) for p in depth_map_list]).reshape(-1, 2)
+        return (
+            list(self.index["path"]) == [str(p) for p in depth_map_list]
+            and np.array_equal(self.index["size"].to_numpy(), stats[:, 0])
+            and np.array_equal(self.index["mtime_ns"].to_numpy(), stats[:, 1])
+        )
+
+
+def build_depth_map_store(
+    depth_map_list, path, image_width, image_height, dtype=np.float32
+):
+    """Pack depth maps, resized to the image resolution, in a DepthMapStore.
+    If a store at path already holds the same depth maps, it is reused.
+
+    Parameters
+    ----------
+    depth_map_list : list
+        Paths to the depth map .npy files
+    path : Path
+        Path to the stack .npy file
+    image_width : int
+        Image width
+    image_height : int
+        Image height
+    dtype : numpy.dtype
+        Type of the stored depth maps, e.g. float16 to halve their size
+
+    Returns
+    -------
+    DepthMapStore
+        Store holding the depth maps in the order of depth_map_list
+    """
+    path = Path(path)
+    dtype = np.dtype(dtype)
+    if path.exists() and DepthMapStore.index_path(path).exists():
+        store = DepthMapStore(path)
+        if store.matches(depth_map_list, image_width, image_height, dtype):
+            Console.info("Using depth map store", path)
+            return store
+        del store
+
+    Console.info("Packing", len(depth_map_list), "depth maps into", path)
+    tmp_path = path.with_name(path.stem + "_tmp.npy")
+    maps = np.lib.format.open_memmap(
+        tmp_path,
+        mode="w+",
+        dtype=dtype,
+        shape=(len(depth_map_list), image_height, image_width),
+    )
+
+    def pack(i):
+        depth_map = np.load(depth_map_list[i])
+        maps[i] = resize_depth_map(depth_map, image_width, image_height)
+        # Mean of the original depth map, as used for the altitude histogram
+        return depth_map.mean()
+
+    with tqdm_joblib(tqdm(desc="Packing depth maps", total=len(depth_map_list))):
+        means = joblib.Parallel(n_jobs=cpu_workers(), prefer="threads", verbose=0)(
+            joblib.delayed(pack)(i) for i in range(len(depth_map_list))
+        )
+    maps.flush()
+    maps = None
+    os.replace(tmp_path, path)
+
+    stats = np.array([file_stat(p) for p in depth_map_list]).reshape(-1, 2)
+    index = pd.DataFrame(
+        {
+            "path": [str(p) for p in depth_map_list],
+            "size": stats[:, 0],
+            "mtime_ns": stats[:, 1],
+            "mean": means,
+        }
+    )
+    index.to_csv(DepthMapStore.index_path(path), index=False)
+    return DepthMapStore(path)
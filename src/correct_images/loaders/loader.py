@@ -1,3 +1,5 @@
+import numpy as np
+
 from correct_images.loaders import default, rosbag, xviii
 from oplab import Console
 
@@ -10,6 +12,8 @@ class Loader:
         "topic",
         "bagfile_list",
         "tz_offset_s",
+        "bag_index",
+        "parallel",
     ]
 
     def __init__(self):
@@ -19,6 +23,10 @@ class Loader:
         self.topic = None
         self.tz_offset_s = 0.0
         self.bagfile_list = []
+        self.bag_index = None
+        # Decode each image with several threads. Disabled when images are
+        # loaded concurrently, e.g. by the workers of process
+        self.parallel = True
 
     def set_loader(self, loader_name):
         if loader_name == "xviii":
@@ -47,8 +55,54 @@ class Loader:
                     self.bagfile_list,
                     self.tz_offset_s,
                     self.bit_depth,
+                    self.bag_index,
+                )
+            elif self._loader_name == "xviii":
+                return self._loader(
+                    img_file, src_bit=self.bit_depth, parallel=self.parallel
                 )
             else:
                 return self._loader(img_file, src_bit=self.bit_depth)
         else:
             Console.quit("Set the bit_depth in the loader first.")
+
+    def load_uint16(self, img_file):
+        """Load an image as 16-bit integers, with the intensities of the
+        float loader in units of 2**-16. Only the default loader reads the
+        integers directly, the others convert the float image."""
+        if self.bit_depth is None:
+            Console.quit("Set the bit_depth in the loader first.")
+        if self._loader_name == "default":
+            return default.loader_uint16(img_file, src_bit=self.bit_depth)
+        image = self(img_file)
+        return (
+            np.rint(np.clip(image, 0, 1) * 2**16)
+            .clip(0, 2**16 - 1)
+            .astype(np.uint16)
+        )
+
+    def load_batch(self, img_files, out=None):
+        """Load a list of images into one stack, e.g. a preallocated memmap.
+        The images must all have the same dimensions."""
+        if self.bit_depth is None:
+            Console.quit("Set the bit_depth in the loader first.")
+        if self._loader_name == "xviii":
+            return xviii.batch_loader(img_files, src_bit=self.bit_depth, out=out)
+        if self._loader_name == "rosbag" and self.bag_index is not None:
+            # Read each bagfile once for the whole batch
+            images = rosbag.batch_loader(
+                img_files, self.bag_index, self.tz_offset_s, self.bit_depth
+            )
+            if any(image is None for image in images):
+                Console.quit("Some images of the batch are not in the bagfiles")
+            if out is None:
+                out = np.empty((len(img_files),) + images[0].shape, dtype=np.float32)
+            for i, image in enumerate(images):
+                out[i] = image
+            return out
+        for i, img_file in enumerate(img_files):
+            image = self(img_file)
+            if out is None:
+                out = np.empty((len(img_files),) + image.shape, dtype=np.float32)
+            out[i] = image
+        return out
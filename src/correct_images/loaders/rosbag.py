@@ -1,8 +1,14 @@
-from auv_nav.sensors import ros_stamp_to_epoch
-from oplab import Console
+import threading
+from pathlib import Path
 
-import numpy as np
 import cv2
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+from auv_nav.sensors import ros_stamp_to_epoch
+from correct_images.tools.manifest import file_stat
+from oplab import Console
 
 # fmt: off
 ROSBAG_IS_AVAILABLE = False
@@ -18,13 +24,213 @@ except ImportError:
 TOL = 5e-3
 SEARCH_TOL = 0.5
 
+# Bagfiles and CvBridge opened by each thread, reused across images
+_thread_data = threading.local()
+
+
+def _open_bag(bagfile):
+    if not hasattr(_thread_data, "bags"):
+        _thread_data.bags = {}
+    bag = _thread_data.bags.get(str(bagfile))
+    if bag is None:
+        bag = rosbag.Bag(str(bagfile))
+        _thread_data.bags[str(bagfile)] = bag
+    return bag
+
+
+def _bridge():
+    if not hasattr(_thread_data, "bridge"):
+        _thread_data.bridge = CvBridge()
+    return _thread_data.bridge
+
+
+def _decode(msg, src_bit):
+    type_str = str(type(msg))
+    msg_type = type_str.split(".")[1][1:-2].replace("__", "/")
+    image = None
+    if msg_type == "sensor_msgs/CompressedImage":
+        np_arr = np.frombuffer(msg.data, np.uint8)
+        image = cv2.imdecode(np_arr, cv2.IMREAD_COLOR)
+    else:
+        image = _bridge().imgmsg_to_cv2(msg, desired_encoding="passthrough")
+    return image.astype(float) * 2 ** (-src_bit)
+
+
+class BagIndex:
+    """Index of the images of a topic in a list of bagfiles.
+
+    Each row holds the header timestamp of an image, the bagfile that contains
+    it and the time it was recorded in the bagfile, so that the image can be
+    read directly instead of searching every bagfile. The index is built with
+    a single pass over the bagfiles and saved as a CSV file, which is reused
+    while the bagfiles and topic do not change.
+    """
+
+    COLUMNS = ["timestamp", "bagfile", "bag_time_ns", "bag_size", "bag_mtime_ns"]
+
+    def __init__(self, dataframe, topic):
+        """Create an index from a dataframe with the columns in COLUMNS
+
+        Parameters
+        ----------
+        dataframe : pandas.DataFrame
+            Index rows
+        topic : str
+            Image topic
+        """
+        self.dataframe = dataframe.sort_values("timestamp", kind="stable")
+        self.dataframe = self.dataframe.reset_index(drop=True)
+        self.topic = str(topic)
+        self.timestamps = self.dataframe["timestamp"].to_numpy(dtype=np.float64)
 
-def loader(img_timestamp, img_topic, bagfile_list, tz_offset_s, src_bit=8):
-    """Load an image from a ROS bagfile"""
+    def __len__(self):
+        return len(self.dataframe)
+
+    @classmethod
+    def build(cls, bagfile_list, topic):
+        """Index the images of a topic with one pass over each bagfile"""
+        if not ROSBAG_IS_AVAILABLE:
+            raise ImportError("ROS bagfile support is not available.")
+        rows = []
+        for bagfile in tqdm(bagfile_list, desc="Indexing bagfiles"):
+            size, mtime_ns = file_stat(bagfile)
+            with rosbag.Bag(str(bagfile)) as bag:
+                for _, msg, t in bag.read_messages(topics=[str(topic)]):
+                    rows.append(
+                        (
+                            ros_stamp_to_epoch(msg.header.stamp),
+                            str(bagfile),
+                            t.to_nsec(),
+                            size,
+                            mtime_ns,
+                        )
+                    )
+        return cls(pd.DataFrame(rows, columns=cls.COLUMNS), topic)
+
+    @classmethod
+    def load_or_build(cls, path, bagfile_list, topic):
+        """Load the index saved at path if it matches the bagfiles and topic.
+        Otherwise build it and save it to path."""
+        path = Path(path)
+        if path.exists():
+            dataframe = pd.read_csv(path)
+            if len(dataframe) > 0:
+                index = cls(dataframe.drop(columns="topic"), dataframe["topic"].iloc[0])
+                if index.matches(bagfile_list, topic):
+                    Console.info("Using bagfile index", path)
+                    return index
+        Console.info("Indexing", len(bagfile_list), "bagfiles for topic", topic)
+        index = cls.build(bagfile_list, topic)
+        index.save(path)
+        return index
+
+    def save(self, path):
+        dataframe = self.dataframe.copy()
+        dataframe["topic"] = self.topic
+        dataframe.to_csv(path, index=False)
+
+    def matches(self, bagfile_list, topic):
+        """Check if the index covers the given bagfiles, unchanged since it
+        was built, and topic"""
+        if str(topic) != self.topic:
+            return False
+        indexed = self.dataframe.drop_duplicates("bagfile").set_index("bagfile")
+        for bagfile in bagfile_list:
+            if str(bagfile) not in indexed.index:
+                # Bagfiles without images of the topic have no rows
+                continue
+            row = indexed.loc[str(bagfile)]
+            if (row["bag_size"], row["bag_mtime_ns"]) != file_stat(bagfile):
+                return False
+        return set(indexed.index) <= {str(b) for b in bagfile_list}
+
+    def find(self, img_timestamps, tz_offset_s=0.0):
+        """Find images by timestamp
+
+        Parameters
+        ----------
+        img_timestamps : numpy.ndarray
+            Image timestamps, in the time zone of the navigation
+        tz_offset_s : float
+            Offset of the bagfile timestamps to the navigation ones
+
+        Returns
+        -------
+        numpy.ndarray
+            Row of each image in the index, or -1 if it is not found within TOL
+        """
+        query = np.asarray(img_timestamps, dtype=np.float64).reshape(-1) + tz_offset_s
+        rows = np.full(query.shape, -1, dtype=np.int64)
+        if len(self.timestamps) == 0:
+            return rows
+        right = np.clip(np.searchsorted(self.timestamps, query), 0, len(self) - 1)
+        left = np.clip(right - 1, 0, len(self) - 1)
+        nearest = np.where(
+            np.abs(self.timestamps[left] - query)
+            <= np.abs(self.timestamps[right] - query),
+            left,
+            right,
+        )
+        found = np.abs(self.timestamps[nearest] - query) < TOL
+        rows[found] = nearest[found]
+        return rows
+
+    def order(self, img_timestamps, tz_offset_s=0.0):
+        """Order in which to read images so that each bagfile is walked once,
+        chronologically. Images not in the index go last."""
+        rows = self.find(img_timestamps, tz_offset_s)
+        bagfiles = self.dataframe["bagfile"].to_numpy(dtype=object)
+        bag_times = self.dataframe["bag_time_ns"].to_numpy(dtype=np.int64)
+        keys = [
+            (0, bagfiles[r], bag_times[r]) if r >= 0 else (1, "", i)
+            for i, r in enumerate(rows)
+        ]
+        return sorted(range(len(keys)), key=keys.__getitem__)
+
+
+def _read_indexed(bag_index, rows, img_timestamps, tz_offset_s, src_bit):
+    # Read the images at the given index rows, walking each bagfile once over
+    # the time range of the images it holds
+    images = [None] * len(rows)
+    dataframe = bag_index.dataframe
+    wanted = {}
+    for i, row in enumerate(rows):
+        if row >= 0:
+            bagfile = dataframe["bagfile"].iat[row]
+            bag_time_ns = int(dataframe["bag_time_ns"].iat[row])
+            wanted.setdefault(bagfile, {}).setdefault(bag_time_ns, []).append(i)
+    for bagfile, times in wanted.items():
+        bag = _open_bag(bagfile)
+        for _, msg, t in bag.read_messages(
+            topics=[bag_index.topic],
+            start_time=rospy.Time(0, min(times)),
+            end_time=rospy.Time(0, max(times)),
+        ):
+            epoch_timestamp = None
+            for i in times.get(t.to_nsec(), []):
+                if images[i] is not None:
+                    continue
+                if epoch_timestamp is None:
+                    epoch_timestamp = ros_stamp_to_epoch(msg.header.stamp) - tz_offset_s
+                if abs(epoch_timestamp - img_timestamps[i]) < TOL:
+                    images[i] = _decode(msg, src_bit)
+    return images
+
+
+def loader(
+    img_timestamp, img_topic, bagfile_list, tz_offset_s, src_bit=8, bag_index=None
+):
+    """Load an image from a ROS bagfile. If a BagIndex is given, the image is
+    read directly from the bagfile that contains it."""
     if not ROSBAG_IS_AVAILABLE:
         raise ImportError("ROS bagfile support is not available.")
-    bridge = CvBridge()
     img_timestamp = float(img_timestamp)
+    if bag_index is not None:
+        rows = bag_index.find([img_timestamp], tz_offset_s)
+        image = _read_indexed(bag_index, rows, [img_timestamp], tz_offset_s, src_bit)[0]
+        if image is None:
+            Console.warn("Image", img_timestamp, "not found in bagfile index.")
+        return image
     # Bagfile filtering timestamps
     start_time = rospy.Time.from_sec(img_timestamp - SEARCH_TOL + tz_offset_s)
     end_time = rospy.Time.from_sec(img_timestamp + SEARCH_TOL + tz_offset_s)
@@ -39,15 +245,37 @@ def loader(img_timestamp, img_topic, bagfile_list, tz_offset_s, src_bit=8):
                 # print(abs(epoch_timestamp - img_timestamp))
                 if abs(epoch_timestamp - img_timestamp) < TOL:
                     # print("Image found at", t.to_sec())
-                    type_str = str(type(msg))
-                    msg_type = type_str.split(".")[1][1:-2].replace("__", "/")
-                    image = None
-                    if msg_type == "sensor_msgs/CompressedImage":
-                        np_arr = np.fromstring(msg.data, np.uint8)
-                        image = cv2.imdecode(np_arr, cv2.IMREAD_COLOR)
-                    else:
-                        image = bridge.imgmsg_to_cv2(msg, desired_encoding="passthrough")
-                    image_float = image.astype(float) * 2 ** (-src_bit)
-                    return image_float
+                    return _decode(msg, src_bit)
     Console.warn("Image", img_timestamp, "not found in bagfile list.")
     return None
+
+
+def batch_loader(img_timestamps, bag_index, tz_offset_s, src_bit=8):
+    """Load several images from ROS bagfiles, reading each bagfile once in
+    chronological order
+
+    Parameters
+    ----------
+    img_timestamps : list
+        Image timestamps
+    bag_index : BagIndex
+        Index of the bagfiles
+    tz_offset_s : float
+        Offset of the bagfile timestamps to the image ones
+    src_bit : int
+        Bit depth of the images
+
+    Returns
+    -------
+    list
+        Images, as float arrays, or None for the images that are not found
+    """
+    if not ROSBAG_IS_AVAILABLE:
+        raise ImportError("ROS bagfile support is not available.")
+    img_timestamps = [float(t) for t in img_timestamps]
+    rows = bag_index.find(img_timestamps, tz_offset_s)
+    images = _read_indexed(bag_index, rows, img_timestamps, tz_offset_s, src_bit)
+    for img_timestamp, image in zip(img_timestamps, images):
+        if image is None:
+            Console.warn("Image", img_timestamp, "not found in bagfile index.")
+    return images
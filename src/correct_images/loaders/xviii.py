@@ -7,61 +7,91 @@ See LICENSE.md file in the project root for full license information.
 """
 
 import numpy as np
-from numba import njit
+from numba import njit, prange
+
+from oplab import Console
+
+
+@njit(parallel=True)
+def _unpack_xviii(groups, pixels, scale):
+    # Each group of 12 bytes holds 4 pixels of 18 bits
+    for i in prange(groups.shape[0]):
+        for j in range(groups.shape[1]):
+            g = groups[i, j]
+            pixels[i, j, 0] = scale * (
+                (np.uint32(g[3]) << 16) | (np.uint32(g[2]) << 8) | np.uint32(g[1])
+            )
+            pixels[i, j, 1] = scale * (
+                (np.uint32(g[0]) << 16) | (np.uint32(g[7]) << 8) | np.uint32(g[6])
+            )
+            pixels[i, j, 2] = scale * (
+                (np.uint32(g[5]) << 16) | (np.uint32(g[4]) << 8) | np.uint32(g[11])
+            )
+            pixels[i, j, 3] = scale * (
+                (np.uint32(g[10]) << 16) | (np.uint32(g[9]) << 8) | np.uint32(g[8])
+            )
+
+
+# Serial variant, for images loaded concurrently by several threads or processes
+_unpack_xviii_serial = njit(_unpack_xviii.py_func)
 
 
 # read binary raw image files for xviii camera
-@njit
-def load_xviii_bayer_from_binary(binary_data, image_height, image_width):
+def load_xviii_bayer_from_binary(
+    binary_data, image_height, image_width, out=None, scale=1.0, parallel=True
+):
     """Read XVIII binary images into bayer array
 
+    The data is viewed, without copying, as groups of 12 bytes that hold 4
+    pixels of 18 bits each, and the rows are unpacked in parallel unless
+    parallel is False.
+
     Parameters
     -----------
     binary_data : numpy.ndarray
-        binary image data from XVIII
+        binary image data from XVIII, as uint8. It can be a memory map, in
+        which case it is not copied
     image_height : int
         image height
     image_width : int
         image width
+    out : numpy.ndarray
+        C-contiguous float32 array of shape (image_height, image_width) to
+        write the image to. If None, a new array is allocated
+    scale : float
+        Factor applied to the pixel values
+    parallel : bool
+        Unpack the rows in parallel threads
 
     Returns
     --------
     numpy.ndarray
         Bayer image
     """
+    num_bytes = image_height * image_width * 3
+    if binary_data.size < num_bytes:
+        Console.quit(
+            "XVIII image data is too small:",
+            binary_data.size,
+            "bytes instead of",
+            num_bytes,
+        )
+    if out is None:
+        out = np.empty((image_height, image_width), dtype=np.float32)
+    groups = binary_data[:num_bytes].reshape(image_height, image_width // 4, 12)
+    unpack = _unpack_xviii if parallel else _unpack_xviii_serial
+    unpack(groups, out.reshape(image_height, image_width // 4, 4), scale)
+    return out
 
-    img_h = image_height
-    img_w = image_width
-    bayer_img = np.zeros((img_h, img_w), dtype=np.uint32)
-
-    # read raw data and put them into bayer pattern.
-    count = 0
-    for i in range(0, img_h, 1):
-        for j in range(0, img_w, 4):
-            chunk = binary_data[count : count + 12]  # noqa
-            bayer_img[i, j] = (
-                ((chunk[3] & 0xFF) << 16) | ((chunk[2] & 0xFF) << 8) | (chunk[1] & 0xFF)
-            )
-            bayer_img[i, j + 1] = (
-                ((chunk[0] & 0xFF) << 16) | ((chunk[7] & 0xFF) << 8) | (chunk[6] & 0xFF)
-            )
-            bayer_img[i, j + 2] = (
-                ((chunk[5] & 0xFF) << 16)
-                | ((chunk[4] & 0xFF) << 8)
-                | (chunk[11] & 0xFF)
-            )
-            bayer_img[i, j + 3] = (
-                ((chunk[10] & 0xFF) << 16)
-                | ((chunk[9] & 0xFF) << 8)
-                | (chunk[8] & 0xFF)
-            )
-            count += 12
-
-    bayer_img = bayer_img.astype(np.float32)
-    return bayer_img
 
-
-def loader(raw_filename, image_width=1280, image_height=1024, src_bit=18):
+def loader(
+    raw_filename,
+    image_width=1280,
+    image_height=1024,
+    src_bit=18,
+    out=None,
+    parallel=True,
+):
     """XVIII image loader
 
     Parameters
@@ -72,14 +102,57 @@ def loader(raw_filename, image_width=1280, image_height=1024, src_bit=18):
         Image height
     image_height : int
         Image height
+    src_bit : int
+        Bit depth of the image
+    out : numpy.ndarray
+        C-contiguous float32 array of shape (image_height, image_width) to
+        write the image to. If None, a new array is allocated
+    parallel : bool
+        Unpack the image in parallel threads
 
     Returns
     -------
     np.ndarray
         Loaded image in matrix form (numpy)
     """
-    binary_data = np.fromfile(raw_filename, dtype=np.uint8)
-    bayer_img = load_xviii_bayer_from_binary(binary_data[:], image_height, image_width)
+    binary_data = np.memmap(raw_filename, dtype=np.uint8, mode="r")
     # Scale down from 18 bits to unitary to process with OpenCV debayer
-    bayer_img *= 2 ** (-src_bit)
+    bayer_img = load_xviii_bayer_from_binary(
+        binary_data, image_height, image_width, out, 2 ** (-src_bit), parallel
+    )
+    del binary_data
     return bayer_img
+
+
+def batch_loader(
+    raw_filenames, image_width=1280, image_height=1024, src_bit=18, out=None
+):
+    """Load a list of XVIII images into one stack
+
+    Parameters
+    ----------
+    raw_filenames : list
+        Image file paths
+    image_width : int
+        Image height
+    image_height : int
+        Image height
+    src_bit : int
+        Bit depth of the images
+    out : numpy.ndarray
+        float32 array of shape (len(raw_filenames), image_height, image_width)
+        to write the images to, e.g. a memmap. If None, a new array is
+        allocated
+
+    Returns
+    -------
+    np.ndarray
+        Loaded images
+    """
+    if out is None:
+        out = np.empty(
+            (len(raw_filenames), image_height, image_width), dtype=np.float32
+        )
+    for i, raw_filename in enumerate(raw_filenames):
+        loader(raw_filename, image_width, image_height, src_bit, out[i])
+    return out
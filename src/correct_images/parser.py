@@ -34,6 +34,59 @@ class ColourCorrection:
         method of sampling intensity values
     window_size : int
         control how noisy the parameters can be
+    fitting_method : string
+        solver used to fit the attenuation curves ("batch" or "reference")
+    fitting_stride : int
+        size of the square pixel blocks pooled into one curve fit. Values
+        larger than 1 fit a coarse grid and upsample the parameters
+    fitting_upsampling : string
+        interpolation of the coarse parameters ("bilinear" or "bicubic")
+    fitting_validation_pixels : int
+        number of random pixels fitted at full resolution to validate the
+        upsampled parameters
+    single_pass : bool
+        compute the corrected mean and std from the altitude bin statistics
+        instead of reading all images a second time
+    histogram_bins : int
+        number of intensity bins of the approximate smoothing methods
+    fused_kernel : bool
+        apply the corrections of process in fused compiled kernels instead
+        of step by step
+    gain_cache_step : float
+        altitude step, in metres, of the cached gain maps of the altitude
+        metric. 0 (default) disables the cache
+    gain_cache_size : int
+        maximum memory of the cached gain maps, in MB
+    depth_map_store : bool
+        pack the depth maps, resized to the image resolution, in a single
+        memory-mapped stack
+    depth_map_dtype : str
+        type of the depth maps in the stack (float32 or float16)
+    memory_budget : float
+        memory, in GB, that parse can use at once, or None to use most of the
+        available memory
+    scratch_budget : float
+        scratch disk space, in GB, that parse can use at once, or None to use
+        most of the free space
+    scratch_root : str
+        folder where parse creates its memmaps, or None to use the current
+        working directory
+    scratch_dtype : str
+        type the images are stored as in the memmaps (float32, float16 or
+        uint16)
+    store_bin_statistics : bool
+        compute and save the statistics of the altitude bins, to merge them
+        later, also when the smoothing method does not use them
+    cache_images : bool
+        store every decoded image in the scratch space, so that the corrected
+        mean and std are computed without decoding the images again
+    diagnostics : str
+        how the diagnostic figures of parse are rendered (render, background,
+        data or none)
+    diagnostics_figures : list
+        diagnostic figures to store and render, or None for all of them
+    diagnostics_dpi : int
+        resolution of the diagnostic figures
     """
 
     def __init__(self, node):
@@ -96,6 +149,60 @@ class ColourCorrection:
         self.smoothing = node["smoothing"]
         self.window_size = node["window_size"]
 
+        valid_fitting_methods = ["batch", "reference"]
+        self.fitting_method = node.get("fitting_method", "batch")
+        if self.fitting_method not in valid_fitting_methods:
+            Console.error(
+                "Fitting method not valid. Please use one of the following:",
+                valid_fitting_methods,
+            )
+            Console.quit("Invalid fitting method: {}".format(self.fitting_method))
+        self.fitting_stride = int(node.get("fitting_stride", 1))
+        self.fitting_upsampling = node.get("fitting_upsampling", "bilinear")
+        self.fitting_validation_pixels = int(
+            node.get("fitting_validation_pixels", 1000)
+        )
+        if self.fitting_stride < 1:
+            Console.quit("Invalid fitting_stride:", self.fitting_stride, "(at least 1)")
+        if self.fitting_upsampling not in ["bilinear", "bicubic"]:
+            Console.quit(
+                "Invalid fitting_upsampling:",
+                self.fitting_upsampling,
+                "(bilinear or bicubic)",
+            )
+        self.single_pass = node.get("single_pass", False)
+        self.histogram_bins = int(node.get("histogram_bins", 256))
+        self.fused_kernel = node.get("fused_kernel", False)
+        self.gain_cache_step = float(node.get("gain_cache_step", 0.0))
+        self.gain_cache_size = int(node.get("gain_cache_size", 1024))
+        self.depth_map_store = node.get("depth_map_store", True)
+        self.depth_map_dtype = node.get("depth_map_dtype", "float32")
+        self.memory_budget = node.get("memory_budget", None)
+        self.scratch_budget = node.get("scratch_budget", None)
+        self.scratch_root = node.get("scratch_root", None)
+        self.scratch_dtype = node.get("scratch_dtype", "float32")
+        if self.scratch_dtype not in ["float32", "float16", "uint16"]:
+            Console.quit(
+                "Invalid scratch_dtype:",
+                self.scratch_dtype,
+                "(float32, float16 or uint16)",
+            )
+        self.store_bin_statistics = node.get("store_bin_statistics", False)
+        self.cache_images = node.get("cache_images", False)
+        self.diagnostics = node.get("diagnostics", "render")
+        self.diagnostics_figures = node.get("diagnostics_figures", None)
+        self.diagnostics_dpi = int(node.get("diagnostics_dpi", 600))
+        if self.diagnostics not in ["render", "background", "data", "none"]:
+            Console.quit(
+                "Invalid diagnostics:",
+                self.diagnostics,
+                "(render, background, data or none)",
+            )
+        if self.depth_map_dtype not in ["float32", "float16"]:
+            Console.quit(
+                "Invalid depth_map_dtype:", self.depth_map_dtype, "(float32 or float16)"
+            )
+
 
 class CameraConfig:
     """class Config creates an object for camera specific configuration
@@ -115,6 +222,12 @@ class CameraConfig:
         parameters for manual balance of images
     color_correct_matrix_rgb : matrix
         parameters for manual balance of images
+    integer_pipeline : bool
+        apply the manual balance to 16-bit integer images, without
+        converting them to float
+    priority : float
+        weight of the camera when the cameras are parsed or processed
+        concurrently, multiplied by its number of images
     """
 
     def __init__(self, node):
@@ -144,6 +257,7 @@ class CameraConfig:
 
         subtractors_rgb = np.array([0, 0, 0])
         color_gain_matrix_rgb = np.array([[1, 0, 0], [0, 1, 0], [0, 0, 1]])
+        integer_pipeline = False
         if "manual_balance" in node:
             subtractors_rgb = node.get("manual_balance", {}).get(
                 "subtractors_rgb", subtractors_rgb
@@ -151,6 +265,9 @@ class CameraConfig:
             color_gain_matrix_rgb = node.get("manual_balance", {}).get(
                 "colour_gain_matrix_rgb", color_gain_matrix_rgb
             )
+            integer_pipeline = node.get("manual_balance", {}).get(
+                "integer_pipeline", integer_pipeline
+            )
 
         self.camera_name = camera_name
         self.imagefilelist_parse = imagefilelist_parse
@@ -159,6 +276,8 @@ class CameraConfig:
         self.contrast = contrast
         self.subtractors_rgb = subtractors_rgb
         self.color_gain_matrix_rgb = color_gain_matrix_rgb
+        self.integer_pipeline = bool(integer_pipeline)
+        self.priority = float(node.get("priority", 1.0))
 
 
 class CameraConfigs:
@@ -199,6 +318,27 @@ class OutputSettings:
         flag denotes if images need to be corrected for distortion
     compression_parameter : str
         output format in which images need to be saved
+    undistort_fixed_point : bool
+        flag denotes if fixed-point remap tables are used for undistortion
+    read_workers : int
+        number of threads reading images during process
+    compute_workers : int
+        number of workers correcting images during process, or None to use
+        the CPU share of the process
+    write_workers : int
+        number of threads writing images during process
+    queue_size : int
+        maximum number of images waiting between two processing stages, or
+        None for twice compute_workers
+    fsync : bool
+        flag denotes if output images are flushed to disk once written
+    compute_backend : str
+        run the corrections in worker "processes" or in "threads"
+    shard_format : str
+        write the output images to "tar" or "zip" shards, or to one file
+        per image if "none"
+    shard_size : int
+        size of the shards, in MB
     """
 
     def __init__(self, node):
@@ -213,6 +353,27 @@ class OutputSettings:
 
         self.undistort_flag = node["undistort"]
         self.compression_parameter = node["compression_parameter"]
+        self.undistort_fixed_point = node.get("undistort_fixed_point", False)
+        self.read_workers = int(node.get("read_workers", 2))
+        self.compute_workers = node.get("compute_workers", None)
+        self.write_workers = int(node.get("write_workers", 2))
+        self.queue_size = node.get("queue_size", None)
+        self.fsync = node.get("fsync", False)
+        self.compute_backend = node.get("compute_backend", "processes")
+        if self.compute_backend not in ["threads", "processes"]:
+            Console.quit(
+                "output_settings: compute_backend must be threads or processes"
+            )
+        self.shard_format = node.get("shard_format", "none")
+        if self.shard_format not in ["none", "tar", "zip"]:
+            Console.quit("output_settings: shard_format must be none, tar or zip")
+        self.shard_size = int(node.get("shard_size", 1024))
+        for key in ["read_workers", "compute_workers", "write_workers", "queue_size"]:
+            if getattr(self, key) is None:
+                continue
+            setattr(self, key, int(getattr(self, key)))
+            if getattr(self, key) < 1:
+                Console.quit("output_settings:", key, "must be at least 1")
 
 
 class RescaleImage:
@@ -225,6 +386,10 @@ class RescaleImage:
         target_pixel_size,
         maintain_pixels,
         output_folder,
+        backend="pil",
+        output_format=None,
+        compression=None,
+        num_workers=-2,
     ):
 
         self.camera_name = camera_name
@@ -234,6 +399,10 @@ class RescaleImage:
         self.target_pixel_size = target_pixel_size / 100
         self.maintain_pixels = maintain_pixels
         self.output_folder = output_folder
+        self.backend = backend
+        self.output_format = output_format
+        self.compression = compression
+        self.num_workers = num_workers
 
 
 class CameraRescale:
@@ -257,6 +426,10 @@ class CameraRescale:
                     node[i]["target_pixel_size"],
                     node[i]["maintain_pixels"],
                     node[i]["output_folder"],
+                    node[i].get("backend", "pil"),
+                    node[i].get("output_format", None),
+                    node[i].get("compression", None),
+                    int(node[i].get("num_workers", -2)),
                 )
             )
 
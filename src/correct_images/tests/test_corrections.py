@@ -14,7 +14,27 @@ import numpy as np
 import yaml
 
 from correct_images import corrections
-from correct_images.tools.numerical import RunningMeanStd, mean_std
+from correct_images.tools.bin_statistics import compute_bin_statistics
+from correct_images.tools.curve_fitting import curve_fitting, curve_fitting_batch
+from correct_images.tools.numerical import (
+    PixelHistogram,
+    RunningMeanStd,
+    calc_mean_and_std_trimmed,
+    image_mean_std_trimmed,
+    mean_std,
+)
+
+
+def shared_cpus(seconds):
+    """Job of test_run_shared: CPUs of the job when it starts and after
+    running for some seconds"""
+    import time
+
+    from correct_images.tools.scheduler import cpu_workers
+
+    cpus = cpu_workers()
+    time.sleep(seconds)
+    return cpus, cpu_workers()
 
 
 class testCorrections(unittest.TestCase):
@@ -108,6 +128,116 @@ class testCorrections(unittest.TestCase):
             corrected_rgb[:, :, :, k] = corrected
         # TODO what do we test here?
 
+    def test_curve_fitting_batch(self):
+        rng = np.random.default_rng(0)
+        num_bins, num_pixels = 40, 30
+        altitudes = np.tile(np.linspace(2.0, 8.0, num_bins), (num_pixels, 1)).T
+        a = rng.uniform(0.3, 0.8, num_pixels)
+        b = rng.uniform(-0.5, -0.1, num_pixels)
+        c = rng.uniform(0.01, 0.05, num_pixels)
+        intensities = a * np.exp(b * altitudes) + c
+        intensities += rng.normal(0, 0.002, intensities.shape)
+        # Empty bins are stored as zeros and last pixel has no valid samples
+        altitudes[:5, :] = 0
+        intensities[:5, :] = 0
+        intensities[:, -1] = np.nan
+
+        params = curve_fitting_batch(altitudes, intensities)
+        np.testing.assert_allclose(params[-1], [1, 0, 0])
+
+        xs = np.linspace(2.0, 8.0, 20)
+        for i in range(num_pixels - 1):
+            reference = curve_fitting(altitudes[:, i], intensities[:, i], i, 0, None)
+            curve_batch = params[i, 0] * np.exp(params[i, 1] * xs) + params[i, 2]
+            curve_reference = reference[0] * np.exp(reference[1] * xs) + reference[2]
+            np.testing.assert_allclose(curve_batch, curve_reference, atol=2e-3)
+            self.assertGreaterEqual(params[i, 0], 1e-6)
+            self.assertLessEqual(params[i, 1], 0)
+            self.assertGreaterEqual(params[i, 2], 0)
+
+    def test_coarse_fitting(self):
+        rng = np.random.default_rng(0)
+        height, width, channels, num_bins = 18, 22, 2, 30
+        ys, xs = np.mgrid[0:height, 0:width]
+        # Smoothly varying parameters, as with vignetting
+        a = 0.4 + 0.05 * np.sin(xs / width * np.pi) * np.sin(ys / height * np.pi)
+        b = -0.3 + 0.05 * xs / width
+        c = 0.02 + 0.01 * ys / height
+        altitudes = np.linspace(2.0, 8.0, num_bins)
+        distances = np.tile(altitudes[:, None], (1, height * width)).astype(np.float32)
+        curves = a.reshape(-1) * np.exp(np.outer(altitudes, b.reshape(-1)))
+        curves += c.reshape(-1)
+        images = np.stack([curves, 0.8 * curves], axis=-1).astype(np.float32)
+        images += rng.normal(0, 0.001, images.shape).astype(np.float32)
+        # Empty bins are stored as zeros
+        images[:3] = 0
+        distances[:3] = 0
+
+        full = corrections.calculate_attenuation_parameters(
+            images, distances, height, width, channels, None
+        )
+        for upsampling in ["bilinear", "bicubic"]:
+            coarse = corrections.calculate_attenuation_parameters(
+                images,
+                distances,
+                height,
+                width,
+                channels,
+                None,
+                stride=4,
+                upsampling=upsampling,
+            )
+            self.assertEqual(coarse.shape, full.shape)
+            for params in [full, coarse]:
+                curve = params[..., 0] * np.exp(params[..., 1] * 5.0) + params[..., 2]
+                np.testing.assert_allclose(curve[0], a * np.exp(b * 5.0) + c, rtol=0.05)
+
+        report = corrections.validate_upsampled_parameters(
+            images, distances, coarse, height, width, channels, num_pixels=50
+        )
+        self.assertEqual(len(report), channels * 50)
+        self.assertLess(report["relative_error"].median(), 0.01)
+        self.assertLess(report["relative_error"].max(), 0.05)
+
+    def test_bag_index(self):
+        import pandas as pd
+
+        from correct_images.loaders.rosbag import BagIndex
+        from correct_images.tools.manifest import file_stat
+
+        with tempfile.TemporaryDirectory() as tmp:
+            tmp = Path(tmp)
+            bagfiles = [tmp / "a.bag", tmp / "b.bag"]
+            for bagfile in bagfiles:
+                bagfile.write_bytes(b"bag")
+            rows = []
+            for i, bagfile in enumerate(bagfiles):
+                for j in range(3):
+                    t = 100.0 + 10 * i + j
+                    rows.append(
+                        (t, str(bagfile), int(t * 1e9) + 5, *file_stat(bagfile))
+                    )
+            # Rows do not need to be sorted
+            index = BagIndex(pd.DataFrame(rows[::-1], columns=BagIndex.COLUMNS), "/cam")
+
+            tz_offset_s = 2.0
+            rows = index.find([98.0, 109.001, 99.5, 108.0], tz_offset_s)
+            self.assertEqual(rows.tolist(), [0, 4, -1, 3])
+            self.assertEqual(index.dataframe["timestamp"][rows[1]], 111.0)
+            order = index.order([109.0, 98.0, 99.5, 100.0, 108.0], tz_offset_s)
+            self.assertEqual(order, [1, 3, 4, 0, 2])
+
+            # The saved index is reused while the bagfiles do not change
+            index_path = tmp / "bag_index.csv"
+            index.save(index_path)
+            loaded = BagIndex.load_or_build(index_path, bagfiles, "/cam")
+            pd.testing.assert_frame_equal(loaded.dataframe, index.dataframe)
+            self.assertTrue(loaded.matches(bagfiles + [tmp / "empty.bag"], "/cam"))
+            self.assertFalse(loaded.matches(bagfiles, "/other"))
+            self.assertFalse(loaded.matches(bagfiles[:1], "/cam"))
+            bagfiles[1].write_bytes(b"bigger bag")
+            self.assertFalse(loaded.matches(bagfiles, "/cam"))
+
     def test_debayer(self):
         # test debayer for each bayer pattern choices:
         for i in range(len(self.bayer_pattern_choices)):
@@ -154,12 +284,238 @@ class testCorrections(unittest.TestCase):
                     "Blue channel value is incorrect",
                 )
 
+    def test_depth_map_store(self):
+        import pickle
+
+        from correct_images.loaders import depth_map
+
+        rng = np.random.default_rng(0)
+        with tempfile.TemporaryDirectory() as tmp:
+            tmp = Path(tmp)
+            depth_map_list = []
+            for i in range(3):
+                depth_map_list.append(tmp / "{}_depthmap.npy".format(i))
+                np.save(depth_map_list[-1], rng.uniform(1, 5, (4, 6)))
+            store_path = tmp / "store.npy"
+
+            store = depth_map.build_depth_map_store(depth_map_list, store_path, 12, 8)
+            self.assertEqual(store.maps.shape, (3, 8, 12))
+            for i, item in enumerate(store.items()):
+                expected = depth_map.loader(depth_map_list[i], 12, 8)
+                self.assertEqual(expected.shape, (8, 12))
+                np.testing.assert_array_equal(depth_map.loader(item, 12, 8), expected)
+                self.assertAlmostEqual(
+                    store.means[i], np.load(depth_map_list[i]).mean()
+                )
+            item = pickle.loads(pickle.dumps(store.items()[1]))
+            np.testing.assert_array_equal(depth_map.loader(item), store[1])
+
+            # The store is reused until a depth map changes
+            mtime_ns = store_path.stat().st_mtime_ns
+            store = depth_map.build_depth_map_store(depth_map_list, store_path, 12, 8)
+            self.assertEqual(store_path.stat().st_mtime_ns, mtime_ns)
+            np.save(depth_map_list[0], np.full((4, 6), 2.0))
+            store = depth_map.build_depth_map_store(
+                depth_map_list, store_path, 12, 8, np.float16
+            )
+            self.assertEqual(store.maps.dtype, np.float16)
+            np.testing.assert_array_equal(store[0], 2.0)
+            self.assertEqual(store.means[0], 2.0)
+
+    def test_diagnostics(self):
+        from correct_images.tools.diagnostics import Diagnostics, render_diagnostics
+
+        rng = np.random.default_rng(0)
+        with tempfile.TemporaryDirectory() as tmp:
+            tmp = Path(tmp)
+            diagnostics = Diagnostics(tmp, "data", ["bins", "curves"], dpi=20)
+            diagnostics.save(
+                "bins",
+                "03",
+                image=rng.random((4, 6, 3)),
+                distance=np.full((4, 6), 2.5),
+                idx_bin=3,
+                altitude=2.5,
+            )
+            diagnostics.save("parameters", "gains", gains=np.ones((3, 4, 6)))
+            diagnostics.save_curves(
+                rng.random((5, 24, 3)),
+                rng.uniform(2, 4, (5, 24)),
+                np.tile([0.5, -0.3, 0.05], (3, 4, 6, 1)),
+            )
+            # Only the figure data is stored, not the disabled figures
+            self.assertEqual(len(list((tmp / "diagnostics").glob("*.npz"))), 4)
+            self.assertEqual(len(list(tmp.glob("*.png"))), 0)
+
+            render_diagnostics(tmp, ["bins", "curves"], dpi=20, n_jobs=1)
+            self.assertTrue((tmp / "bin_image_03_02.50m.png").exists())
+            self.assertTrue((tmp / "bin_distance_sample_03_02.50m.png").exists())
+            # One curve per diagonal pixel and channel
+            curves = list(tmp.glob("intensities_curve_c_*.png"))
+            self.assertEqual(len(curves), 3 * 4)
+            self.assertFalse((tmp / "gain.png").exists())
+
+            diagnostics.reset()
+            self.assertEqual(len(list((tmp / "diagnostics").glob("*.npz"))), 0)
+            Diagnostics(tmp, "none").save("bins", "00", image=np.zeros((4, 6)))
+            self.assertEqual(len(list((tmp / "diagnostics").glob("*.npz"))), 0)
+
+    def test_fused_colour_correct(self):
+        rng = np.random.default_rng(0)
+        height, width = 16, 20
+        parameters = np.empty((3, height, width, 3), dtype=np.float32)
+        parameters[..., 0] = rng.uniform(0.5, 1.0, (3, height, width))
+        parameters[..., 1] = rng.uniform(-0.3, -0.1, (3, height, width))
+        parameters[..., 2] = rng.uniform(0.01, 0.05, (3, height, width))
+        gains = corrections.calculate_correction_gains(
+            5.0, parameters, height, width, 3
+        )
+        distance = rng.uniform(3.0, 7.0, (height, width))
+
+        for image_type in ["rgb", "bgr", "grayscale", "rggb"]:
+            shape = (
+                (height, width, 3)
+                if image_type in ["rgb", "bgr"]
+                else (
+                    height,
+                    width,
+                )
+            )
+            channels = 3 if len(shape) == 3 else 1
+            image = rng.uniform(0.0, 0.6, shape).astype(np.float32)
+            mean = rng.uniform(0.2, 0.4, shape).astype(np.float32)
+            std = rng.uniform(0.05, 0.1, shape).astype(np.float32)
+            for distance_matrix in [distance, None]:
+                # Step by step reference, as in Corrector.correct_image
+                expected = image
+                if distance_matrix is not None:
+                    expected = corrections.attenuation_correct(
+                        expected, distance_matrix, parameters[:channels], gains
+                    )
+                expected = corrections.pixel_stat(expected, mean, std, 30.0, 3.0)
+                if image_type == "rggb":
+                    expected = corrections.debayer(expected, image_type)
+                elif image_type == "rgb":
+                    expected = expected[:, :, [2, 1, 0]]
+                expected = corrections.gamma_correct(expected) * 255
+                expected = expected.clip(0, 255).astype(np.uint8)
+
+                fused = corrections.colour_correct(
+                    image,
+                    distance_matrix,
+                    parameters[:channels],
+                    gains,
+                    mean,
+                    std,
+                    30.0,
+                    3.0,
+                    image_type,
+                )
+                self.assertEqual(fused.dtype, np.uint8)
+                self.assertEqual(fused.shape, expected.shape)
+                difference = np.abs(fused.astype(int) - expected.astype(int))
+                self.assertLessEqual(difference.max(), 1)
+                self.assertGreater(np.mean(difference == 0), 0.99)
+                # The serial kernels used by the workers of process give the
+                # same output
+                serial = corrections.colour_correct(
+                    image,
+                    distance_matrix,
+                    parameters[:channels],
+                    gains,
+                    mean,
+                    std,
+                    30.0,
+                    3.0,
+                    image_type,
+                    parallel=False,
+                )
+                np.testing.assert_array_equal(serial, fused)
+
+    def test_gain_map_cache(self):
+        rng = np.random.default_rng(0)
+        height, width = 6, 8
+        parameters = np.empty((3, height, width, 3), dtype=np.float32)
+        parameters[..., 0] = rng.uniform(0.5, 1.0, (3, height, width))
+        parameters[..., 1] = rng.uniform(-0.3, -0.1, (3, height, width))
+        parameters[..., 2] = rng.uniform(0.01, 0.05, (3, height, width))
+        gains = corrections.calculate_correction_gains(
+            5.0, parameters, height, width, 3
+        )
+        map_bytes = 3 * height * width * 4
+        cache = corrections.GainMapCache(parameters, gains, 0.01, 2 * map_bytes)
+
+        image = rng.uniform(0.0, 1.0, (height, width, 3)).astype(np.float32)
+        expected = corrections.attenuation_correct(
+            image, np.full((height, width), 4.5), parameters, gains
+        )
+        np.testing.assert_allclose(
+            corrections.gain_map_correct(image, cache(4.5)), expected, rtol=1e-5
+        )
+        # 4.502 rounds to the same altitude as 4.5
+        self.assertIs(cache(4.502), cache(4.5))
+        self.assertEqual((cache.hits, cache.misses), (2, 1))
+        cache(5.0)
+        cache(6.0)
+        # The least recently used map, of 4.5 m, is dropped
+        self.assertEqual(len(cache), 2)
+        self.assertLessEqual(cache.nbytes, 2 * map_bytes)
+        cache(4.5)
+        self.assertEqual((cache.hits, cache.misses), (2, 4))
+
+        fused = corrections.colour_correct(
+            image,
+            None,
+            None,
+            None,
+            np.full(image.shape, 0.3, np.float32),
+            np.full(image.shape, 0.1, np.float32),
+            30.0,
+            3.0,
+            "bgr",
+            gain_map=cache(4.5),
+        )
+        expected = corrections.pixel_stat(expected, 0.3, 0.1, 30.0, 3.0)
+        expected = corrections.gamma_correct(expected) * 255
+        expected = expected.clip(0, 255).astype(np.uint8)
+        self.assertLessEqual(np.abs(fused.astype(int) - expected).max(), 1)
+
     def test_gamma(self):
         pass
 
     def test_manual_balance(self):
         pass
 
+    def test_manual_balance_uint16(self):
+        from imageio.v2 import imwrite
+
+        from correct_images.loaders import default
+
+        gains = np.array([[1.2, 0.05, 0.0], [0.0, 1.0, 0.02], [0.1, 0.0, 1.5]])
+        subtractors = np.array([0.02, 0.01, 0.03])
+        rgb = np.array(self.rgb_images[0], dtype=np.float32)
+        for image, image_type in [(self.image_bayer, "rggb"), (rgb, "rgb")]:
+            image16 = np.rint(image * 2**16).clip(0, 2**16 - 1).astype(np.uint16)
+            if image_type == "rggb":
+                expected = corrections.debayer(image16 * 2.0**-16, image_type)
+            else:
+                expected = image16[:, :, ::-1] * 2.0**-16
+            expected = corrections.manual_balance(expected, gains, subtractors)
+            expected = (expected * 255).clip(0, 255).astype(np.uint8)
+            balanced = corrections.manual_balance_uint16(
+                image16, gains, subtractors, image_type
+            )
+            self.assertEqual(balanced.dtype, np.uint8)
+            self.assertLessEqual(np.abs(balanced.astype(int) - expected).max(), 1)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / "image.png"
+            imwrite(path, np.left_shift(image16[:, :, 0] >> 4, 4))
+            np.testing.assert_array_equal(
+                default.loader_uint16(path, src_bit=12),
+                default.loader(path, src_bit=12) * 2**16,
+            )
+
     def test_pixel_stat(self):
         image_height, image_width, image_channels = self.rgb_images[0].shape
 
@@ -270,6 +626,84 @@ class testCorrections(unittest.TestCase):
             self.assertEqual(n, expected_image_size)
             self.assertEqual(p, 3)
 
+        # The OpenCV backend gives the same sizes and similar images
+        rng = np.random.default_rng(0)
+        img = rng.integers(0, 256, (100, 100, 3), dtype=np.uint8)
+        for maintain_pixels, target_pixel_size_m in [(False, 0.002), (True, 0.0005)]:
+            img_pil = corrections.rescale(
+                img,
+                "bilinear",
+                target_pixel_size_m,
+                altitude,
+                f_x,
+                f_y,
+                maintain_pixels,
+            )
+            img_cv = corrections.rescale(
+                img,
+                "bilinear",
+                target_pixel_size_m,
+                altitude,
+                f_x,
+                f_y,
+                maintain_pixels,
+                backend="opencv",
+            )
+            self.assertEqual(img_pil.shape, img_cv.shape)
+            self.assertLess(
+                np.abs(img_pil.astype(float) - img_cv.astype(float)).mean(), 20
+            )
+
+    def test_rescale_images(self):
+        import cv2
+        import pandas as pd
+
+        from correct_images.corrections.rescale import rescale_images
+
+        image = np.zeros((40, 60, 3), dtype=np.uint8)
+        image[:, :, 0] = 255
+        with tempfile.TemporaryDirectory() as tmp:
+            tmp = Path(tmp)
+            (tmp / "out").mkdir()
+            names = ["img_1.png", "img_10.png", "img_2.png"]
+            for name in names:
+                cv2.imwrite(str(tmp / name), image)
+            dataframe = pd.DataFrame(
+                {
+                    "relative_path": ["raw/img_1.raw", "raw/img_10.raw"],
+                    "altitude [m]": [1.0, 2.0],
+                }
+            )
+            rescale_images(
+                names,
+                tmp,
+                "bilinear",
+                0.002,
+                dataframe,
+                tmp / "out",
+                1000.0,
+                1000.0,
+                False,
+                backend="opencv",
+                output_format="jpg",
+                compression=90,
+                num_workers=1,
+            )
+            self.assertEqual(
+                sorted(p.name for p in (tmp / "out").iterdir()),
+                ["img_1.jpg", "img_10.jpg"],
+            )
+            self.assertEqual(
+                cv2.imread(str(tmp / "out" / "img_1.jpg")).shape, (20, 30, 3)
+            )
+            self.assertEqual(
+                cv2.imread(str(tmp / "out" / "img_10.jpg")).shape, (40, 60, 3)
+            )
+            # Images are read and written as RGB
+            self.assertGreater(
+                cv2.imread(str(tmp / "out" / "img_1.jpg"))[10, 15, 0], 200
+            )
+
     def test_running_mean_std(self):
         dimensions = (10, 10, 3)
         runner = RunningMeanStd(dimensions)
@@ -284,6 +718,834 @@ class testCorrections(unittest.TestCase):
         np.testing.assert_allclose(runner.mean, true_mean, atol=2)
         np.testing.assert_allclose(runner.std, true_std, atol=2)
 
+    def test_corrected_statistics(self):
+        from correct_images.tools.bin_statistics import compute_corrected_statistics
+
+        rng = np.random.default_rng(0)
+        dimensions = [4, 5, 3]
+        images = rng.uniform(0.05, 0.15, (30, 4, 5, 3)).astype(np.float32)
+        distances = rng.uniform(2, 4, 30)
+        attenuation_parameters = np.tile([0.5, -0.3, 0.05], (3, 4, 5, 1))
+        correction_gains = rng.uniform(0.5, 1, (3, 4, 5)).astype(np.float32)
+
+        runner = RunningMeanStd(dimensions)
+        for image, distance in zip(images, distances):
+            runner.compute(
+                corrections.attenuation_correct(
+                    image,
+                    np.full((4, 5), distance),
+                    attenuation_parameters,
+                    correction_gains,
+                )
+            )
+        with tempfile.TemporaryDirectory() as tmp:
+            image_list = []
+            for i, image in enumerate(images):
+                image_list.append(Path(tmp) / ("image_%02d.npy" % i))
+                np.save(image_list[-1], image)
+            results = [
+                compute_corrected_statistics(
+                    image_list,
+                    distances,
+                    np.load,
+                    attenuation_parameters,
+                    correction_gains,
+                    dimensions,
+                    chunk_size=4,
+                    n_jobs=n_jobs,
+                )
+                for n_jobs in [1, 2]
+            ]
+        self.assertEqual(results[0].count, 30)
+        np.testing.assert_allclose(results[0].mean, runner.mean, atol=1e-5)
+        np.testing.assert_allclose(results[0].std, runner.std, atol=1e-5)
+        # The chunks are merged in order whatever the number of workers
+        np.testing.assert_array_equal(results[0].mean, results[1].mean)
+        np.testing.assert_array_equal(results[0].std, results[1].std)
+
+    def test_corrected_statistics_saturated(self):
+        from correct_images.tools.bin_statistics import compute_corrected_statistics
+
+        rng = np.random.default_rng(1)
+        dimensions = [4, 5, 3]
+        images = rng.uniform(0.05, 0.15, (30, 4, 5, 3)).astype(np.float32)
+        # Saturate pixels in every chunk, including the first image of each
+        saturated = rng.random(images.shape) < 0.2
+        saturated[::4] = True
+        images[saturated] = 1.0
+        distances = rng.uniform(2, 4, 30)
+        attenuation_parameters = np.tile([0.5, -0.3, 0.05], (3, 4, 5, 1))
+        correction_gains = rng.uniform(0.5, 1, (3, 4, 5)).astype(np.float32)
+
+        runner = RunningMeanStd(dimensions)
+        corrected = []
+        for image, distance in zip(images, distances):
+            corrected.append(
+                corrections.attenuation_correct(
+                    image,
+                    np.full((4, 5), distance),
+                    attenuation_parameters,
+                    correction_gains,
+                )
+            )
+            runner.compute(corrected[-1].copy())
+        # Saturated pixels are clipped at clipping_max, not to a running mean
+        clipped = np.minimum(np.array(corrected), runner.clipping_max)
+        np.testing.assert_allclose(runner.mean, clipped.mean(axis=0), atol=1e-5)
+        with tempfile.TemporaryDirectory() as tmp:
+            image_list = []
+            for i, image in enumerate(images):
+                image_list.append(Path(tmp) / ("image_%02d.npy" % i))
+                np.save(image_list[-1], image)
+            for n_jobs in [1, 2]:
+                result = compute_corrected_statistics(
+                    image_list,
+                    distances,
+                    np.load,
+                    attenuation_parameters,
+                    correction_gains,
+                    dimensions,
+                    chunk_size=4,
+                    n_jobs=n_jobs,
+                )
+                np.testing.assert_allclose(result.mean, runner.mean, atol=1e-5)
+                np.testing.assert_allclose(result.std, runner.std, atol=1e-5)
+
+    def test_bin_statistics(self):
+        rng = np.random.default_rng(0)
+        images = rng.random((30, 4, 5, 3)).astype(np.float32)
+        bin_idxs = rng.integers(0, 3, 30)
+        bin_idxs[0] = 5  # outside of the bins
+        with tempfile.TemporaryDirectory() as tmp:
+            image_list = []
+            for i, image in enumerate(images):
+                image_list.append(Path(tmp) / ("image_%02d.npy" % i))
+                np.save(image_list[-1], image)
+            bins = compute_bin_statistics(
+                image_list, bin_idxs, 3, np.load, chunk_size=4, n_jobs=1
+            )
+            bins_2 = compute_bin_statistics(
+                image_list, bin_idxs, 3, np.load, chunk_size=4, n_jobs=2
+            )
+        self.assertEqual(sorted(bins.keys()), [0, 1, 2])
+        for idx_bin in range(3):
+            selected = images[bin_idxs == idx_bin]
+            self.assertEqual(bins[idx_bin].count, len(selected))
+            np.testing.assert_allclose(
+                bins[idx_bin].mean, selected.mean(axis=0), atol=1e-6
+            )
+            np.testing.assert_allclose(
+                bins[idx_bin].std, selected.std(axis=0), atol=1e-5
+            )
+            np.testing.assert_array_equal(bins[idx_bin].mean, bins_2[idx_bin].mean)
+
+    def test_bin_statistics_cache(self):
+        from correct_images.tools.memmap import MemmapImageLoader
+
+        rng = np.random.default_rng(0)
+        images = rng.random((30, 4, 5, 3)).astype(np.float32)
+        bin_idxs = rng.integers(0, 3, 30)
+        bin_idxs[0] = 5  # outside of the bins, but cached
+        cache_rows = np.full(30, -1)
+        cache_rows[::2] = np.arange(15)[::-1]
+        with tempfile.TemporaryDirectory() as tmp:
+            image_list = []
+            for i, image in enumerate(images):
+                image_list.append(Path(tmp) / ("image_%02d.npy" % i))
+                np.save(image_list[-1], image)
+            for dtype in [np.float32, np.float16]:
+                cache_fn = str(Path(tmp) / "cache.map")
+                np.memmap(cache_fn, dtype=dtype, mode="w+", shape=(15, 4, 5, 3))
+                cache = (cache_fn, (15, 4, 5, 3), dtype)
+                bins = compute_bin_statistics(
+                    image_list,
+                    bin_idxs,
+                    3,
+                    np.load,
+                    chunk_size=4,
+                    n_jobs=2,
+                    cache=cache,
+                    cache_rows=cache_rows,
+                )
+                # The cache does not change the statistics
+                for idx_bin in range(3):
+                    selected = images[bin_idxs == idx_bin]
+                    self.assertEqual(bins[idx_bin].count, len(selected))
+                    np.testing.assert_allclose(
+                        bins[idx_bin].mean, selected.mean(axis=0), atol=1e-6
+                    )
+                loader = MemmapImageLoader(*cache)
+                atol = 0 if dtype == np.float32 else 1e-3
+                for i in range(0, 30, 2):
+                    np.testing.assert_allclose(
+                        loader(int(cache_rows[i])), images[i], atol=atol
+                    )
+                del loader
+
+    def test_bin_statistics_histogram(self):
+        from correct_images.tools.numerical import pixel_histogram
+
+        rng = np.random.default_rng(0)
+        images = rng.random((30, 4, 5, 3)).astype(np.float32)
+        bin_idxs = rng.integers(0, 3, 30)
+        bin_idxs[0] = 5  # outside of the bins
+        with tempfile.TemporaryDirectory() as tmp:
+            image_list = []
+            for i, image in enumerate(images):
+                image_list.append(Path(tmp) / ("image_%02d.npy" % i))
+                np.save(image_list[-1], image)
+            for smoothing in ["median_approx", "mean_trimmed_approx"]:
+                for n_jobs in [1, 2]:
+                    bins = compute_bin_statistics(
+                        image_list,
+                        bin_idxs,
+                        3,
+                        np.load,
+                        chunk_size=4,
+                        n_jobs=n_jobs,
+                        smoothing=smoothing,
+                        histogram_bins=64,
+                    )
+                    for idx_bin in range(3):
+                        selected = images[bin_idxs == idx_bin]
+                        self.assertEqual(bins[idx_bin].count, len(selected))
+                        np.testing.assert_allclose(
+                            bins[idx_bin].mean, selected.mean(axis=0), atol=1e-6
+                        )
+                        # The same histogram as reading the bin on its own
+                        histogram = pixel_histogram(selected, lambda x: x, 64)
+                        if smoothing == "median_approx":
+                            expected = histogram.median
+                        else:
+                            expected = histogram.mean_trimmed()
+                        np.testing.assert_array_equal(bins[idx_bin].smoothed, expected)
+
+    def test_image_cache_plan(self):
+        import types
+
+        from correct_images.corrector import Corrector
+
+        idxs = np.repeat([0, 1, 2, -1], [30, 5, 12, 3])
+        corrector = Corrector("parse")
+        corrector.scratch = types.SimpleNamespace(dtype=np.float32)
+        corrector.smoothing = "median"
+        corrector.cache_images = True
+        cache_rows, bin_rows, corrected = corrector.plan_image_cache(idxs, 3, 20, False)
+        # Every image is cached, and the bins are sampled to 20 images
+        self.assertTrue(corrected)
+        np.testing.assert_array_equal(np.sort(cache_rows), np.arange(50))
+        self.assertEqual(bin_rows, {0: (0, 20), 2: (35, 47)})
+        self.assertTrue(np.all(idxs[np.argsort(cache_rows)[:30]] == 0))
+        self.assertTrue(np.all(idxs[np.argsort(cache_rows)[35:47]] == 2))
+        # With lossy storage only the smoothed images are cached
+        corrector.scratch.dtype = np.float16
+        cache_rows, bin_rows, corrected = corrector.plan_image_cache(idxs, 3, 20, False)
+        self.assertFalse(corrected)
+        self.assertEqual(bin_rows, {0: (0, 20), 2: (20, 32)})
+        self.assertEqual(np.count_nonzero(cache_rows >= 0), 32)
+        self.assertTrue(np.all(idxs[cache_rows >= 0] >= 0))
+        # Nothing to cache for the mean with lossy storage
+        corrector.smoothing = "mean"
+        self.assertIsNone(corrector.plan_image_cache(idxs, 3, 20, False)[0])
+        # Nor by default with float32 storage
+        corrector.scratch.dtype = np.float32
+        corrector.cache_images = False
+        self.assertIsNone(corrector.plan_image_cache(idxs, 3, 20, False)[0])
+
+    def test_merge_bin_statistics(self):
+        from correct_images.tools.bin_statistics import (
+            BinStatistics,
+            attenuation_from_bin_statistics,
+        )
+
+        rng = np.random.default_rng(0)
+        bin_edges = np.arange(2.0, 3.05, 0.1)
+        altitudes = rng.uniform(2.0, 3.0, 60)
+        bin_idxs = np.digitize(altitudes, bin_edges) - 1
+        images = 0.5 * np.exp(-0.3 * altitudes)[:, None, None, None] + 0.05
+        images = images * rng.uniform(0.95, 1.05, (60, 4, 5, 3))
+        images = images.astype(np.float32)
+        with tempfile.TemporaryDirectory() as tmp:
+            image_list = []
+            for i, image in enumerate(images):
+                image_list.append(Path(tmp) / ("image_%02d.npy" % i))
+                np.save(image_list[-1], image)
+
+            def statistics(selected, settings=None):
+                bins = compute_bin_statistics(
+                    [image_list[i] for i in selected],
+                    bin_idxs[selected],
+                    10,
+                    np.load,
+                    n_jobs=1,
+                )
+                return BinStatistics.from_images(
+                    bin_edges,
+                    (4, 5, 3),
+                    bins,
+                    bin_idxs[selected],
+                    altitudes[selected],
+                    settings,
+                )
+
+            # Two dives, saved and merged
+            settings = {"smoothing": "mean", "fitting_stride": 1}
+            statistics(np.arange(0, 25), settings).save(Path(tmp) / "a.npz")
+            statistics(np.arange(25, 60), settings).save(Path(tmp) / "b.npz")
+            merged = BinStatistics.load(Path(tmp) / "a.npz")
+            self.assertEqual(merged.settings, settings)
+            merged.merge(BinStatistics.load(Path(tmp) / "b.npz"))
+            reference = statistics(np.arange(60))
+            # Statistics of other parse settings are not merged
+            other = statistics(np.arange(25, 60), dict(settings, smoothing="median"))
+            with self.assertRaises(SystemExit):
+                BinStatistics.load(Path(tmp) / "a.npz").merge(other)
+
+        self.assertEqual(merged.count, 60)
+        self.assertEqual(merged.settings, settings)
+        self.assertEqual(sorted(merged.accumulators), sorted(reference.accumulators))
+        for idx_bin, accumulator in reference.accumulators.items():
+            np.testing.assert_allclose(
+                merged.accumulators[idx_bin].mean, accumulator.mean, atol=1e-6
+            )
+            np.testing.assert_allclose(
+                merged.accumulators[idx_bin].std, accumulator.std, atol=1e-6
+            )
+            self.assertAlmostEqual(
+                merged.distance(idx_bin), reference.distance(idx_bin)
+            )
+        attn, gains, mean, std = attenuation_from_bin_statistics(merged, min_count=2)
+        self.assertEqual(attn.shape, (3, 4, 5, 3))
+        self.assertEqual(gains.shape, (3, 4, 5))
+        self.assertEqual(mean.shape, (4, 5, 3))
+        curve = attn[..., 0] * np.exp(attn[..., 1] * 2.5) + attn[..., 2]
+        np.testing.assert_allclose(curve, 0.5 * np.exp(-0.3 * 2.5) + 0.05, rtol=0.02)
+
+    def test_call_merge(self):
+        import argparse
+        import json
+
+        from correct_images.correct_images import call_merge
+        from correct_images.tools.bin_statistics import BinStatistics
+
+        rng = np.random.default_rng(0)
+        bin_edges = np.arange(2.0, 3.05, 0.1)
+        altitudes = rng.uniform(2.0, 3.0, 40)
+        bin_idxs = np.digitize(altitudes, bin_edges) - 1
+        images = 0.5 * np.exp(-0.3 * altitudes)[:, None, None, None] + 0.05
+        images = images * rng.uniform(0.95, 1.05, (40, 4, 5, 3))
+        images = images.astype(np.float32)
+        with tempfile.TemporaryDirectory() as tmp:
+            tmp = Path(tmp)
+            image_list = []
+            for i, image in enumerate(images):
+                image_list.append(tmp / ("image_%02d.npy" % i))
+                np.save(image_list[-1], image)
+            settings = {"smoothing": "median", "fitting_method": "reference"}
+            for name, selected in [("a", np.arange(20)), ("b", np.arange(20, 40))]:
+                bins = compute_bin_statistics(
+                    [image_list[i] for i in selected],
+                    bin_idxs[selected],
+                    10,
+                    np.load,
+                    n_jobs=1,
+                )
+                BinStatistics.from_images(
+                    bin_edges,
+                    (4, 5, 3),
+                    bins,
+                    bin_idxs[selected],
+                    altitudes[selected],
+                    settings,
+                ).save(tmp / (name + ".npz"))
+            args = argparse.Namespace(
+                path=[str(tmp / "a.npz"), str(tmp / "b.npz")],
+                output=str(tmp / "merged"),
+                fitting_method="batch",
+                mean_smoothing=False,
+            )
+            # The median of the bins cannot be refitted from their statistics
+            with self.assertRaises(SystemExit):
+                call_merge(args)
+            args.mean_smoothing = True
+            call_merge(args)
+            with (tmp / "merged" / "parse_key.json").open() as f:
+                record = json.load(f)
+            merged = BinStatistics.load(tmp / "merged")
+        expected = {"smoothing": "mean", "fitting_method": "batch", "single_pass": True}
+        self.assertEqual(record["settings"], expected)
+        self.assertEqual(merged.settings, expected)
+        self.assertEqual(merged.count, 40)
+
+    def test_image_mean_std_trimmed(self):
+        rng = np.random.default_rng(0)
+        images = rng.random((51, 7, 9, 3)).astype(np.float32)
+        # Small chunks, to read the data in several passes
+        mean, std = image_mean_std_trimmed(images, 0.2, max_chunk_size=3000)
+        self.assertEqual(mean.shape, (7, 9, 3))
+        for i, j, k in [(0, 0, 0), (3, 4, 1), (6, 8, 2)]:
+            expected = calc_mean_and_std_trimmed(images[:, i, j, k], 0.2)
+            self.assertAlmostEqual(mean[i, j, k], expected[0], places=5)
+            self.assertAlmostEqual(std[i, j, k], expected[1], places=5)
+        mean, std = image_mean_std_trimmed(images[..., 0], 0)
+        np.testing.assert_allclose(mean, images[..., 0].mean(axis=0), atol=1e-6)
+        np.testing.assert_allclose(std, images[..., 0].std(axis=0), atol=1e-6)
+
+    def test_image_index(self):
+        import pandas as pd
+
+        from correct_images.tools.image_index import build_image_index, merge_filelist
+
+        with tempfile.TemporaryDirectory() as tmp:
+            tmp = Path(tmp)
+            (tmp / "dive" / "cam").mkdir(parents=True)
+            for name in ["a.raw", "b.raw", "c.raw", "d.raw"]:
+                (tmp / "dive" / "cam" / name).write_bytes(b"raw")
+            dataframe = pd.DataFrame(
+                {
+                    "relative_path": [
+                        "dive/cam/a.raw",
+                        "dive/cam/missing.raw",
+                        "dive/cam/b.raw",
+                        str(tmp / "dive" / "cam" / "c.raw"),
+                        "dive/cam/d.raw",
+                        "other/e.raw",
+                    ],
+                    "altitude [m]": ["2.0", "2.0", "None", "3.0", "20.0", "2.0"],
+                }
+            )
+            index, num_images = build_image_index(dataframe, tmp, 1.0, 10.0)
+            self.assertEqual(num_images, 3)
+            self.assertEqual(list(index.index), [0, 3])
+            self.assertEqual(list(index["altitude [m]"]), [2.0, 3.0])
+            self.assertEqual(
+                [Path(p) for p in index["image_path"]],
+                [tmp / "dive" / "cam" / "a.raw", tmp / "dive" / "cam" / "c.raw"],
+            )
+            index, num_images = build_image_index(
+                dataframe, tmp, 1.0, 10.0, check_exists=False
+            )
+            self.assertEqual(list(index.index), [0, 1, 3, 5])
+
+            output_df = merge_filelist(
+                dataframe, [tmp / "out" / "c.png", None, tmp / "out" / "a.png"], tmp
+            )
+            self.assertEqual(list(output_df.index), [0, 3])
+            self.assertEqual(list(output_df["relative_path"]), ["a.png", "c.png"])
+            self.assertEqual(
+                [Path(p) for p in output_df["raw_relative_path"]],
+                [Path("dive/cam/a.raw"), Path("dive/cam/c.raw")],
+            )
+
+    def test_manifest(self):
+        import os
+
+        from correct_images.tools.manifest import Manifest
+
+        with tempfile.TemporaryDirectory() as tmp:
+            tmp = Path(tmp)
+            image_path = tmp / "image.raw"
+            image_path.write_bytes(b"raw")
+            output_path = tmp / "corrected" / "image.png"
+            output_path.parent.mkdir()
+            output_path.write_bytes(b"png")
+
+            manifest = Manifest(output_path.parent / "manifest.csv")
+            self.assertIsNone(manifest.output_path(image_path, "abc"))
+            manifest.add(image_path, "abc", output_path)
+
+            manifest = Manifest(output_path.parent / "manifest.csv", resume=True)
+            self.assertEqual(manifest.output_path(image_path, "abc"), output_path)
+            # Different configuration
+            self.assertIsNone(manifest.output_path(image_path, "def"))
+            # Modified input
+            stat = image_path.stat()
+            os.utime(image_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+            self.assertIsNone(manifest.output_path(image_path, "abc"))
+            manifest.add(image_path, "abc", output_path)
+            self.assertEqual(manifest.output_path(image_path, "abc"), output_path)
+            # Missing output
+            output_path.unlink()
+            self.assertIsNone(manifest.output_path(image_path, "abc"))
+
+            manifest = Manifest(output_path.parent / "manifest.csv", resume=False)
+            self.assertEqual(len(manifest.entries), 0)
+
+            # Images in a ROS bagfile are identified by their timestamp
+            output_path.write_bytes(b"png")
+            self.assertIsNone(manifest.output_path(1600000000.5, "abc"))
+            manifest.add(1600000000.5, "abc", output_path)
+            manifest = Manifest(output_path.parent / "manifest.csv", resume=True)
+            self.assertEqual(manifest.output_path(1600000000.5, "abc"), output_path)
+
+    def test_scheduler(self):
+        import threading
+        import time
+        from concurrent.futures import ThreadPoolExecutor
+
+        from correct_images.tools.scheduler import (
+            Task,
+            estimate_bin_footprint,
+            max_bin_images,
+            run_scheduled,
+        )
+
+        memory, scratch = estimate_bin_footprint(100, 10, 20, 3, "median")
+        self.assertEqual(scratch, 100 * 10 * 20 * 3 * 4)
+        self.assertGreater(memory, estimate_bin_footprint(100, 10, 20, 3, "mean")[0])
+        n = max_bin_images(memory, 10**12, 1000, 10, 20, 3, "median")
+        self.assertEqual(n, 100)
+        self.assertEqual(max_bin_images(0, 0, 1000, 10, 20, 3, "median"), 0)
+
+        sizes = {"a": 6, "b": 5, "c": 4, "d": 2, "e": 1, "huge": 12}
+        tasks = [Task(key, size, 0) for key, size in sizes.items()]
+        lock = threading.Lock()
+        state = {"memory": 0, "peak": 0, "started": []}
+
+        def work(key):
+            with lock:
+                state["started"].append(key)
+                state["memory"] += sizes[key]
+                if key != "huge":
+                    state["peak"] = max(state["peak"], state["memory"])
+            time.sleep(0.02)
+            with lock:
+                state["memory"] -= sizes[key]
+            return key * 2
+
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            results = run_scheduled(
+                tasks, lambda key: executor.submit(work, key), 10, 0, 3, "test"
+            )
+        self.assertEqual(results, {key: key * 2 for key in sizes})
+        # The task larger than the budget runs first, on its own
+        self.assertEqual(state["started"][:2], ["huge", "a"])
+        self.assertLessEqual(state["peak"], 10)
+
+    def test_run_shared(self):
+        from correct_images.tools.scheduler import cpu_workers, run_shared
+
+        # Heavier jobs get more CPUs, and the CPUs of a finished job go to the
+        # jobs that still run
+        jobs = [(1, (4.0,)), (3, (2.0,))]
+        self.assertEqual(run_shared(shared_cpus, jobs, 2, cpus=8), [(2, 8), (6, 6)])
+        # One job at a time runs in this process with all the CPUs
+        jobs = [(1, ()), (3, ())]
+        self.assertEqual(run_shared(cpu_workers, jobs, 1), [cpu_workers()] * 2)
+
+    def test_shards(self):
+        import tarfile
+        import zipfile
+
+        from correct_images.tools.file_handlers import encode_output_image
+        from correct_images.tools.shards import ShardReader, ShardWriter
+
+        rng = np.random.default_rng(0)
+        images = [rng.integers(0, 256, (8, 10, 3), dtype=np.uint8) for _ in range(5)]
+        for shard_format in ["tar", "zip"]:
+            with tempfile.TemporaryDirectory() as tmp:
+                tmp = Path(tmp)
+                # Small shards, to hold about two images each
+                writer = ShardWriter(tmp, shard_format, max_shard_size=600)
+                for i, image in enumerate(images[:4]):
+                    path = writer.write(
+                        "img_{}.png".format(i), encode_output_image(image, "png")
+                    )
+                    self.assertEqual(path, tmp / "img_{}.png".format(i))
+                    self.assertTrue(writer.exists(path))
+                writer.close()
+                self.assertFalse(writer.exists(tmp / "img_4.png"))
+                # A new writer starts a new shard
+                writer = ShardWriter(tmp, shard_format, max_shard_size=600)
+                self.assertTrue(writer.exists(tmp / "img_0.png"))
+                writer.write("img_4.png", encode_output_image(images[4], "png"))
+                writer.close()
+
+                shards = sorted(tmp.glob("shard_*." + shard_format))
+                self.assertGreater(len(shards), 2)
+                reader = ShardReader(tmp)
+                self.assertEqual(len(reader), 5)
+                for i, image in enumerate(images):
+                    name = "img_{}.png".format(i)
+                    self.assertIn(name, reader)
+                    np.testing.assert_array_equal(reader.read_image(name), image)
+                # Shards are regular archives
+                names = []
+                for shard in shards:
+                    if shard_format == "tar":
+                        with tarfile.open(shard) as archive:
+                            names += archive.getnames()
+                    else:
+                        with zipfile.ZipFile(shard) as archive:
+                            names += archive.namelist()
+                self.assertEqual(sorted(names), sorted(reader.names()))
+
+    def test_parse_cache(self):
+        from correct_images.tools.parse_cache import ParseCache, inputs_key
+
+        with tempfile.TemporaryDirectory() as tmp:
+            folder = Path(tmp)
+            image = folder / "image.npy"
+            np.save(image, np.zeros(3))
+            cache = ParseCache(folder, ["attenuation_parameters.npy"])
+            settings = {"smoothing": "mean", "parse_altitude_min": 2.0}
+            record = cache.record(settings, inputs_key([image], [2.5]))
+            self.assertFalse(cache.restore(record))
+
+            np.save(folder / "attenuation_parameters.npy", np.ones(3))
+            cache.store(record)
+            self.assertEqual(cache.read()["key"], record["key"])
+            # Other settings or inputs are a miss, and parse writes new files
+            other = cache.record(settings, inputs_key([image], [2.6]))
+            self.assertNotEqual(other["key"], record["key"])
+            self.assertFalse(cache.restore(other))
+            cache.clear()
+            np.save(folder / "attenuation_parameters.npy", np.full(3, 2.0))
+            cache.store(other)
+            # Back to the first inputs, their result is restored intact
+            self.assertTrue(cache.restore(record))
+            np.testing.assert_array_equal(
+                np.load(folder / "attenuation_parameters.npy"), np.ones(3)
+            )
+            self.assertEqual(cache.read()["settings"], settings)
+
+            cache.prune(max_entries=1)
+            self.assertEqual(len(list(cache.cache_folder.iterdir())), 1)
+
+            # Images in bagfiles are keyed by their timestamp and the bagfiles
+            bagfile = folder / "dive.bag"
+            bagfile.write_bytes(b"bag")
+            key = inputs_key([1.5, 2.5], [2.5, 2.6], bagfile_list=[bagfile])
+            other = inputs_key([1.5, 3.5], [2.5, 2.6], bagfile_list=[bagfile])
+            self.assertNotEqual(key, other)
+            bagfile.write_bytes(b"modified bag")
+            other = inputs_key([1.5, 2.5], [2.5, 2.6], bagfile_list=[bagfile])
+            self.assertNotEqual(key, other)
+
+    def test_parse_settings(self):
+        import types
+
+        from correct_images.corrector import Corrector
+        from correct_images.tools.parse_cache import ParseCache, inputs_key
+
+        corrector = Corrector("parse")
+        for name in [
+            "camera_name",
+            "correction_method",
+            "distance_metric",
+            "parse_altitude_min",
+            "parse_altitude_max",
+            "window_size",
+            "fitting_method",
+            "fitting_stride",
+            "fitting_upsampling",
+            "single_pass",
+            "histogram_bins",
+            "depth_map_dtype",
+        ]:
+            setattr(corrector, name, None)
+        corrector.loader = types.SimpleNamespace(bit_depth=8)
+        corrector.smoothing = "median"
+        inputs = inputs_key(["image.png"], [2.5])
+
+        def key(scratch_dtype):
+            corrector.scratch_dtype = scratch_dtype
+            return ParseCache.record(corrector.parse_settings(), inputs)["key"]
+
+        # The median bins are stored at the precision of the scratch space
+        self.assertNotEqual(key("float32"), key("float16"))
+        self.assertNotEqual(key("float16"), key("uint16"))
+        # The mean does not use the scratch space
+        corrector.smoothing = "mean"
+        self.assertEqual(key("float32"), key("float16"))
+
+    def test_scratch_space(self):
+        import json
+        import subprocess
+        import sys
+
+        from correct_images.tools.memmap import (
+            SCRATCH_OWNER_FILENAME,
+            ScratchSpace,
+            create_memmap,
+            storage_scale,
+        )
+
+        with tempfile.TemporaryDirectory() as tmp:
+            images = []
+            for i, image in enumerate(self.rgb_images):
+                images.append(Path(tmp) / ("image_" + str(i) + ".npy"))
+                np.save(images[-1], image)
+
+            # Folder of a run whose process has exited
+            process = subprocess.Popen([sys.executable, "-c", "pass"])
+            process.wait()
+            stale = Path(tmp) / "scratch" / "correct_images_scratch_dead"
+            stale.mkdir(parents=True)
+            scratch = ScratchSpace(Path(tmp) / "scratch", dtype="uint16")
+            with (stale / SCRATCH_OWNER_FILENAME).open("w") as f:
+                json.dump({"host": scratch.host, "pid": process.pid}, f)
+
+            _, memmap = create_memmap(
+                images,
+                list(self.rgb_images[0].shape),
+                loader=np.load,
+                scratch=scratch,
+            )
+            self.assertFalse(stale.exists())
+            self.assertEqual(memmap.dtype, np.uint16)
+            self.assertEqual(scratch.used(), memmap.nbytes)
+            np.testing.assert_allclose(
+                memmap / storage_scale(memmap.dtype),
+                np.stack(self.rgb_images),
+                atol=0.5 / 65535,
+            )
+            del memmap
+            scratch.close()
+            self.assertFalse(scratch.folder.exists())
+
+    def test_pipeline(self):
+        import time
+
+        from correct_images.tools.pipeline import run_pipeline
+
+        def read(idx):
+            # Finish the items out of order
+            time.sleep(0.001 * (idx % 3))
+            return idx * 2
+
+        def write(idx, value):
+            if value < 0:
+                raise ValueError("negative value")
+            return value + 1
+
+        stages = [(read, 3), (lambda idx, value: value * 10, 2), (write, 2)]
+        results = run_pipeline(range(50), stages, queue_size=2)
+        self.assertEqual(results, [i * 20 + 1 for i in range(50)])
+        results = run_pipeline([7, 3, 5], stages, queue_size=2)
+        self.assertEqual(results, [141, 61, 101])
+
+        stages[1] = (lambda idx, value: -1 if idx == 17 else value, 2)
+        with self.assertRaises(ValueError):
+            run_pipeline(range(50), stages, queue_size=2)
+
+    def test_process_in_workers(self):
+        import types
+
+        from imageio.v2 import imread, imwrite
+
+        from correct_images.corrector import Corrector
+        from correct_images.loaders.loader import Loader
+
+        rng = np.random.default_rng(0)
+        with tempfile.TemporaryDirectory() as tmp:
+            tmp = Path(tmp)
+            image_list = []
+            for i in range(6):
+                image_list.append(str(tmp / ("image_" + str(i) + ".png")))
+                imwrite(image_list[-1], rng.integers(0, 256, (8, 10, 3), np.uint8))
+            corrector = Corrector("process")
+            corrector.camera_image_list = image_list
+            corrector.loader = Loader()
+            corrector.loader.set_loader("default")
+            corrector.loader.bit_depth = 8
+            corrector.camera = types.SimpleNamespace(extension="png")
+            corrector.correction_method = "colour_correction"
+            corrector.distance_metric = "uniform"
+            corrector._type = "rgb"
+            corrector.fused_kernel = False
+            corrector.image_raw_mean = rng.random((8, 10, 3)).astype(np.float32)
+            corrector.image_raw_std = np.full((8, 10, 3), 0.25, np.float32)
+            corrector.brightness = 30.0
+            corrector.contrast = 3.0
+            corrector.undistort = False
+            corrector.output_format = "png"
+            corrector.fsync = False
+            corrector.compute_workers = 2
+            corrector.write_workers = 1
+            corrector.queue_size = 2
+
+            corrector.output_images_folder = tmp / "threads"
+            corrector.output_images_folder.mkdir()
+            expected = [corrector.process_image(i) for i in range(6)]
+            corrector.output_images_folder = tmp / "processes"
+            corrector.output_images_folder.mkdir()
+            paths = corrector.process_correction_in_workers(range(6))
+            self.assertIsNotNone(corrector.image_raw_mean)
+            for path, expected_path in zip(paths, expected):
+                self.assertEqual(path.name, expected_path.name)
+                np.testing.assert_array_equal(imread(path), imread(expected_path))
+
+    def test_pixel_histogram(self):
+        dimensions = (6, 7, 3)
+        num_bins = 128
+        rng = np.random.default_rng(0)
+        images = rng.beta(2, 5, (101,) + dimensions).astype(np.float32)
+        histogram = PixelHistogram(dimensions, num_bins)
+        for image in images:
+            histogram.compute(image)
+        bin_width = 1.0 / num_bins
+        np.testing.assert_allclose(
+            histogram.median, np.median(images, axis=0), atol=bin_width
+        )
+        trimmed = histogram.mean_trimmed(0.2)
+        for i, j, k in [(0, 0, 0), (3, 4, 1), (5, 6, 2)]:
+            expected = calc_mean_and_std_trimmed(images[:, i, j, k], 0.2)[0]
+            self.assertAlmostEqual(trimmed[i, j, k], expected, delta=bin_width / 2)
+
+    def test_xviii_loader(self):
+        from correct_images.loaders import xviii
+
+        height, width = 4, 8
+        rng = np.random.default_rng(0)
+        pixels = rng.integers(0, 2**18, (height, width // 4, 4), dtype=np.uint32)
+        # High, middle and low byte of the 4 pixels of each 12-byte group
+        byte_order = [(3, 2, 1), (0, 7, 6), (5, 4, 11), (10, 9, 8)]
+        groups = np.zeros((height, width // 4, 12), dtype=np.uint8)
+        for k, (high, mid, low) in enumerate(byte_order):
+            groups[:, :, high] = pixels[:, :, k] >> 16
+            groups[:, :, mid] = (pixels[:, :, k] >> 8) & 0xFF
+            groups[:, :, low] = pixels[:, :, k] & 0xFF
+        expected = pixels.reshape(height, width).astype(np.float32) * 2 ** (-18)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            raw_files = [Path(tmp) / "image_0.raw", Path(tmp) / "image_1.raw"]
+            groups.tofile(raw_files[0])
+            groups[::-1].tofile(raw_files[1])
+            image = xviii.loader(raw_files[0], width, height)
+            np.testing.assert_array_equal(image, expected)
+            image = xviii.loader(raw_files[0], width, height, parallel=False)
+            np.testing.assert_array_equal(image, expected)
+
+            out = np.zeros((2, height, width), dtype=np.float32)
+            images = xviii.batch_loader(raw_files, width, height, out=out)
+            self.assertIs(images, out)
+            np.testing.assert_array_equal(out[0], expected)
+            np.testing.assert_array_equal(out[1], expected[::-1])
+
     def test_undistort(self):
-        # TODO
-        pass
+        from oplab import MonoCamera
+
+        monocam = MonoCamera()
+        monocam.name = "test"
+        monocam.size = (64, 48)
+        monocam.K = np.array([[60.0, 0, 32.0], [0, 60.0, 24.0], [0, 0, 1]])
+        monocam.d = np.array([[-0.2], [0.05], [0.0], [0.0], [0.0]])
+        monocam.P = np.hstack([monocam.K, np.zeros((3, 1))])
+        with tempfile.TemporaryDirectory() as tmp:
+            calibration_path = Path(tmp) / "mono_test.yaml"
+            calibration_path.write_text(monocam.to_str(write_metadata=False))
+
+            rng = np.random.default_rng(0)
+            image = rng.random((48, 64, 3)).astype(np.float32)
+            undistorted = corrections.distortion_correct(calibration_path, image)
+            undistorted_fixed = corrections.distortion_correct(
+                calibration_path, image, fixed_point=True
+            )
+            self.assertEqual(undistorted.shape, image.shape)
+            np.testing.assert_allclose(undistorted, undistorted_fixed, atol=0.05)
+            # Remap tables are reused for the same calibration file
+            maps = corrections.undistort.rectification_maps(calibration_path)
+            self.assertIs(
+                maps, corrections.undistort.rectification_maps(calibration_path)
+            )
@@ -0,0 +1,829 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (c) 2023, University of Southampton
+All rights reserved.
+Licensed under the BSD 3-Clause License.
+See LICENSE.md file in the project root for full license information.
+"""
+
+import copy
+import json
+import math
+import os
+import random
+from pathlib import Path
+
+import joblib
+import numpy as np
+from tqdm import tqdm
+
+from correct_images.corrections.attenuation import (
+    attenuation_correct,
+    calculate_attenuation_parameters,
+    calculate_correction_gains,
+)
+from correct_images.loaders import depth_map
+from correct_images.tools.memmap import store_image
+from correct_images.tools.numerical import (
+    PixelHistogram,
+    RunningMeanStd,
+    combine_mean_m2,
+)
+from correct_images.tools.scheduler import HISTOGRAM_SMOOTHING, MAX_HISTOGRAM_IMAGES
+from oplab import Console
+
+
+class BinAccumulator:
+    __slots__ = [
+        "count",
+        "mean",
+        "mean2",
+        "distance_sum",
+        "distance_count",
+        "smoothed",
+    ]
+
+    def __init__(self):
+        """Mean and variance of the images (and depth maps) of one altitude
+        bin, computed incrementally and mergeable across workers. smoothed
+        is the image of the bin given by an approximate smoothing method, if
+        the bin was read by a single task."""
+        self.count = 0
+        self.mean = None
+        self.mean2 = None
+        self.distance_sum = None
+        self.distance_count = None
+        self.smoothed = None
+
+    def add(self, image, distance=None):
+        """Add an image, and optionally its depth map, to the bin."""
+        image = image.astype(np.float32)
+        if self.mean is None:
+            self.mean = np.zeros(image.shape, dtype=np.float32)
+            self.mean2 = np.zeros(image.shape, dtype=np.float32)
+        self.count += 1
+        delta = image - self.mean
+        self.mean += delta / self.count
+        self.mean2 += delta * (image - self.mean)
+
+        if distance is not None:
+            if self.distance_sum is None:
+                self.distance_sum = np.zeros(distance.shape, dtype=np.float64)
+                self.distance_count = np.zeros(distance.shape, dtype=np.int64)
+            # Zeroes in depth maps are missing values
+            valid = distance > 0
+            self.distance_sum[valid] += distance[valid]
+            self.distance_count[valid] += 1
+
+    def merge(self, other):
+        """Merge the samples of another accumulator into this one."""
+        if other.count == 0:
+            return
+        if self.count == 0:
+            self.count = other.count
+            self.mean = other.mean
+            self.mean2 = other.mean2
+        else:
+            self.count, self.mean, self.mean2 = combine_mean_m2(
+                self.count,
+                self.mean,
+                self.mean2,
+                other.count,
+                other.mean,
+                other.mean2,
+            )
+        if other.distance_sum is not None:
+            if self.distance_sum is None:
+                self.distance_sum = other.distance_sum
+                self.distance_count = other.distance_count
+            else:
+                self.distance_sum += other.distance_sum
+                self.distance_count += other.distance_count
+        # Smoothed images can not be merged, only kept if the bin was empty
+        self.smoothed = other.smoothed if self.count == other.count else None
+
+    @property
+    def std(self):
+        """Get the standard deviation of the bin."""
+        if self.count > 1:
+            return np.sqrt(self.mean2 / self.count)
+        return None
+
+    @property
+    def distance_mean(self):
+        """Get the per-pixel mean of the non-zero depth map values."""
+        if self.distance_sum is None:
+            return None
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = self.distance_sum / self.distance_count
+        mean[self.distance_count == 0] = 0
+        return mean.astype(np.float32)
+
+
+def accumulate_bins(
+    image_list,
+    bin_idxs,
+    loader,
+    depth_map_list=None,
+    width=None,
+    height=None,
+    cache=None,
+    cache_rows=None,
+    smoothing=None,
+    histogram_bins=256,
+    histogram_mask=None,
+):
+    """Accumulate a chunk of images into the accumulators of their bins
+
+    Parameters
+    ----------
+    image_list : list
+        Images of the chunk, in the order they are read
+    bin_idxs : np.ndarray
+        Bin index of each image, or -1 to not accumulate it
+    loader : Loader
+        Image loader
+    depth_map_list : list
+        Depth maps of the chunk, or None if not using depth maps
+    width, height : int
+        Image size, used to load the depth maps
+    cache : tuple
+        Filename, shape and dtype of a memmap where the images are also
+        stored, or None
+    cache_rows : np.ndarray
+        Row of the cache of each image, or -1 to not store it
+    smoothing : str
+        median_approx or mean_trimmed_approx to also smooth each bin with a
+        per-pixel histogram, or None. The chunk must hold whole bins
+    histogram_bins : int
+        Number of histogram bins
+    histogram_mask : np.ndarray
+        Whether each image is added to the histogram of its bin
+
+    Returns
+    -------
+    dict
+        BinAccumulator for each bin found in the chunk
+    """
+    bins = {}
+    histograms = {}
+    cache_memmap = None
+    if cache is not None:
+        filename, shape, dtype = cache
+        cache_memmap = np.memmap(filename, dtype=dtype, mode="r+", shape=shape)
+    for i, image_path in enumerate(image_list):
+        image = loader(image_path)
+        if image is None:
+            continue
+        if cache_memmap is not None and cache_rows[i] >= 0:
+            store_image(cache_memmap, int(cache_rows[i]), image, width, height)
+        idx_bin = int(bin_idxs[i])
+        if idx_bin < 0:
+            continue
+        distance = None
+        if depth_map_list is not None:
+            distance = depth_map.loader(depth_map_list[i], width, height)
+        if idx_bin not in bins:
+            bins[idx_bin] = BinAccumulator()
+        bins[idx_bin].add(image, distance)
+        if smoothing is not None and histogram_mask[i]:
+            if idx_bin not in histograms:
+                histograms[idx_bin] = PixelHistogram(image.shape, histogram_bins)
+            histograms[idx_bin].compute(image)
+    if cache_memmap is not None:
+        cache_memmap.flush()
+    # Only the smoothed image is returned, as the histograms are large
+    for idx_bin, histogram in histograms.items():
+        if smoothing == "median_approx":
+            bins[idx_bin].smoothed = histogram.median
+        else:
+            bins[idx_bin].smoothed = histogram.mean_trimmed()
+    return bins
+
+
+def compute_bin_statistics(
+    image_list,
+    bin_idxs,
+    num_bins,
+    loader,
+    depth_map_list=None,
+    width=None,
+    height=None,
+    chunk_size=64,
+    n_jobs=-2,
+    cache=None,
+    cache_rows=None,
+    smoothing=None,
+    histogram_bins=256,
+):
+    """Compute the mean and std of every altitude bin reading each image once
+
+    Images are split in contiguous chunks that keep the order of the list, so
+    that each worker reads the files sequentially. Chunks are processed with
+    map_chunks and merged in order, which bounds memory and keeps the result
+    independent of the number of workers. The decoded images can also be
+    stored in a memmap in the same pass, so that later stages do not decode
+    them again, and the bins smoothed with a per-pixel histogram. In that
+    case each bin is read by a single task, to hold one histogram per worker.
+
+    Parameters
+    ----------
+    image_list : list
+        List of images
+    bin_idxs : np.ndarray
+        Bin index of each image
+    num_bins : int
+        Number of bins. Images with a bin index outside [0, num_bins) are
+        skipped
+    loader : Loader
+        Image loader
+    depth_map_list : list
+        List of depth maps, or None if not using depth maps
+    width, height : int
+        Image size, used to load the depth maps
+    chunk_size : int
+        Number of consecutive images read by a worker in one task
+    n_jobs : int
+        Number of parallel jobs, as in joblib
+    cache : tuple
+        Filename, shape and dtype of a memmap where the images are also
+        stored, resized to width x height, or None
+    cache_rows : np.ndarray
+        Row of the cache of each image, or -1 to not store it. Images outside
+        the bins are read if they have a row
+    smoothing : str
+        median_approx or mean_trimmed_approx to also smooth each bin with a
+        per-pixel histogram of at most MAX_HISTOGRAM_IMAGES random images of
+        the bin, stored in the smoothed attribute of its accumulator
+    histogram_bins : int
+        Number of histogram bins
+
+    Returns
+    -------
+    dict
+        BinAccumulator for each non-empty bin
+    """
+    bin_idxs = np.asarray(bin_idxs).reshape(-1)
+    in_bins = (bin_idxs >= 0) & (bin_idxs < num_bins)
+    if np.count_nonzero(in_bins) < len(bin_idxs):
+        Console.warn(
+            len(bin_idxs) - np.count_nonzero(in_bins),
+            "images are outside the altitude bins",
+        )
+    # Images outside the bins are not accumulated
+    bin_idxs = np.where(in_bins, bin_idxs, -1)
+    if cache_rows is not None:
+        cache_rows = np.asarray(cache_rows).reshape(-1)
+        selected = np.where(in_bins | (cache_rows >= 0))[0]
+    else:
+        selected = np.where(in_bins)[0]
+    histogram_mask = None
+    if smoothing in HISTOGRAM_SMOOTHING:
+        chunks = []
+        histogram_mask = np.ones(len(bin_idxs), dtype=bool)
+        for idx_bin in range(num_bins):
+            chunk = np.where(bin_idxs == idx_bin)[0]
+            if len(chunk) == 0:
+                continue
+            if len(chunk) > MAX_HISTOGRAM_IMAGES:
+                Console.info(
+                    "Random sampling altitude bin to", MAX_HISTOGRAM_IMAGES, "images"
+                )
+                histogram_mask[chunk] = False
+                histogram_mask[random.sample(list(chunk), MAX_HISTOGRAM_IMAGES)] = True
+            chunks.append(chunk)
+        selected = selected[bin_idxs[selected] < 0]
+    else:
+        smoothing = None
+        chunks = []
+    chunks += [
+        selected[i : i + chunk_size]  # noqa
+        for i in range(0, len(selected), chunk_size)
+    ]
+    tasks = (
+        joblib.delayed(accumulate_bins)(
+            [image_list[i] for i in chunk],
+            bin_idxs[chunk],
+            loader,
+            None if depth_map_list is None else [depth_map_list[i] for i in chunk],
+            width,
+            height,
+            cache,
+            None if cache_rows is None else cache_rows[chunk],
+            smoothing,
+            histogram_bins,
+            None if histogram_mask is None else histogram_mask[chunk],
+        )
+        for chunk in chunks
+    )
+
+    bins = {}
+    for partial in map_chunks(
+        tasks, [len(c) for c in chunks], n_jobs, "Computing bin statistics"
+    ):
+        for idx_bin, accumulator in partial.items():
+            if idx_bin not in bins:
+                bins[idx_bin] = BinAccumulator()
+            bins[idx_bin].merge(accumulator)
+    return bins
+
+
+def map_chunks(tasks, chunk_sizes, n_jobs, desc):
+    """Run one task per chunk of images in parallel and yield their results
+    in order
+
+    Tasks are run in waves of one task per worker, so that at most one
+    result per worker is held in memory before it is merged by the caller.
+
+    Parameters
+    ----------
+    tasks : iterable
+        joblib.delayed call of each chunk
+    chunk_sizes : list
+        Number of images of each chunk, for the progress bar
+    n_jobs : int
+        Number of parallel jobs, as in joblib
+    desc : str
+        Description of the progress bar
+
+    Yields
+    ------
+    object
+        Result of each task, in the order of tasks
+    """
+    tasks = iter(tasks)
+    num_workers = joblib.effective_n_jobs(n_jobs)
+    with tqdm(desc=desc, total=sum(chunk_sizes)) as pbar:
+        with joblib.Parallel(n_jobs=n_jobs, verbose=0) as parallel:
+            for wave in range(math.ceil(len(chunk_sizes) / num_workers)):
+                wave_sizes = chunk_sizes[wave * num_workers : (wave + 1) * num_workers]
+                results = parallel(next(tasks) for _ in wave_sizes)
+                for size, result in zip(wave_sizes, results):
+                    yield result
+                    pbar.update(size)
+
+
+def accumulate_corrected(
+    image_list,
+    distances,
+    loader,
+    attenuation_parameters,
+    correction_gains,
+    dimensions,
+    depth_map_list=None,
+):
+    """Correct a chunk of images and accumulate their mean and std
+
+    Parameters
+    ----------
+    image_list : list
+        Images of the chunk, in the order they are read
+    distances : np.ndarray
+        Altitude of each image, used if depth_map_list is None
+    loader : Loader
+        Image loader
+    attenuation_parameters : np.ndarray
+        Attenuation parameters
+    correction_gains : np.ndarray
+        Correction gains
+    dimensions : list
+        Image height, width and channels
+    depth_map_list : list
+        Depth maps of the chunk, or None if not using depth maps
+
+    Returns
+    -------
+    RunningMeanStd
+        Statistics of the corrected images of the chunk
+    """
+    image_height, image_width = dimensions[:2]
+    runner = RunningMeanStd(dimensions)
+    for i, image_path in enumerate(image_list):
+        image = loader(image_path)
+        if depth_map_list is None:
+            distance = np.full((image_height, image_width), distances[i])
+        else:
+            distance = depth_map.loader(depth_map_list[i], image_width, image_height)
+        runner.compute(
+            attenuation_correct(
+                image, distance, attenuation_parameters, correction_gains
+            )
+        )
+    return runner
+
+
+def compute_corrected_statistics(
+    image_list,
+    distances,
+    loader,
+    attenuation_parameters,
+    correction_gains,
+    dimensions,
+    depth_map_list=None,
+    chunk_size=64,
+    n_jobs=-2,
+):
+    """Compute the mean and std of the attenuation corrected images
+
+    Contiguous chunks of images are corrected and accumulated in parallel,
+    and the accumulators are merged in the order of the chunks, so the result
+    does not depend on the number of workers.
+
+    Parameters
+    ----------
+    image_list : list
+        List of images
+    distances : np.ndarray
+        Altitude of each image, used if depth_map_list is None
+    loader : Loader
+        Image loader
+    attenuation_parameters : np.ndarray
+        Attenuation parameters
+    correction_gains : np.ndarray
+        Correction gains
+    dimensions : list
+        Image height, width and channels
+    depth_map_list : list
+        List of depth maps, or None if not using depth maps
+    chunk_size : int
+        Number of consecutive images read by a worker in one task
+    n_jobs : int
+        Number of parallel jobs, as in joblib
+
+    Returns
+    -------
+    RunningMeanStd
+        Statistics of all the corrected images
+    """
+    chunks = [
+        range(i, min(i + chunk_size, len(image_list)))
+        for i in range(0, len(image_list), chunk_size)
+    ]
+    tasks = (
+        joblib.delayed(accumulate_corrected)(
+            [image_list[i] for i in chunk],
+            None if distances is None else [distances[i] for i in chunk],
+            loader,
+            attenuation_parameters,
+            correction_gains,
+            dimensions,
+            None if depth_map_list is None else [depth_map_list[i] for i in chunk],
+        )
+        for chunk in chunks
+    )
+    runner = RunningMeanStd(dimensions)
+    for partial in map_chunks(
+        tasks, [len(c) for c in chunks], n_jobs, "Correcting images"
+    ):
+        runner.merge(partial)
+    return runner
+
+
+BIN_STATISTICS_FILENAME = "bin_statistics.npz"
+
+
+class BinStatistics:
+    """Sufficient statistics of the altitude bins of parse.
+
+    Each non-empty bin holds its BinAccumulator (number of images, per-pixel
+    mean and sum of squared differences to the mean, and with depth maps the
+    per-pixel sum and count of valid distances) and the sum of the mean
+    distance of its images. Statistics of several dives, or of several shards
+    of a dive, are merged exactly, and the attenuation parameters refitted
+    from them without reading the images again.
+
+    They are saved as a versioned npz file, with only the non-empty bins and
+    the settings of the parse run that computed them. Version 1 files have
+    no settings.
+    """
+
+    VERSION = 2
+
+    def __init__(
+        self,
+        bin_edges,
+        image_shape,
+        accumulators=None,
+        distance_sums=None,
+        settings=None,
+    ):
+        """Create the statistics of a set of bins
+
+        Parameters
+        ----------
+        bin_edges : np.ndarray
+            Edges of the altitude bins
+        image_shape : tuple
+            Height, width and channels of the images
+        accumulators : dict
+            BinAccumulator of each non-empty bin
+        distance_sums : dict
+            Sum of the mean distance of the images of each non-empty bin
+        settings : dict
+            Settings of parse, as in Corrector.parse_settings, or None if they
+            are unknown
+        """
+        self.bin_edges = np.asarray(bin_edges, dtype=np.float64)
+        self.image_shape = tuple(int(i) for i in image_shape)
+        self.accumulators = dict(accumulators or {})
+        self.distance_sums = dict(distance_sums or {})
+        self.settings = settings
+
+    @classmethod
+    def from_images(
+        cls, bin_edges, image_shape, accumulators, bin_idxs, distances, settings=None
+    ):
+        """Create the statistics from the accumulators of compute_bin_statistics
+
+        Parameters
+        ----------
+        bin_edges : np.ndarray
+            Edges of the altitude bins
+        image_shape : tuple
+            Height, width and channels of the images
+        accumulators : dict
+            BinAccumulator of each non-empty bin
+        bin_idxs : np.ndarray
+            Bin index of each image
+        distances : np.ndarray
+            Mean distance of each image
+        settings : dict
+            Settings of parse
+        """
+        bin_idxs = np.asarray(bin_idxs).reshape(-1)
+        distances = np.asarray(distances, dtype=np.float64).reshape(-1)
+        distance_sums = {
+            idx_bin: float(distances[bin_idxs == idx_bin].sum())
+            for idx_bin in accumulators
+        }
+        return cls(bin_edges, image_shape, accumulators, distance_sums, settings)
+
+    @property
+    def count(self):
+        """Number of images in all bins"""
+        return sum(a.count for a in self.accumulators.values())
+
+    def distance(self, idx_bin):
+        """Mean distance of the images of a bin"""
+        return self.distance_sums[idx_bin] / self.accumulators[idx_bin].count
+
+    def mean_distance(self):
+        """Mean distance of all images"""
+        return sum(self.distance_sums.values()) / self.count
+
+    def merge(self, other):
+        """Merge the statistics of other images, binned the same way, into
+        these ones"""
+        if self.image_shape != other.image_shape:
+            Console.quit(
+                "Cannot merge bin statistics of images of shape",
+                self.image_shape,
+                "and",
+                other.image_shape,
+            )
+        if self.bin_edges.shape != other.bin_edges.shape or not np.allclose(
+            self.bin_edges, other.bin_edges
+        ):
+            Console.quit(
+                "Cannot merge bin statistics with different altitude bins. Use the"
+                " same altitude_filter parse range for all dives."
+            )
+        if self.settings is not None and other.settings is not None:
+            changed = [
+                key
+                for key in sorted(set(self.settings) | set(other.settings))
+                if self.settings.get(key) != other.settings.get(key)
+            ]
+            for key in changed:
+                Console.warn(
+                    "  ",
+                    key,
+                    ":",
+                    self.settings.get(key),
+                    "and",
+                    other.settings.get(key),
+                )
+            if changed:
+                Console.quit(
+                    "Cannot merge bin statistics computed with other parse settings."
+                )
+        elif self.settings is not None or other.settings is not None:
+            # Statistics of version 1 files do not record their settings
+            self.settings = None
+        for idx_bin, accumulator in sorted(other.accumulators.items()):
+            if idx_bin not in self.accumulators:
+                self.accumulators[idx_bin] = BinAccumulator()
+            # Copy, as an empty accumulator takes the arrays of the merged one
+            self.accumulators[idx_bin].merge(copy.deepcopy(accumulator))
+            self.distance_sums[idx_bin] = (
+                self.distance_sums.get(idx_bin, 0.0) + other.distance_sums[idx_bin]
+            )
+        return self
+
+    def save(self, path):
+        """Save the statistics to an npz file"""
+        path = Path(path)
+        bins = sorted(self.accumulators)
+        accumulators = [self.accumulators[idx_bin] for idx_bin in bins]
+        arrays = {
+            "version": np.int64(self.VERSION),
+            "bin_edges": self.bin_edges,
+            "image_shape": np.array(self.image_shape, dtype=np.int64),
+            "bins": np.array(bins, dtype=np.int64),
+            "count": np.array([a.count for a in accumulators], dtype=np.int64),
+            "distance_sums": np.array(
+                [self.distance_sums[idx_bin] for idx_bin in bins], dtype=np.float64
+            ),
+            "mean": np.stack([a.mean for a in accumulators]),
+            "mean2": np.stack([a.mean2 for a in accumulators]),
+        }
+        if self.settings is not None:
+            arrays["settings"] = np.array(json.dumps(self.settings, default=str))
+        if accumulators and accumulators[0].distance_sum is not None:
+            arrays["distance_sum"] = np.stack([a.distance_sum for a in accumulators])
+            arrays["distance_count"] = np.stack(
+                [a.distance_count for a in accumulators]
+            )
+        # Write to a temporary file first, so that an interrupted save does
+        # not leave a truncated file
+        tmp_path = path.with_name(path.stem + ".tmp.npz")
+        np.savez(tmp_path, **arrays)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """Load statistics saved with save. path can also be the folder of
+        the correction parameters that holds them"""
+        path = Path(path)
+        if path.is_dir():
+            path = path / BIN_STATISTICS_FILENAME
+        if not path.exists():
+            Console.quit("Bin statistics not found at", path)
+        with np.load(path) as data:
+            version = int(data["version"])
+            if version > cls.VERSION:
+                Console.quit(
+                    "Bin statistics",
+                    path,
+                    "have format version",
+                    version,
+                    "but this version of correct_images reads up to version",
+                    cls.VERSION,
+                )
+            # Indexing the NpzFile reads the whole array, so each array is
+            # read once
+            count = data["count"]
+            mean = data["mean"]
+            mean2 = data["mean2"]
+            bin_distance_sums = data["distance_sums"]
+            distance_sum = None
+            distance_count = None
+            if "distance_sum" in data:
+                distance_sum = data["distance_sum"]
+                distance_count = data["distance_count"]
+            settings = None
+            if "settings" in data:
+                settings = json.loads(str(data["settings"]))
+            accumulators = {}
+            distance_sums = {}
+            for i, idx_bin in enumerate(data["bins"]):
+                accumulator = BinAccumulator()
+                accumulator.count = int(count[i])
+                accumulator.mean = mean[i]
+                accumulator.mean2 = mean2[i]
+                if distance_sum is not None:
+                    accumulator.distance_sum = distance_sum[i]
+                    accumulator.distance_count = distance_count[i]
+                accumulators[int(idx_bin)] = accumulator
+                distance_sums[int(idx_bin)] = float(bin_distance_sums[i])
+            return cls(
+                data["bin_edges"],
+                data["image_shape"],
+                accumulators,
+                distance_sums,
+                settings,
+            )
+
+
+def corrected_statistics_from_bins(
+    bin_statistics, attenuation_parameters, correction_gains
+):
+    """Compute the mean and std of the attenuation corrected images from
+    the raw statistics of each altitude bin, without reading the images.
+
+    All images of a bin are corrected as if they were taken at the mean
+    altitude of the bin, so the result differs from reading the images
+    again by the change of the attenuation curve within one bin.
+
+    Parameters
+    ----------
+    bin_statistics : BinStatistics
+        Statistics of the altitude bins
+    attenuation_parameters : np.ndarray
+        Attenuation parameters
+    correction_gains : np.ndarray
+        Correction gains
+
+    Returns
+    -------
+    tuple
+        Mean and std of the corrected images, of shape (height, width,
+        channels)
+    """
+    image_height, image_width, _ = bin_statistics.image_shape
+    count = 0
+    mean = None
+    mean2 = None
+    for idx_bin, accumulator in sorted(bin_statistics.accumulators.items()):
+        distance_mtx = np.empty((image_height, image_width))
+        distance_mtx.fill(bin_statistics.distance(idx_bin))
+        # Correction is a per-pixel gain, so scale the bin statistics
+        scale = attenuation_correct(
+            np.ones(accumulator.mean.shape, dtype=np.float32),
+            distance_mtx,
+            attenuation_parameters,
+            correction_gains,
+        )
+        count, mean, mean2 = combine_mean_m2(
+            count,
+            mean,
+            mean2,
+            accumulator.count,
+            accumulator.mean * scale,
+            accumulator.mean2 * scale * scale,
+        )
+    std = np.sqrt(mean2 / count)
+    std[std < 1e-6] = 1e-6
+    return (
+        mean.reshape(bin_statistics.image_shape),
+        std.reshape(bin_statistics.image_shape),
+    )
+
+
+def attenuation_from_bin_statistics(
+    bin_statistics,
+    fitting_method="batch",
+    min_count=10,
+    stride=1,
+    upsampling="bilinear",
+):
+    """Fit the attenuation parameters to the mean image of each altitude bin,
+    as parse does with the mean smoothing, and compute the correction gains
+    and the corrected mean and std
+
+    Parameters
+    ----------
+    bin_statistics : BinStatistics
+        Statistics of the altitude bins
+    fitting_method : str
+        Curve fitting method, as in calculate_attenuation_parameters
+    min_count : int
+        Bins with fewer images are not used in the fit
+    stride : int
+        Fitting stride, as in calculate_attenuation_parameters
+    upsampling : str
+        Upsampling method, as in calculate_attenuation_parameters
+
+    Returns
+    -------
+    tuple
+        Attenuation parameters, correction gains, and mean and std of the
+        corrected images
+    """
+    image_height, image_width, image_channels = bin_statistics.image_shape
+    num_bins = len(bin_statistics.bin_edges) - 1
+    pixels = image_height * image_width
+    images_map = np.zeros((num_bins, pixels, image_channels), dtype=np.float32)
+    distances_map = np.zeros((num_bins, pixels), dtype=np.float32)
+    for idx_bin, accumulator in sorted(bin_statistics.accumulators.items()):
+        if accumulator.count < min_count:
+            continue
+        images_map[idx_bin] = accumulator.mean.reshape(pixels, image_channels)
+        if accumulator.distance_sum is not None:
+            distances_map[idx_bin] = accumulator.distance_mean.reshape(pixels)
+        else:
+            distances_map[idx_bin] = bin_statistics.distance(idx_bin)
+    attenuation_parameters = calculate_attenuation_parameters(
+        images_map,
+        distances_map,
+        image_height,
+        image_width,
+        image_channels,
+        None,
+        fitting_method,
+        stride=stride,
+        upsampling=upsampling,
+    )
+    target_altitude = bin_statistics.mean_distance()
+    Console.info("Computing correction gains for target altitude", target_altitude)
+    correction_gains = calculate_correction_gains(
+        target_altitude,
+        attenuation_parameters,
+        image_height,
+        image_width,
+        image_channels,
+    )
+    corrected_mean, corrected_std = corrected_statistics_from_bins(
+        bin_statistics, attenuation_parameters, correction_gains
+    )
+    return attenuation_parameters, correction_gains, corrected_mean, corrected_std
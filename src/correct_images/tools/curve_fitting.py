@@ -6,13 +6,15 @@ Licensed under the BSD 3-Clause License.
 See LICENSE.md file in the project root for full license information.
 """
 
+import math
 from pathlib import Path
 from typing import Optional
 
 import matplotlib.pyplot as plt
 import numpy as np
-from numba import njit
+from numba import njit, prange
 from scipy import optimize
+
 from oplab import Console
 
 
@@ -61,6 +63,99 @@ def residual_exp_curve(params: np.ndarray, x: np.ndarray, y: np.ndarray):
     return residual
 
 
+@njit
+def initial_parameters(altitudes: np.ndarray, intensities: np.ndarray):
+    """Compute the initial guess and the upper bound of c for the batch curve
+    fit
+
+    This is the initial guess of curve_fitting, compiled for the batch
+    kernel. Compiled code raises on division by zero, so the slope is only
+    estimated from distinct altitudes and intensities above c.
+
+    Parameters
+    -----------
+    altitudes : numpy.ndarray
+        array of positive and finite distance values
+    intensities : numpy.ndarray
+        array of positive and finite intensity values
+
+    Returns
+    --------
+    tuple
+        a, b, c initial parameters and the upper bound for c
+    """
+    eps = np.finfo(np.float64).eps
+    n = len(intensities)
+    if n == 0:
+        return 1.01, -0.01, eps, eps
+
+    c_upper_bound = intensities.min()
+    if c_upper_bound <= 0:
+        # c should be slightly greater than zero to avoid error
+        # 'Each lower bound must be strictly less than each upper bound.'
+        c_upper_bound = eps
+
+    idx_0 = int(n * 0.3)
+    idx_1 = int(n * 0.7)
+
+    int_0 = intensities[idx_0]
+    int_1 = intensities[idx_1]
+    alt_0 = altitudes[idx_0]
+    alt_1 = altitudes[idx_1]
+
+    # Avoid zero divisions
+    b = 0.0
+    c = intensities.min() * 0.5
+
+    if int_1 != c and alt_0 != alt_1:
+        b = (np.log((int_0 - c) / (int_1 - c))) / (alt_0 - alt_1)
+    a = (int_1 - c) / np.exp(b * alt_1)
+    if a <= 0 or b > 0 or not np.isfinite(a) or not np.isfinite(b):
+        a = 1.01
+        b = -0.01
+    return a, b, c, c_upper_bound
+
+
+def plot_curve_fitting(
+    altitudes: np.ndarray,
+    intensities: np.ndarray,
+    params: np.ndarray,
+    figure_path: Path,
+    dpi: int = 600,
+):
+    """Write the intensities and the fitted curve of a pixel to a figure.
+    Samples that are not finite or not positive are not plotted.
+
+    Parameters
+    -----------
+    altitudes : numpy.ndarray
+        array of distance values
+    intensities : numpy.ndarray
+        array of intensity values
+    params : numpy.ndarray
+        fitted a, b, c parameters
+    figure_path : Path
+        Path where the figure is written
+    dpi : int
+        Resolution of the figure
+    """
+    valid = (
+        np.isfinite(altitudes)
+        & np.isfinite(intensities)
+        & (altitudes > 0)
+        & (intensities > 0)
+    )
+    fig = plt.figure()
+    plt.plot(altitudes[valid], intensities[valid], "c.", label="Intensities")
+    xs = np.arange(2, 10, 0.1)
+    ys = exp_curve(xs, params[0], params[1], params[2])
+    plt.plot(xs, ys, "-m", label="Exp curve")
+    plt.plot(xs, np.ones(xs.shape[0]) * params[2], "-y", label="C term")
+    plt.legend()
+    plt.savefig(str(figure_path), dpi=dpi)
+    plt.close(fig)
+
+
 # compute attenuation correction parameters through regression
 def curve_fitting(
     altitudes: np.ndarray,
@@ -198,18 +293,193 @@ def curve_fitting(
             bounds=(bound_lower, bound_upper),
         )
         if figure_path:
-            fig = plt.figure()
-            plt.plot(altitudes_filt, intensities_filt, "c.", label="Intensities")
-            xs = np.arange(2, 10, 0.1)
-            ys = exp_curve(xs, tmp_params.x[0], tmp_params.x[1], tmp_params.x[2])
-            plt.plot(xs, ys, "-m", label="Exp curve")
-            plt.plot(xs, np.ones(xs.shape[0]) * tmp_params.x[2], "-y", label="C term")
-            plt.legend()
-            plt.savefig(str(figure_path), dpi=600)
-            plt.close(fig)
+            plot_curve_fitting(
+                altitudes_filt, intensities_filt, tmp_params.x, figure_path
+            )
 
         return tmp_params.x
     except (ValueError, UnboundLocalError) as e:
         Console.error("Value Error due to Overflow", a, b, c)
         Console.error("Parameters calculated are unoptimised because of error", e)
         return init_params
+
+
+@njit
+def _soft_l1_cost(x, y, n, a, b, c):
+    cost = 0.0
+    for k in range(n):
+        r = a * math.exp(b * x[k]) + c - y[k]
+        cost += math.sqrt(1.0 + r * r) - 1.0
+    return cost
+
+
+@njit
+def _fit_exp_curve(x, y, n, a, b, c, c_upper_bound, max_iterations, tolerance):
+    """Fit a*exp(b*x)+c with a bounded Levenberg-Marquardt using a soft-L1
+    loss through iteratively reweighted least squares"""
+    cost = _soft_l1_cost(x, y, n, a, b, c)
+    damping = 1e-3
+    for _ in range(max_iterations):
+        # Normal equations weighted by the soft-L1 loss derivative
+        h00 = h01 = h02 = h11 = h12 = h22 = 0.0
+        g0 = g1 = g2 = 0.0
+        for k in range(n):
+            e = math.exp(b * x[k])
+            r = a * e + c - y[k]
+            w = 1.0 / math.sqrt(1.0 + r * r)
+            j0 = e
+            j1 = a * x[k] * e
+            h00 += w * j0 * j0
+            h01 += w * j0 * j1
+            h02 += w * j0
+            h11 += w * j1 * j1
+            h12 += w * j1
+            h22 += w
+            g0 += w * j0 * r
+            g1 += w * j1 * r
+            g2 += w * r
+
+        accepted = False
+        new_cost = cost
+        na, nb, nc = a, b, c
+        while damping < 1e10:
+            m00 = h00 * (1.0 + damping) + 1e-12
+            m11 = h11 * (1.0 + damping) + 1e-12
+            m22 = h22 * (1.0 + damping) + 1e-12
+            # Solve the symmetric 3x3 system with Cramer's rule
+            det = (
+                m00 * (m11 * m22 - h12 * h12)
+                - h01 * (h01 * m22 - h12 * h02)
+                + h02 * (h01 * h12 - m11 * h02)
+            )
+            if det == 0.0 or not np.isfinite(det):
+                damping *= 10.0
+                continue
+            d0 = (
+                -g0 * (m11 * m22 - h12 * h12)
+                + h01 * (g1 * m22 - h12 * g2)
+                - h02 * (g1 * h12 - m11 * g2)
+            ) / det
+            d1 = (
+                -m00 * (g1 * m22 - h12 * g2)
+                + g0 * (h01 * m22 - h12 * h02)
+                - h02 * (h01 * g2 - g1 * h02)
+            ) / det
+            d2 = (
+                -m00 * (m11 * g2 - g1 * h12)
+                + h01 * (h01 * g2 - g1 * h02)
+                - g0 * (h01 * h12 - m11 * h02)
+            ) / det
+            # Project the step onto the bounds
+            na = max(a + d0, 1e-6)
+            nb = min(b + d1, 0.0)
+            nc = min(max(c + d2, 0.0), c_upper_bound)
+            new_cost = _soft_l1_cost(x, y, n, na, nb, nc)
+            if new_cost < cost:
+                accepted = True
+                damping = max(damping * 0.1, 1e-12)
+                break
+            damping *= 10.0
+        if not accepted:
+            break
+        converged = cost - new_cost <= tolerance * cost
+        a, b, c, cost = na, nb, nc, new_cost
+        if converged:
+            break
+    return a, b, c
+
+
+@njit(parallel=True)
+def _curve_fitting_batch(altitudes, intensities, max_iterations, tolerance):
+    n_samples = altitudes.shape[0]
+    n_pixels = altitudes.shape[1]
+    params = np.empty((n_pixels, 3), dtype=np.float64)
+    valid = np.zeros(n_pixels, dtype=np.bool_)
+    for i in prange(n_pixels):
+        x = np.empty(n_samples, dtype=np.float64)
+        y = np.empty(n_samples, dtype=np.float64)
+        n = 0
+        for k in range(n_samples):
+            alt = altitudes[k, i]
+            intensity = intensities[k, i]
+            if (
+                np.isfinite(alt)
+                and np.isfinite(intensity)
+                and alt > 0
+                and intensity > 0
+            ):
+                x[n] = alt
+                y[n] = intensity
+                n += 1
+        if n == 0:
+            params[i, 0] = 1.0
+            params[i, 1] = 0.0
+            params[i, 2] = 0.0
+            continue
+        valid[i] = True
+        a0, b0, c0, c_upper_bound = initial_parameters(x[:n], y[:n])
+        a, b, c = _fit_exp_curve(
+            x, y, n, a0, b0, c0, c_upper_bound, max_iterations, tolerance
+        )
+        if np.isfinite(a) and np.isfinite(b) and np.isfinite(c):
+            params[i, 0] = a
+            params[i, 1] = b
+            params[i, 2] = c
+        else:
+            params[i, 0] = a0
+            params[i, 1] = b0
+            params[i, 2] = c0
+    return params, valid
+
+
+def curve_fitting_batch(
+    altitudes: np.ndarray,
+    intensities: np.ndarray,
+    max_iterations: int = 100,
+    tolerance: float = 1e-8,
+    chunk_size: int = 262144,
+) -> np.ndarray:
+    """Compute attenuation coefficients for many pixels at once
+
+    Solves the same bounded soft-L1 problem as curve_fitting, starting from
+    the same initial guess, for every pixel in parallel. Samples that are not
+    finite or not positive are ignored, and pixels without any valid sample
+    fall back to [1, 0, 0].
+
+    Parameters
+    -----------
+    altitudes : numpy.ndarray
+        distance values with shape (samples, pixels)
+    intensities : numpy.ndarray
+        intensity values with shape (samples, pixels)
+    max_iterations : int
+        maximum number of Levenberg-Marquardt iterations per pixel
+    tolerance : float
+        relative cost reduction below which a pixel is considered converged
+    chunk_size : int
+        number of pixels loaded in memory at once
+
+    Returns
+    --------
+    numpy.ndarray
+        parameters with shape (pixels, 3)
+    """
+    n_pixels = altitudes.shape[1]
+    params = np.empty((n_pixels, 3), dtype=np.float64)
+    num_invalid = 0
+    for start in range(0, n_pixels, chunk_size):
+        end = min(start + chunk_size, n_pixels)
+        params[start:end], valid = _curve_fitting_batch(
+            np.ascontiguousarray(altitudes[:, start:end], dtype=np.float64),
+            np.ascontiguousarray(intensities[:, start:end], dtype=np.float64),
+            max_iterations,
+            tolerance,
+        )
+        num_invalid += int(np.count_nonzero(~valid))
+    if num_invalid > 0:
+        Console.warn(
+            num_invalid,
+            "pixels have no positive and finite samples. Their parameters are",
+            "set to [1, 0, 0].",
+        )
+    return params
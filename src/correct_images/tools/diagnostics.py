@@ -0,0 +1,284 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (c) 2023, University of Southampton
+All rights reserved.
+Licensed under the BSD 3-Clause License.
+See LICENSE.md file in the project root for full license information.
+"""
+
+import subprocess
+import sys
+from pathlib import Path
+
+import joblib
+import matplotlib
+import numpy as np
+from matplotlib import pyplot as plt
+from tqdm import tqdm
+
+from correct_images.corrections.attenuation import (
+    curve_figure_paths,
+    save_attenuation_plots,
+)
+from correct_images.tools.curve_fitting import exp_curve, plot_curve_fitting
+from correct_images.tools.joblib_tqdm import tqdm_joblib
+from correct_images.tools.scheduler import cpu_workers
+from oplab import Console
+
+matplotlib.use("Agg")
+
+# render: store the figure data and render it at the end of parse
+# background: store the figure data and render it in a separate process
+# data: only store the figure data, to render later with
+#       correct_images diagnostics <folder>
+# none: no diagnostics
+DIAGNOSTICS_MODES = ["render", "background", "data", "none"]
+DIAGNOSTIC_FIGURES = ["bins", "curves", "attenuation_plot", "parameters", "statistics"]
+DIAGNOSTICS_FOLDER = "diagnostics"
+
+
+class Diagnostics:
+    """Store the data of the diagnostic figures of parse and render them
+    separately from the numerical work.
+
+    Each figure, or group of figures, is saved as a small npz file in the
+    diagnostics subfolder of the output folder. Rendering reads them back and
+    writes the PNG figures to the output folder, in parallel.
+    """
+
+    def __init__(self, output_folder, mode="render", figures=None, dpi=600):
+        """Create the diagnostics of an output folder
+
+        Parameters
+        ----------
+        output_folder : Path
+            Folder where the figures are written
+        mode : str
+            One of DIAGNOSTICS_MODES
+        figures : list
+            Figures to store and render, from DIAGNOSTIC_FIGURES. Defaults to
+            all of them
+        dpi : int
+            Resolution of the rendered figures
+        """
+        if mode not in DIAGNOSTICS_MODES:
+            Console.quit(
+                "Diagnostics mode", mode, "not supported. Use", DIAGNOSTICS_MODES
+            )
+        if figures is None:
+            figures = DIAGNOSTIC_FIGURES
+        for figure in figures:
+            if figure not in DIAGNOSTIC_FIGURES:
+                Console.quit(
+                    "Diagnostic figure",
+                    figure,
+                    "not supported. Use",
+                    DIAGNOSTIC_FIGURES,
+                )
+        self.output_folder = Path(output_folder)
+        self.data_folder = self.output_folder / DIAGNOSTICS_FOLDER
+        self.mode = mode
+        self.figures = list(figures)
+        self.dpi = int(dpi)
+
+    def enabled(self, figure):
+        """Check if a figure is stored"""
+        return self.mode != "none" and figure in self.figures
+
+    def reset(self):
+        """Remove the data stored by a previous run"""
+        if self.data_folder.exists():
+            for p in self.data_folder.glob("*.npz"):
+                p.unlink()
+
+    def save(self, figure, name, **arrays):
+        """Store the data of a figure, if it is enabled
+
+        Parameters
+        ----------
+        figure : str
+            Figure type, from DIAGNOSTIC_FIGURES
+        name : str
+            Name of the data file, unique for the figure type
+        arrays : numpy.ndarray
+            Data of the figure
+        """
+        if not self.enabled(figure):
+            return
+        self.data_folder.mkdir(parents=True, exist_ok=True)
+        np.savez(self.data_folder / (figure + "__" + name + ".npz"), **arrays)
+
+    def save_curves(self, images, distances, attenuation_parameters):
+        """Store the intensities and fitted curve of the pixels on the image
+        diagonal
+
+        Parameters
+        ----------
+        images : numpy.ndarray
+            Bin images, of shape (bins, height * width, channels)
+        distances : numpy.ndarray
+            Bin distances, of shape (bins, height * width)
+        attenuation_parameters : numpy.ndarray
+            Fitted parameters, of shape (channels, height, width, 3)
+        """
+        if not self.enabled("curves"):
+            return
+        image_channels, image_height, image_width, _ = attenuation_parameters.shape
+        for i_channel in range(image_channels):
+            channel_str = "c_" + str(i_channel) + "_" if image_channels > 1 else ""
+            figure_paths = curve_figure_paths(
+                image_height, image_width, channel_str, Path()
+            )
+            pixels = [i for i, p in enumerate(figure_paths) if p is not None]
+            self.save(
+                "curves",
+                "channel_" + str(i_channel),
+                altitudes=np.asarray(distances[:, pixels]),
+                intensities=np.asarray(images[:, pixels, i_channel]),
+                params=attenuation_parameters[i_channel].reshape(-1, 3)[pixels],
+                filenames=np.array([figure_paths[i].name for i in pixels]),
+            )
+
+    def finish(self):
+        """Render the stored figures as set by the mode"""
+        if self.mode == "render":
+            render_diagnostics(
+                self.output_folder, self.figures, self.dpi, cpu_workers()
+            )
+        elif self.mode == "background":
+            log_path = self.data_folder / "render.log"
+            Console.info(
+                "Rendering diagnostic figures in the background. Log:", log_path
+            )
+            self.data_folder.mkdir(parents=True, exist_ok=True)
+            log = open(log_path, "w")
+            subprocess.Popen(
+                [
+                    sys.executable,
+                    "-m",
+                    "correct_images.correct_images",
+                    "diagnostics",
+                    str(self.output_folder),
+                    "--dpi",
+                    str(self.dpi),
+                    "--figures",
+                    *self.figures,
+                ],
+                stdout=log,
+                stderr=subprocess.STDOUT,
+                start_new_session=True,
+            )
+            log.close()
+        elif self.mode == "data":
+            Console.info(
+                "Diagnostic figure data stored in",
+                self.data_folder,
+                "Render it with: correct_images diagnostics",
+                self.output_folder,
+            )
+
+
+def _render_image(image, title, figure_path, dpi):
+    fig = plt.figure()
+    plt.imshow(image)
+    plt.colorbar()
+    plt.title(title)
+    plt.savefig(figure_path, dpi=dpi)
+    plt.close(fig)
+
+
+def _render_bin(data, output_folder, dpi):
+    idx_bin = int(data["idx_bin"])
+    altitude = float(data["altitude"])
+    _render_image(
+        data["image"],
+        f"Image bin {idx_bin}, altitude: {altitude:.2f}",
+        output_folder / f"bin_image_{idx_bin:02}_{altitude:05.2f}m.png",
+        dpi,
+    )
+    _render_image(
+        data["distance"],
+        f"Distance bin {idx_bin}, altitude: {altitude:.2f}",
+        output_folder / f"bin_distance_sample_{idx_bin:02}_{altitude:05.2f}m.png",
+        dpi,
+    )
+
+
+def _render_attenuation_plot(data, output_folder, dpi):
+    fig = plt.figure()
+    xs = np.arange(2, 10, 0.1)
+    altitudes = data["altitudes"]
+    intensities = data["intensities"]
+    params = data["params"]
+    for i_channel in range(params.shape[0]):
+        for i_pixel in range(params.shape[1]):
+            p0, p1, p2 = params[i_channel, i_pixel]
+            plt.plot(xs, exp_curve(xs, p0, p1, p2), color="black", alpha=0.1)
+            plt.plot(
+                altitudes[:, i_pixel],
+                intensities[:, i_pixel, i_channel],
+                ",",
+                color="blue",
+                alpha=0.1,
+            )
+    plt.savefig(output_folder / "attenuation_plot.png", dpi=dpi)
+    plt.close(fig)
+
+
+def _render_arrays(data, output_folder, dpi):
+    save_attenuation_plots(output_folder, dpi=dpi, **data)
+
+
+def render_diagnostics(output_folder, figures=None, dpi=600, n_jobs=-2):
+    """Render the diagnostic figures stored in the diagnostics subfolder of
+    an output folder
+
+    Parameters
+    ----------
+    output_folder : Path
+        Folder where the figures are written
+    figures : list
+        Figures to render, from DIAGNOSTIC_FIGURES. Defaults to all of them
+    dpi : int
+        Resolution of the figures
+    n_jobs : int
+        Number of parallel jobs, as in joblib
+    """
+    output_folder = Path(output_folder)
+    if figures is None:
+        figures = DIAGNOSTIC_FIGURES
+    data_folder = output_folder / DIAGNOSTICS_FOLDER
+    # Function and arguments of each figure, or group of figures
+    jobs = []
+    for p in sorted(data_folder.glob("*.npz")):
+        figure = p.stem.split("__")[0]
+        if figure not in figures:
+            continue
+        data = dict(np.load(p))
+        if figure == "bins":
+            jobs.append((_render_bin, data, output_folder, dpi))
+        elif figure == "attenuation_plot":
+            jobs.append((_render_attenuation_plot, data, output_folder, dpi))
+        elif figure == "curves":
+            # One job per figure, as there is one figure per diagonal pixel
+            for i, filename in enumerate(data["filenames"]):
+                jobs.append(
+                    (
+                        plot_curve_fitting,
+                        data["altitudes"][:, i],
+                        data["intensities"][:, i],
+                        data["params"][i],
+                        output_folder / str(filename),
+                        dpi,
+                    )
+                )
+        else:
+            jobs.append((_render_arrays, data, output_folder, dpi))
+    if not jobs:
+        Console.info("No diagnostic figures to render in", data_folder)
+        return
+    Console.info("Rendering", len(jobs), "diagnostic figures at", dpi, "dpi")
+    with tqdm_joblib(tqdm(desc="Diagnostic figures", total=len(jobs))):
+        joblib.Parallel(n_jobs=n_jobs, verbose=0)(
+            joblib.delayed(job[0])(*job[1:]) for job in jobs
+        )
@@ -6,6 +6,7 @@ Licensed under the BSD 3-Clause License.
 See LICENSE.md file in the project root for full license information.
 """
 
+import os
 import uuid
 from pathlib import Path
 
@@ -19,7 +20,9 @@ import numpy as np
 import pandas as pd
 from tqdm import tqdm
 
+from correct_images.tools.image_index import path_stems
 from correct_images.tools.joblib_tqdm import tqdm_joblib
+from correct_images.tools.scheduler import cpu_workers
 from oplab import Console
 
 
@@ -40,12 +43,8 @@ def trim_csv_files(image_files_paths, original_csv_path, trimmed_csv_path):
 
     image_name_list = get_imagename_list(image_files_paths)
     dataframe = pd.read_csv(original_csv_path)
-    image_path_list = dataframe["relative_path"]
-    trimmed_path_list = [
-        path for path in image_path_list if Path(path).stem in image_name_list
-    ]
     trimmed_dataframe = dataframe.loc[
-        dataframe["relative_path"].isin(trimmed_path_list)
+        path_stems(dataframe["relative_path"]).isin(image_name_list)
     ]
     # trimmed_dataframe.to_csv(trimmed_csv_path, index=False, header=True)
     return trimmed_dataframe
@@ -102,7 +101,7 @@ def load_memmap_from_numpyfilelist(filepath, numpyfilelist: list):
         memmap_handle[idx, ...] = np.load(numpyfilelist[idx])
 
     with tqdm_joblib(tqdm(desc="numpy images to memmap", total=len(numpyfilelist))):
-        joblib.Parallel(n_jobs=-2, verbose=0)(
+        joblib.Parallel(n_jobs=cpu_workers(), verbose=0)(
             joblib.delayed(memmap_loader)(numpyfilelist, memmap_handle, idx)
             for idx in range(len(numpyfilelist))
         )
@@ -110,9 +109,34 @@ def load_memmap_from_numpyfilelist(filepath, numpyfilelist: list):
     return memmap_path, memmap_handle
 
 
+def _channels_last(image):
+    ch = image.shape[0]
+    if ch == 3:
+        image = image.transpose((1, 2, 0))
+    return image
+
+
+def encode_output_image(image, dest_format):
+    """Encode an output image in memory, e.g. to append it to a shard
+
+    Parameters
+    -----------
+    image : numpy.ndarray
+        image data to be encoded
+    dest_format : string
+        output image format
+
+    Returns
+    --------
+    bytes
+        encoded image
+    """
+    return imwrite("<bytes>", _channels_last(image), format=dest_format)
+
+
 # save processed image in an output file with
 # given output format
-def write_output_image(image, filename, dest_path, dest_format):
+def write_output_image(image, filename, dest_path, dest_format, fsync=False):
     """Write into output images
 
     Parameters
@@ -125,12 +149,14 @@ def write_output_image(image, filename, dest_path, dest_format):
         path to the output folder
     dest_format : string
         output image format
+    fsync : bool
+        flush the file to disk before returning
     """
 
     file = filename + "." + dest_format
     file_path = dest_path / file
-    ch = image.shape[0]
-    if ch == 3:
-        image = image.transpose((1, 2, 0))
-    imwrite(file_path, image)
+    imwrite(file_path, _channels_last(image))
+    if fsync:
+        with open(file_path, "r+b") as f:
+            os.fsync(f.fileno())
     return file_path
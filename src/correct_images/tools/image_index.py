@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (c) 2023, University of Southampton
+All rights reserved.
+Licensed under the BSD 3-Clause License.
+See LICENSE.md file in the project root for full license information.
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+
+
+def path_stems(paths):
+    """Get the filenames without extension of a list of paths
+
+    Parameters
+    ----------
+    paths : list or pandas.Series
+        Paths, as strings or Path objects
+
+    Returns
+    -------
+    pandas.Series
+        Filename stems, with the index of paths if it is a Series
+    """
+    index = paths.index if isinstance(paths, pd.Series) else None
+    stems = [os.path.splitext(os.path.basename(str(p)))[0] for p in paths]
+    return pd.Series(stems, index=index, dtype=object)
+
+
+def existing_files(paths):
+    """Check which files exist, listing each of their folders only once
+    instead of querying the filesystem for every path
+
+    Parameters
+    ----------
+    paths : list
+        File paths, as strings or Path objects
+
+    Returns
+    -------
+    numpy.ndarray
+        Boolean mask of the paths that exist
+    """
+    paths = pd.Series([os.path.normpath(str(p)) for p in paths], dtype=object)
+    folders = pd.Series([os.path.dirname(p) for p in paths], dtype=object)
+    listed = []
+    for folder in folders.unique():
+        try:
+            with os.scandir(folder or os.curdir) as entries:
+                listed.extend(os.path.join(folder, entry.name) for entry in entries)
+        except OSError:
+            # The folder does not exist or cannot be read
+            pass
+    # isin builds a hash table of the listed files, so this is O(N)
+    return paths.isin(listed).to_numpy()
+
+
+def build_image_index(
+    dataframe, path_raw, altitude_min, altitude_max, check_exists=True
+):
+    """Select the images of a navigation dataframe that exist and whose
+    altitude is within the given range, using array operations only
+
+    Parameters
+    ----------
+    dataframe : pandas.DataFrame
+        Navigation dataframe with 'relative_path' and 'altitude [m]' columns
+    path_raw : Path
+        Raw folder the relative paths are relative to
+    altitude_min : float
+        Images at or below this altitude are discarded
+    altitude_max : float
+        Images at or above this altitude are discarded
+    check_exists : bool
+        Discard the images that do not exist. Set to False for images
+        stored in ROS bagfiles
+
+    Returns
+    -------
+    pandas.DataFrame
+        Rows of the selected images, with the altitude converted to float and
+        the path to each image in an 'image_path' column
+    int
+        Number of images that exist and have an altitude, before applying the
+        altitude filter
+    """
+    image_paths = np.array(
+        [os.path.join(str(path_raw), str(p)) for p in dataframe["relative_path"]],
+        dtype=object,
+    )
+    mask = np.ones(len(dataframe), dtype=bool)
+    if check_exists:
+        mask = existing_files(image_paths)
+    # Altitudes that are not numbers (e.g. 'None') become NaN
+    altitude = pd.to_numeric(dataframe["altitude [m]"], errors="coerce").to_numpy(
+        dtype=float
+    )
+    mask = mask & ~np.isnan(altitude)
+    num_valid = int(np.count_nonzero(mask))
+    mask = mask & (altitude > altitude_min) & (altitude < altitude_max)
+
+    index = dataframe[mask].copy()
+    index["altitude [m]"] = altitude[mask]
+    index["image_path"] = image_paths[mask]
+    return index, num_valid
+
+
+def merge_filelist(dataframe, output_paths, path_raw):
+    """Join a navigation dataframe with the corrected images by filename stem
+
+    Parameters
+    ----------
+    dataframe : pandas.DataFrame
+        Navigation dataframe with a 'relative_path' column
+    output_paths : list
+        Paths to the corrected images. None entries are ignored
+    path_raw : Path
+        Raw folder, to make absolute paths in the dataframe relative to it
+
+    Returns
+    -------
+    pandas.DataFrame
+        Rows of the images that were corrected, with the corrected image
+        filename in 'relative_path' and the raw image path relative to the raw
+        folder in 'raw_relative_path'
+    """
+    output_names = {}
+    for path in output_paths:
+        if path is not None:
+            # Keep the first image with a given stem
+            name = os.path.basename(str(path))
+            output_names.setdefault(os.path.splitext(name)[0], name)
+
+    raw_paths = dataframe["relative_path"]
+    names = path_stems(raw_paths).map(output_names)
+    mask = names.notna().to_numpy()
+    output_df = dataframe[mask].copy()
+    output_df["relative_path"] = names[mask].to_numpy(dtype=object)
+    output_df["raw_relative_path"] = [
+        os.path.relpath(p, str(path_raw)) if os.path.isabs(str(p)) else p
+        for p in raw_paths[mask]
+    ]
+    return output_df
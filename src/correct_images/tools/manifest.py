@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (c) 2023, University of Southampton
+All rights reserved.
+Licensed under the BSD 3-Clause License.
+See LICENSE.md file in the project root for full license information.
+"""
+
+import csv
+import os
+import threading
+from pathlib import Path
+
+from oplab import Console
+
+
+def file_stat(path):
+    """Get the size and modification time of a file, or -1 for both if it
+    is not a file (e.g. the timestamp of an image in a ROS bagfile)"""
+    if not isinstance(path, (str, os.PathLike)):
+        return -1, -1
+    try:
+        stat = os.stat(path)
+        return stat.st_size, stat.st_mtime_ns
+    except (OSError, ValueError):
+        return -1, -1
+
+
+class Manifest:
+    """Record of the images written by process, used to resume it.
+
+    Each row holds the input image path, its size and modification time, a
+    hash of the configuration and parameters used to correct it, and the
+    output image path relative to the manifest folder. Rows are appended as
+    soon as each image is written, so the manifest survives an interrupted
+    run. If an input appears several times, its last row is used.
+    """
+
+    COLUMNS = [
+        "input_path",
+        "input_size",
+        "input_mtime_ns",
+        "config_hash",
+        "output_path",
+    ]
+
+    def __init__(self, path, resume=True, output_exists=os.path.exists):
+        """Open a manifest, keeping its entries if resume is True and
+        starting a new one otherwise
+
+        Parameters
+        ----------
+        path : Path
+            Path to the manifest CSV file
+        resume : bool
+            Keep the entries of an existing manifest
+        output_exists : function
+            Check if an output image exists, e.g. in a shard
+        """
+        self.path = Path(path)
+        self.output_exists = output_exists
+        self.entries = {}
+        self._lock = threading.Lock()
+        if resume and self.path.exists():
+            with self.path.open("r", newline="") as f:
+                for row in csv.DictReader(f):
+                    self.entries[row["input_path"]] = row
+            Console.info("Loaded", len(self.entries), "entries from", self.path)
+        else:
+            with self.path.open("w", newline="") as f:
+                csv.writer(f).writerow(self.COLUMNS)
+
+    def output_path(self, input_path, config_hash):
+        """Get the output path of an input image, if it was corrected with
+        the same configuration and has not changed since. Otherwise, or if the
+        output does not exist, return None."""
+        entry = self.entries.get(str(input_path))
+        if entry is None or entry["config_hash"] != config_hash:
+            return None
+        size, mtime_ns = file_stat(input_path)
+        if int(entry["input_size"]) != size or int(entry["input_mtime_ns"]) != mtime_ns:
+            return None
+        output_path = self.path.parent / entry["output_path"]
+        if not self.output_exists(output_path):
+            return None
+        return output_path
+
+    def add(self, input_path, config_hash, output_path):
+        """Record that an input image was corrected into output_path"""
+        size, mtime_ns = file_stat(input_path)
+        row = [
+            str(input_path),
+            size,
+            mtime_ns,
+            config_hash,
+            os.path.relpath(output_path, self.path.parent),
+        ]
+        with self._lock:
+            self.entries[str(input_path)] = dict(zip(self.COLUMNS, map(str, row)))
+            with self.path.open("a", newline="") as f:
+                csv.writer(f).writerow(row)
@@ -6,16 +6,43 @@ Licensed under the BSD 3-Clause License.
 See LICENSE.md file in the project root for full license information.
 """
 
+import atexit
+import json
+import os
+import shutil
+import signal
+import socket
+import time
 import uuid
 from datetime import datetime
+from pathlib import Path
 
 import cv2
 import numpy as np
+import psutil
 
 from oplab import Console
 
 from ..loaders import default
 
+# Types the images of a memmap can be stored as, and the scale of the stored
+# values. Images are in [0, 1], so uint16 stores them as fixed point
+SCRATCH_DTYPES = {
+    "float32": (np.float32, 1.0),
+    "float16": (np.float16, 1.0),
+    "uint16": (np.uint16, float(np.iinfo(np.uint16).max)),
+}
+SCRATCH_PREFIX = "correct_images_scratch_"
+SCRATCH_OWNER_FILENAME = "owner.json"
+# Seconds between checks of the free scratch space, while waiting for it
+SCRATCH_POLL_INTERVAL = 1.0
+
+# Scratch spaces of this process that have to be removed on exit, and the
+# signal handlers replaced by the one that removes them
+_open_scratch_spaces = []
+_previous_signal_handlers = {}
+_cleanup_handlers_installed = False
+
 
 def create_memmap_name() -> str:
     filename_map = (
@@ -28,22 +55,273 @@ def create_memmap_name() -> str:
     return filename_map
 
 
-def create_memmap(image_list, dimensions, loader=default.loader):
-    filename_map = create_memmap_name()
-    Console.info("Creating memmap at", filename_map)
+def storage_scale(dtype):
+    """Scale of the values stored in a memmap of a given type: the value of
+    an image intensity of 1"""
+    if np.issubdtype(dtype, np.integer):
+        return float(np.iinfo(dtype).max)
+    return 1.0
+
+
+def encode_image(image, dtype):
+    """Convert an image in [0, 1] to the type of a memmap"""
+    if np.issubdtype(dtype, np.integer):
+        scale = storage_scale(dtype)
+        return np.rint(np.clip(image, 0.0, 1.0) * scale).astype(dtype)
+    return image.astype(dtype, copy=False)
+
+
+def _pid_alive(pid, started=None):
+    if pid is None:
+        return True
+    try:
+        process = psutil.Process(pid)
+    except psutil.NoSuchProcess:
+        return False
+    except psutil.AccessDenied:
+        return True
+    # The PID may have been reused by another process
+    return started is None or abs(process.create_time() - started) < 1.0
+
+
+def _close_open_scratch_spaces():
+    for scratch in list(_open_scratch_spaces):
+        scratch.close()
+
+
+def _scratch_signal_handler(signum, frame):
+    _close_open_scratch_spaces()
+    previous = _previous_signal_handlers.get(signum, signal.SIG_DFL)
+    if callable(previous):
+        previous(signum, frame)
+    elif previous != signal.SIG_IGN:
+        # Terminate the process as the default handler would
+        signal.signal(signum, signal.SIG_DFL)
+        os.kill(os.getpid(), signum)
+
+
+def _install_cleanup_handlers():
+    global _cleanup_handlers_installed
+    if _cleanup_handlers_installed:
+        return
+    _cleanup_handlers_installed = True
+    atexit.register(_close_open_scratch_spaces)
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        try:
+            _previous_signal_handlers[signum] = signal.signal(
+                signum, _scratch_signal_handler
+            )
+        except ValueError:
+            # Signal handlers can only be set in the main thread
+            pass
+
+
+class ScratchSpace:
+    """Folder where the memmaps of a run are created.
+
+    Each run gets its own folder in the scratch root, named after the host
+    and PID of the process, and with an owner file that identifies the run.
+    The folder is removed when it is closed, when the process exits and when
+    it is interrupted by SIGINT or SIGTERM. Folders left behind by runs
+    that crashed are removed by the next run on the same host. Memmaps are
+    only created when they fit in the scratch budget and the free disk
+    space, waiting for the memmaps of other workers to be removed otherwise.
+    """
+
+    def __init__(self, root=None, budget=None, dtype="float32", timeout=3600):
+        """Set up the scratch space of a run. It is created by open()
+
+        Parameters
+        ----------
+        root : Path
+            Folder where the scratch folder is created, such as a fast local
+            disk or /dev/shm. Defaults to the current working directory
+        budget : float
+            Maximum size of the memmaps of the run, in bytes, or None to only
+            limit them to the free disk space
+        dtype : str
+            Type the images of the memmaps are stored as, from SCRATCH_DTYPES
+        timeout : float
+            Seconds to wait for space before creating a memmap anyway
+        """
+        if dtype not in SCRATCH_DTYPES:
+            Console.quit(
+                "Scratch dtype", dtype, "not supported. Use", list(SCRATCH_DTYPES)
+            )
+        self.root = Path(root) if root is not None else Path.cwd()
+        self.budget = budget
+        self.dtype = SCRATCH_DTYPES[dtype][0]
+        self.timeout = timeout
+        self.host = socket.gethostname()
+        self.pid = os.getpid()
+        self.folder = self.root / (
+            SCRATCH_PREFIX
+            + self.host
+            + "_"
+            + str(self.pid)
+            + "_"
+            + uuid.uuid4().hex[:8]
+        )
+
+    def open(self):
+        """Create the scratch folder, remove the folders of dead runs and
+        register its removal on exit"""
+        if self.folder.exists():
+            return
+        self.remove_stale()
+        self.folder.mkdir(parents=True)
+        owner = {
+            "host": self.host,
+            "pid": self.pid,
+            "started": psutil.Process(self.pid).create_time(),
+            "user": Console.get_username(),
+            "created": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        }
+        with (self.folder / SCRATCH_OWNER_FILENAME).open("w") as f:
+            json.dump(owner, f, indent=2)
+        Console.info("Scratch space at", self.folder)
+        _install_cleanup_handlers()
+        _open_scratch_spaces.append(self)
+
+    def close(self):
+        """Remove the scratch folder and its memmaps"""
+        # Forked workers inherit the scratch space, but do not own it
+        if os.getpid() != self.pid:
+            return
+        if self in _open_scratch_spaces:
+            _open_scratch_spaces.remove(self)
+        if self.folder.exists():
+            shutil.rmtree(self.folder, ignore_errors=True)
+            if self.folder.exists():
+                Console.warn(
+                    "Unable to remove scratch folder",
+                    self.folder,
+                    ". Please delete it manually.",
+                )
+
+    def remove_stale(self):
+        """Remove the scratch folders of runs on this host whose process is
+        no longer running. Folders of other hosts are reported, as their
+        runs cannot be checked"""
+        if not self.root.exists():
+            return
+        for folder in self.root.glob(SCRATCH_PREFIX + "*"):
+            owner_path = folder / SCRATCH_OWNER_FILENAME
+            try:
+                with owner_path.open("r") as f:
+                    owner = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if owner.get("host") != self.host:
+                Console.warn(
+                    "Scratch folder", folder, "belongs to a run on", owner.get("host")
+                )
+            elif not _pid_alive(owner.get("pid"), owner.get("started")):
+                Console.warn(
+                    "Removing scratch folder", folder, "of a run that is not running"
+                )
+                shutil.rmtree(folder, ignore_errors=True)
+
+    def used(self):
+        """Size of the memmaps in the scratch folder, in bytes"""
+        if not self.folder.exists():
+            return 0
+        return sum(p.stat().st_size for p in self.folder.glob("*.map"))
+
+    def reserve(self, nbytes):
+        """Wait until a memmap of nbytes fits in the budget and the free disk
+        space. A memmap larger than the budget waits until it is the only
+        one"""
+        start = time.monotonic()
+        warned = False
+        while True:
+            used = self.used()
+            free = shutil.disk_usage(self.folder).free
+            fits = nbytes <= free and (
+                self.budget is None or used + nbytes <= self.budget or used == 0
+            )
+            if fits:
+                return
+            if time.monotonic() - start > self.timeout:
+                Console.warn(
+                    "Scratch space still full after",
+                    self.timeout,
+                    "s. Creating the memmap anyway",
+                )
+                return
+            if not warned:
+                Console.info(
+                    "Waiting for {:.1f} GB of scratch space".format(nbytes / 1024**3)
+                )
+                warned = True
+            time.sleep(SCRATCH_POLL_INTERVAL)
+
+    def create(self, shape, dtype=None):
+        """Create a memmap in the scratch folder, once it fits
+
+        Parameters
+        ----------
+        shape : tuple
+            Shape of the memmap
+        dtype : numpy.dtype
+            Type of the memmap. Defaults to the storage type of the images
+
+        Returns
+        -------
+        tuple
+            Filename and handle of the memmap
+        """
+        if dtype is None:
+            dtype = self.dtype
+        self.open()
+        self.reserve(int(np.prod(shape)) * np.dtype(dtype).itemsize)
+        filename_map = str(self.folder / create_memmap_name())
+        image_memmap = np.memmap(
+            filename=filename_map, mode="w+", shape=tuple(shape), dtype=dtype
+        )
+        return filename_map, image_memmap
+
+
+def create_memmap(
+    image_list, dimensions, loader=default.loader, scratch=None, dtype=None
+):
+    """Load images into a memmap
+
+    Parameters
+    ----------
+    image_list : list
+        Images to load
+    dimensions : list
+        Height, width and channels the images are resized to
+    loader : function
+        Image loader
+    scratch : ScratchSpace
+        Scratch space where the memmap is created. Defaults to the current
+        working directory
+    dtype : numpy.dtype
+        Type of the memmap. Defaults to the storage type of the scratch
+        space, or float32
+
+    Returns
+    -------
+    tuple
+        Filename and handle of the memmap
+    """
     # If only 1 channel, do not create a 3D array
     if dimensions[-1] == 1:
         dimensions = dimensions[:-1]
     list_shape = [len(image_list)] + list(dimensions)
-    size = 1
-    for i in list_shape:
-        size *= i
-    image_memmap = np.memmap(
-        filename=filename_map,
-        mode="w+",
-        shape=tuple(list_shape),
-        dtype=np.float32,
-    )
+    if scratch is not None:
+        filename_map, image_memmap = scratch.create(list_shape, dtype)
+    else:
+        filename_map = create_memmap_name()
+        image_memmap = np.memmap(
+            filename=filename_map,
+            mode="w+",
+            shape=tuple(list_shape),
+            dtype=dtype or np.float32,
+        )
+    Console.info("Creating memmap at", filename_map)
 
     # The parent process/function is paralelised, so this one should not be!
     for idx in range(len(image_list)):
@@ -53,10 +331,15 @@ def create_memmap(image_list, dimensions, loader=default.loader):
     return filename_map, image_memmap
 
 
-def open_memmap(shape, dtype):
-    filename_map = create_memmap_name()
+def open_memmap(shape, dtype, scratch=None):
+    if scratch is not None:
+        filename_map, image_memmap = scratch.create(shape, dtype)
+    else:
+        filename_map = create_memmap_name()
+        image_memmap = np.memmap(
+            filename=filename_map, mode="w+", shape=shape, dtype=dtype
+        )
     Console.info("Creating memmap (open_mammap) at", filename_map)
-    image_memmap = np.memmap(filename=filename_map, mode="w+", shape=shape, dtype=dtype)
     return filename_map, image_memmap
 
 
@@ -82,16 +365,62 @@ def memmap_loader(
         Console.error("Image at idx", idx, "is None")
         Console.error("Please check your navigation CSV for any missing values")
         Console.quit("Image list is malformed")
-    np_im = loader(image_list[idx]).astype(np.float32)
+    np_im = loader(image_list[idx])
+    store_image(memmap_handle, idx, np_im, new_width, new_height)
+
+
+def store_image(memmap_handle, idx, image, new_width=None, new_height=None):
+    """Resize an image to new_width x new_height, if given, and store it in
+    a memmap at idx, in the type of the memmap"""
+    np_im = image.astype(np.float32)
 
     dimensions = np_im.shape
 
     if new_height is not None and new_width is not None:
         same_dimensions = (new_width == dimensions[1]) and (new_height == dimensions[0])
         if not same_dimensions:
-            im2 = cv2.resize(np_im, (new_width, new_height), cv2.INTER_CUBIC)
-            memmap_handle[idx, ...] = im2
-        else:
-            memmap_handle[idx, ...] = np_im
-    else:
-        memmap_handle[idx, ...] = np_im
+            np_im = cv2.resize(np_im, (new_width, new_height), cv2.INTER_CUBIC)
+    memmap_handle[idx, ...] = encode_image(np_im, memmap_handle.dtype)
+
+
+class MemmapImageLoader:
+    """Loader of the images stored in a memmap, by index, as float32 images
+    in [0, 1]. The memmap is opened on first use, so the loader can be sent
+    to worker processes."""
+
+    def __init__(self, filename, shape, dtype):
+        """Set the memmap the images are read from
+
+        Parameters
+        ----------
+        filename : str
+            Filename of the memmap
+        shape : tuple
+            Shape of the memmap
+        dtype : numpy.dtype
+            Type of the memmap
+        """
+        self.filename = filename
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self._memmap = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_memmap"] = None
+        return state
+
+    @property
+    def memmap(self):
+        if self._memmap is None:
+            self._memmap = np.memmap(
+                self.filename, dtype=self.dtype, mode="r", shape=self.shape
+            )
+        return self._memmap
+
+    def __call__(self, idx):
+        image = np.asarray(self.memmap[idx], dtype=np.float32)
+        scale = storage_scale(self.dtype)
+        if scale != 1.0:
+            image = image / np.float32(scale)
+        return image
@@ -15,6 +15,8 @@ import numpy as np
 from numba import njit, prange
 from tqdm import trange
 
+from oplab import Console
+
 from ..loaders import default
 
 
@@ -34,18 +36,30 @@ class RunningMeanStd:
         self.count += 1
 
         image = np.squeeze(image)
-        # Clipping image to mean if above threshold:
-        #  - Need to reshape to 1-D array view
-        mean_1d_view = self._mean.ravel()
-        image_1d_view = image.ravel()
-        image_1d_view[image_1d_view > self.clipping_max] = mean_1d_view[
-            image_1d_view > self.clipping_max
-        ]
+        # Clipping image to clipping_max if above threshold, so that the
+        # statistics do not depend on the order the images are accumulated in
+        np.minimum(image, self.clipping_max, out=image)
         # remove size:1 dimension from mean using squeeze
         delta = image - self._mean
         self._mean += delta / self.count
         self.mean2 += delta * (image - self._mean)
 
+    def merge(self, other):
+        """Merge the images of another accumulator into this one.
+
+        Accumulators of separate chunks of images can be merged into the
+        statistics of all the images. Pixels above clipping_max are clipped to
+        clipping_max, so the result does not depend on the chunks.
+        """
+        self.count, self._mean, self.mean2 = combine_mean_m2(
+            self.count,
+            self._mean,
+            self.mean2,
+            other.count,
+            other._mean,
+            other.mean2,
+        )
+
     @property
     def mean(self):
         """Get the mean of the current batch."""
@@ -65,6 +79,198 @@ class RunningMeanStd:
             return None
 
 
+@njit(parallel=True)
+def _histogram_accumulate(counts, values, scale):
+    num_bins = counts.shape[1]
+    for i in prange(values.shape[0]):
+        value = values[i]
+        if value != value:
+            # Skip NaN values
+            continue
+        position = value * scale
+        if position < 0:
+            k = 0
+        elif position >= num_bins:
+            k = num_bins - 1
+        else:
+            k = int(position)
+        counts[i, k] += 1
+
+
+@njit(parallel=True)
+def _histogram_quantile(counts, quantile, bin_width):
+    num_pixels = counts.shape[0]
+    num_bins = counts.shape[1]
+    ret = np.zeros(num_pixels, dtype=np.float32)
+    for i in prange(num_pixels):
+        total = 0
+        for k in range(num_bins):
+            total += counts[i, k]
+        if total == 0:
+            continue
+        target = quantile * total
+        cumulative = 0.0
+        for k in range(num_bins):
+            count = counts[i, k]
+            if count > 0 and cumulative + count >= target:
+                # Interpolate assuming values are uniform within the bin
+                fraction = (target - cumulative) / count
+                ret[i] = (k + fraction) * bin_width
+                break
+            cumulative += count
+    return ret
+
+
+@njit(parallel=True)
+def _histogram_trimmed_mean(counts, ratio_trimming, bin_width):
+    num_pixels = counts.shape[0]
+    num_bins = counts.shape[1]
+    ret = np.zeros(num_pixels, dtype=np.float32)
+    for i in prange(num_pixels):
+        total = 0
+        for k in range(num_bins):
+            total += counts[i, k]
+        if total == 0:
+            continue
+        # Same ranks as calc_mean_and_std_trimmed
+        left = int(total * ratio_trimming / 2.0)
+        right = int(total * (1.0 - ratio_trimming / 2.0))
+        if right <= left:
+            left = 0
+            right = total
+        acc = 0.0
+        cumulative = 0
+        for k in range(num_bins):
+            count = counts[i, k]
+            lo = max(cumulative, left)
+            hi = min(cumulative + count, right)
+            if hi > lo:
+                acc += (hi - lo) * (k + 0.5) * bin_width
+            cumulative += count
+            if cumulative >= right:
+                break
+        ret[i] = acc / (right - left)
+    return ret
+
+
+class PixelHistogram:
+    __slots__ = ["counts", "shape", "count", "num_bins", "max_value"]
+
+    def __init__(self, dimensions, num_bins=256, max_value=1.0):
+        """Class to compute per-pixel quantiles and trimmed means of a dataset
+        incrementally, with a fixed-bin histogram of each pixel.
+
+        Memory is num_bins * 2 bytes per pixel and channel, regardless of the
+        number of images. Intensities are expected in [0, max_value]; values
+        outside are counted in the first or last bin. Results are within one
+        bin width (max_value / num_bins) of the exact sample statistic: the
+        quantiles are interpolated within the bin that contains them, and the
+        trimmed mean uses the bin centres, so its error is at most half a bin
+        width. At most 65535 images can be added.
+        """
+        self.shape = tuple(np.squeeze(np.zeros(dimensions, dtype=np.uint8)).shape)
+        num_pixels = int(np.prod(self.shape))
+        self.counts = np.zeros((num_pixels, num_bins), dtype=np.uint16)
+        self.count = 0
+        self.num_bins = num_bins
+        self.max_value = max_value
+
+    def compute(self, image):
+        """Update the histograms with a new image."""
+        if self.count >= np.iinfo(np.uint16).max:
+            return False
+        self.count += 1
+        values = np.ascontiguousarray(np.squeeze(image), dtype=np.float32).ravel()
+        _histogram_accumulate(self.counts, values, self.num_bins / self.max_value)
+        return True
+
+    @property
+    def bin_width(self):
+        return self.max_value / self.num_bins
+
+    def quantile(self, quantile):
+        """Get the per-pixel quantile (between 0 and 1)."""
+        ret = _histogram_quantile(self.counts, quantile, self.bin_width)
+        return ret.reshape(self.shape)
+
+    @property
+    def median(self):
+        """Get the per-pixel median."""
+        return self.quantile(0.5)
+
+    def mean_trimmed(self, ratio_trimming=0.2):
+        """Get the per-pixel mean, leaving out ratio_trimming of the samples
+        (half on each side)."""
+        ret = _histogram_trimmed_mean(self.counts, ratio_trimming, self.bin_width)
+        return ret.reshape(self.shape)
+
+
+def pixel_histogram(file_list, loader=default.loader, num_bins=256):
+    """Compute the per-pixel histograms of a list of image filenames, to get
+    approximate medians and trimmed means with bounded memory. See
+    PixelHistogram for the error bounds.
+
+    Parameters
+    ----------
+    file_list : list
+        List of image filenames. Can be list of str or list of Path
+    loader : function
+        Function to read one filename into a numpy array
+    num_bins : int
+        Number of histogram bins over the unit intensity range
+
+    Returns
+    -------
+    PixelHistogram
+        Histograms of the images
+    """
+    histogram = None
+    for item in file_list:
+        value = loader(item)
+        if histogram is None:
+            histogram = PixelHistogram(value.shape, num_bins)
+        if not histogram.compute(value):
+            Console.warn(
+                "Histogram is full. Ignoring the remaining",
+                len(file_list) - histogram.count,
+                "images",
+            )
+            break
+    return histogram
+
+
+def combine_mean_m2(count_a, mean_a, mean2_a, count_b, mean_b, mean2_b):
+    """Combine the mean and sum of squared differences of two data sets
+
+    Uses Chan et al. parallel algorithm, so that partial results computed on
+    separate chunks of data can be merged into the result for all the data.
+    https://en.wikipedia.org/wiki/Algorithms_for_calculating_variance
+
+    Parameters
+    ----------
+    count_a, count_b : int
+        Number of samples in each data set
+    mean_a, mean_b : np.ndarray
+        Mean of each data set
+    mean2_a, mean2_b : np.ndarray
+        Sum of squared differences from the mean of each data set
+
+    Returns
+    -------
+    (int, np.ndarray, np.ndarray)
+        Count, mean and sum of squared differences of the union
+    """
+    count = count_a + count_b
+    if count_a == 0:
+        return count_b, mean_b, mean2_b
+    if count_b == 0:
+        return count_a, mean_a, mean2_a
+    delta = mean_b - mean_a
+    mean = mean_a + delta * (count_b / count)
+    mean2 = mean2_a + mean2_b + delta * delta * (count_a * count_b / count)
+    return count, mean, mean2
+
+
 def running_mean_std(
     file_list, loader=default.loader, width=None, height=None, ignore_zeroes=False
 ):
@@ -276,17 +482,68 @@ def ransac_mean_std(data, max_iterations=1000, threshold=0.1, sample_size=2):
     return ret_mean, ret_std
 
 
-def image_mean_std_trimmed(data, ratio_trimming=0.2, calculate_std=True):
+@njit(parallel=True)
+def _mean_std_trimmed_kernel(data, ratio_trimming, tile_size):
+    n = data.shape[0]
+    num_pixels = data.shape[1]
+    ret_mean = np.zeros(num_pixels, dtype=np.float32)
+    ret_std = np.zeros(num_pixels, dtype=np.float32)
+    # Same ranks as calc_mean_and_std_trimmed
+    left = 0
+    right = n
+    if ratio_trimming > 0:
+        left = int(n * ratio_trimming / 2.0)
+        right = int(n * (1.0 - ratio_trimming / 2.0))
+    num_tiles = (num_pixels + tile_size - 1) // tile_size
+    for t in prange(num_tiles):
+        start = t * tile_size
+        stop = min(start + tile_size, num_pixels)
+        # Copy the tile image by image, so that the data is read in the order
+        # it is stored, and transpose it so that each pixel is contiguous
+        tile = np.empty((stop - start, n), dtype=np.float64)
+        for k in range(n):
+            for j in range(start, stop):
+                tile[j - start, k] = data[k, j]
+        for j in range(stop - start):
+            values = tile[j]
+            if right <= left:
+                ret_mean[start + j] = np.nan
+                ret_std[start + j] = np.nan
+                continue
+            if ratio_trimming > 0:
+                values.sort()
+            mean = 0.0
+            for k in range(left, right):
+                mean += values[k]
+            mean /= right - left
+            mean_sq = 0.0
+            for k in range(left, right):
+                mean_sq += (values[k] - mean) ** 2
+            ret_mean[start + j] = mean
+            ret_std[start + j] = math.sqrt(mean_sq / (right - left))
+    return ret_mean, ret_std
+
+
+def image_mean_std_trimmed(
+    data, ratio_trimming=0.2, calculate_std=True, max_chunk_size=2**28
+):
     """Compute trimmed mean and std for image intensities using parallel computing
 
+    Each pixel and channel is trimmed along the first (image) axis. The data is
+    read in chunks of whole image rows, so that memmaps are read sequentially,
+    and every chunk is processed in parallel in tiles of pixels.
+
     Parameters
     -----------
     data : numpy.ndarray
-        image intensities
+        image intensities, with dimensions (images, height, width) or
+        (images, height, width, channels)
     ratio_trimming : float
         trim ratio
     calculate_std : bool
         denotes to compute std along with mean
+    max_chunk_size : int
+        Maximum number of bytes of data read at once
 
     Returns
     --------
@@ -295,35 +552,31 @@ def image_mean_std_trimmed(data, ratio_trimming=0.2, calculate_std=True):
     """
     n = data.shape[0]
     a = data.shape[1]
-    b = data.shape[2]
-    c = 1
-    if len(data.shape) == 4:
-        c = data.shape[3]
-    ret_mean = np.zeros((a, b, c), np.float32)
-    ret_std = np.zeros((a, b, c), np.float32)
+    pixels_per_row = int(np.prod(data.shape[2:]))
+    ret_mean = np.zeros((a, pixels_per_row), np.float32)
+    ret_std = np.zeros((a, pixels_per_row), np.float32)
 
-    effective_index = [list(range(0, n))]
+    row_size = max(n * pixels_per_row * data.dtype.itemsize, 1)
+    rows_per_chunk = min(max(max_chunk_size // row_size, 1), a)
 
     message = "calculating mean and std of images " + datetime.datetime.now().strftime(
         "%Y-%m-%d %H:%M:%S"
     )
-
-    for ch in range(c):
-        if ratio_trimming <= 0:
-            ret_mean, ret_std = mean_std_array(data[:, :, :, ch])
-            return ret_mean, ret_std
-
-        else:
-            for idx_a in trange(a, ascii=True, desc=message):
-                results = [None] * b
-                for idx_b in range(b):
-                    results[idx_b] = calc_mean_and_std_trimmed(
-                        data[effective_index, idx_a, idx_b, ch],
-                        ratio_trimming,
-                        calculate_std,
-                    )
-                ret_mean[idx_a, :, ch] = np.array(results)[:, 0]
-                ret_std[idx_a, :, ch] = np.array(results)[:, 1]
+    for idx_a in trange(0, a, rows_per_chunk, ascii=True, desc=message):
+        chunk = np.asarray(data[:, idx_a : idx_a + rows_per_chunk])  # noqa
+        if chunk.dtype not in (np.float32, np.float64):
+            # Memmaps stored as float16 or uint16
+            chunk = chunk.astype(np.float32)
+        chunk = chunk.reshape(n, -1)
+        chunk_mean, chunk_std = _mean_std_trimmed_kernel(chunk, ratio_trimming, 64)
+        ret_mean[idx_a : idx_a + rows_per_chunk] = chunk_mean.reshape(  # noqa
+            -1, pixels_per_row
+        )
+        ret_std[idx_a : idx_a + rows_per_chunk] = chunk_std.reshape(  # noqa
+            -1, pixels_per_row
+        )
+    ret_mean = ret_mean.reshape(data.shape[1:])
+    ret_std = ret_std.reshape(data.shape[1:])
     if not calculate_std:
         return ret_mean
     else:
@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (c) 2023, University of Southampton
+All rights reserved.
+Licensed under the BSD 3-Clause License.
+See LICENSE.md file in the project root for full license information.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import time
+from importlib.metadata import PackageNotFoundError
+from pathlib import Path
+
+import numpy as np
+
+from correct_images.tools.manifest import file_stat
+from oplab import Console
+
+PARSE_KEY_FILENAME = "parse_key.json"
+PARSE_CACHE_FOLDER = "cache"
+# Number of parse results kept in the cache of a parameters folder
+PARSE_CACHE_ENTRIES = 4
+
+
+def pipeline_version():
+    """Version of the pipeline, or "unknown" if it is not installed"""
+    try:
+        return Console.get_version()
+    except PackageNotFoundError:
+        return "unknown"
+
+
+def settings_key(settings):
+    """Hash the settings of parse, a dictionary of simple values
+
+    Returns
+    -------
+    str
+        SHA-256 hex digest
+    """
+    return hashlib.sha256(
+        json.dumps(settings, sort_keys=True, default=str).encode()
+    ).hexdigest()
+
+
+def inputs_key(image_list, distances=None, depth_map_list=None, bagfile_list=None):
+    """Hash the inputs of parse: the path, size and modification time of each
+    image, depth map and bagfile, and the distance of each image read from
+    the navigation. Images in bagfiles are identified by their timestamp.
+
+    Parameters
+    ----------
+    image_list : list
+        Images used by parse, as paths or bagfile timestamps
+    distances : list
+        Altitude of each image, or None
+    depth_map_list : list
+        Depth map of each image, or None
+    bagfile_list : list
+        Bagfiles that hold the images, or None
+
+    Returns
+    -------
+    str
+        SHA-256 hex digest
+    """
+    h = hashlib.sha256()
+    for path in image_list:
+        h.update(repr((str(path), *file_stat(path))).encode())
+    if distances is not None and len(distances) > 0:
+        h.update(b"distances")
+        h.update(np.ascontiguousarray(distances, dtype=np.float64))
+    if depth_map_list:
+        h.update(b"depth_maps")
+        for path in depth_map_list:
+            h.update(repr((str(path), *file_stat(path))).encode())
+    if bagfile_list:
+        h.update(b"bagfiles")
+        for path in bagfile_list:
+            h.update(repr((str(path), *file_stat(path))).encode())
+    return h.hexdigest()
+
+
+class ParseCache:
+    """Content-addressed cache of the outputs of parse.
+
+    The outputs of parse are keyed by a hash of its inputs (images and
+    navigation), its settings and the pipeline version. Each result is kept
+    in cache/<key> inside the parameters folder, hard linked to the files of
+    the parameters folder when possible, and the key of the current files is
+    recorded in parse_key.json, along with the settings, so that process can
+    check that the parameters match its configuration.
+    """
+
+    def __init__(self, folder, filenames=()):
+        """Open the cache of a parameters folder
+
+        Parameters
+        ----------
+        folder : Path
+            Parameters folder
+        filenames : list
+            Names of the output files of parse
+        """
+        self.folder = Path(folder)
+        self.filenames = list(filenames)
+        self.cache_folder = self.folder / PARSE_CACHE_FOLDER
+
+    @staticmethod
+    def record(settings, inputs):
+        """Describe a parse run
+
+        Parameters
+        ----------
+        settings : dict
+            Settings of parse
+        inputs : str
+            Hash of the inputs, from inputs_key
+
+        Returns
+        -------
+        dict
+            Key of the run, and the hash of its settings and inputs
+        """
+        config_key = settings_key(settings)
+        version = pipeline_version()
+        key = hashlib.sha256((config_key + inputs + version).encode()).hexdigest()
+        return {
+            "key": key,
+            "config_key": config_key,
+            "inputs_key": inputs,
+            "version": version,
+            "settings": json.loads(json.dumps(settings, default=str)),
+        }
+
+    def read(self, folder=None):
+        """Read the record of the current parameters, or None if there is
+        none"""
+        path = Path(folder or self.folder) / PARSE_KEY_FILENAME
+        if not path.exists():
+            return None
+        with path.open("r") as f:
+            return json.load(f)
+
+    def _write(self, record, folder):
+        record = dict(record, created=time.strftime("%Y-%m-%d %H:%M:%S"))
+        with (Path(folder) / PARSE_KEY_FILENAME).open("w") as f:
+            json.dump(record, f, indent=2)
+
+    def _entry(self, key):
+        return self.cache_folder / key[:16]
+
+    def clear(self):
+        """Remove the current outputs, so that parse writes new files instead
+        of overwriting the cached ones through their hard links"""
+        for name in self.filenames + [PARSE_KEY_FILENAME]:
+            path = self.folder / name
+            if path.exists():
+                path.unlink()
+
+    def restore(self, record):
+        """Make the cached outputs of a run the current ones
+
+        Parameters
+        ----------
+        record : dict
+            Record of the run, from record()
+
+        Returns
+        -------
+        bool
+            True if the run was found in the cache
+        """
+        entry = self._entry(record["key"])
+        cached = self.read(entry)
+        if cached is None or cached["key"] != record["key"]:
+            return False
+        files = cached.get("files", [])
+        if not all((entry / name).exists() for name in files):
+            return False
+        current = self.read()
+        if current is not None and current["key"] == record["key"]:
+            if all((self.folder / name).exists() for name in files):
+                return True
+        self.clear()
+        for name in files:
+            _link_or_copy(entry / name, self.folder / name)
+        self._write(cached, self.folder)
+        # Mark the entry as recently used
+        os.utime(entry)
+        return True
+
+    def store(self, record):
+        """Add the current outputs to the cache as the result of a run
+
+        Parameters
+        ----------
+        record : dict
+            Record of the run, from record()
+        """
+        entry = self._entry(record["key"])
+        if entry.exists():
+            shutil.rmtree(entry)
+        entry.mkdir(parents=True)
+        files = [name for name in self.filenames if (self.folder / name).exists()]
+        for name in files:
+            _link_or_copy(self.folder / name, entry / name)
+        record = dict(record, files=files)
+        self._write(record, entry)
+        self._write(record, self.folder)
+        self.prune()
+
+    def prune(self, max_entries=PARSE_CACHE_ENTRIES):
+        """Remove the least recently used results above max_entries"""
+        entries = sorted(
+            (p for p in self.cache_folder.iterdir() if p.is_dir()),
+            key=lambda p: p.stat().st_mtime,
+            reverse=True,
+        )
+        for entry in entries[max_entries:]:
+            shutil.rmtree(entry)
+
+
+def _link_or_copy(source, destination):
+    # Hard links share the data of large parameter files. They are not
+    # available on every filesystem, in which case files are copied
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copy2(source, destination)
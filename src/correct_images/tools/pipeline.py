@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (c) 2023, University of Southampton
+All rights reserved.
+Licensed under the BSD 3-Clause License.
+See LICENSE.md file in the project root for full license information.
+"""
+
+import queue
+import threading
+
+from tqdm import tqdm
+
+# Marks the end of the items in a queue
+_END = object()
+
+
+def _put(item_queue, item, stop_event):
+    # Block until there is space in the queue, unless the pipeline stops
+    while not stop_event.is_set():
+        try:
+            item_queue.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def _get(item_queue, stop_event):
+    while not stop_event.is_set():
+        try:
+            return item_queue.get(timeout=0.1)
+        except queue.Empty:
+            pass
+    return _END
+
+
+def run_pipeline(items, stages, queue_size=8, desc="Processing"):
+    """Run a list of items through a sequence of stages, each one with its own
+    pool of threads and bounded queues in between.
+
+    Stages overlap, so that e.g. reading the next images, correcting others
+    and writing the previous ones happen at the same time. The queues bound the
+    number of items held in memory between two stages.
+
+    Parameters
+    ----------
+    items : list
+        Items, e.g. image indices
+    stages : list
+        (function, num_workers) tuples. The first function is called as
+        function(item), and the others as function(item, value) with the value
+        returned by the previous stage
+    queue_size : int
+        Maximum number of items waiting between two stages
+    desc : str
+        Description of the progress bar
+
+    Returns
+    -------
+    list
+        Values returned by the last stage, in the order of the items
+        regardless of the order in which they are completed
+    """
+    items = list(items)
+    num_items = len(items)
+    stop_event = threading.Event()
+    errors = []
+    results = [None] * num_items
+    lock = threading.Lock()
+
+    input_queue = queue.Queue()
+    for position in range(num_items):
+        input_queue.put((position, None))
+    queues = [input_queue] + [
+        queue.Queue(maxsize=max(queue_size, 1)) for _ in range(len(stages) - 1)
+    ]
+    # Number of workers of each stage that have not finished yet
+    running = [max(num_workers, 1) for _, num_workers in stages]
+    for _ in range(running[0]):
+        input_queue.put(_END)
+
+    pbar = tqdm(desc=desc, total=num_items)
+
+    def worker(stage_idx):
+        function = stages[stage_idx][0]
+        is_first = stage_idx == 0
+        is_last = stage_idx == len(stages) - 1
+        try:
+            while True:
+                item = _get(queues[stage_idx], stop_event)
+                if item is _END:
+                    break
+                position, value = item
+                key = items[position]
+                value = function(key) if is_first else function(key, value)
+                if is_last:
+                    with lock:
+                        results[position] = value
+                        pbar.update(1)
+                elif not _put(queues[stage_idx + 1], (position, value), stop_event):
+                    break
+        except BaseException as e:
+            with lock:
+                errors.append(e)
+            stop_event.set()
+        finally:
+            with lock:
+                running[stage_idx] -= 1
+                last_worker = running[stage_idx] == 0
+            if last_worker and not is_last:
+                # Tell every worker of the next stage that there are no more
+                # items
+                for _ in range(running[stage_idx + 1]):
+                    _put(queues[stage_idx + 1], _END, stop_event)
+
+    threads = [
+        threading.Thread(target=worker, args=(stage_idx,), daemon=True)
+        for stage_idx, (_, num_workers) in enumerate(stages)
+        for _ in range(max(num_workers, 1))
+    ]
+    for thread in threads:
+        thread.start()
+    try:
+        for thread in threads:
+            thread.join()
+    finally:
+        stop_event.set()
+        pbar.close()
+    if errors:
+        raise errors[0]
+    return results
@@ -0,0 +1,357 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (c) 2023, University of Southampton
+All rights reserved.
+Licensed under the BSD 3-Clause License.
+See LICENSE.md file in the project root for full license information.
+"""
+
+import multiprocessing
+import os
+import shutil
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+
+import numpy as np
+import psutil
+from tqdm import tqdm
+
+from oplab import Console
+
+# A task with its predicted peak memory and scratch disk use, in bytes
+Task = namedtuple("Task", ["key", "memory", "scratch"])
+
+# Smoothing methods that copy the images of a bin to a memmap on disk
+MEMMAP_SMOOTHING = ["mean_trimmed", "median", "ransac_mean"]
+# Smoothing methods that accumulate a per-pixel histogram
+HISTOGRAM_SMOOTHING = ["mean_trimmed_approx", "median_approx"]
+# Histogram counts are 16 bit
+MAX_HISTOGRAM_IMAGES = np.iinfo(np.uint16).max
+# Largest size, in GB of float32 images, of a bin copied to a memmap
+MAX_BIN_SIZE_GB = 50.0
+# Largest chunk of a memmap that image_mean_std_trimmed sorts at once
+TRIMMED_CHUNK_BYTES = 2**28
+
+# Share of the machine given to this process when several jobs, such as the
+# cameras of a dive, run at once. Set with set_resource_share
+_resource_share = {"cpus": None, "fraction": 1.0, "shares": None, "key": None}
+
+
+def set_resource_share(cpus=None, fraction=1.0, shares=None, key=None):
+    """Limit the CPUs, and the fraction of the available memory and scratch
+    disk, that this process uses by default
+
+    Parameters
+    ----------
+    cpus : int
+        Number of CPUs, or None to use all of them
+    fraction : float
+        Fraction of the available memory and free scratch disk
+    shares : dict
+        Shared dictionary with the CPUs and fraction of each job, updated by
+        run_shared as jobs start and finish. It takes precedence over cpus
+        and fraction
+    key : int
+        Key of this job in shares
+    """
+    _resource_share["cpus"] = cpus
+    _resource_share["fraction"] = fraction
+    _resource_share["shares"] = shares
+    _resource_share["key"] = key
+
+
+def shared_resources():
+    """Whether the share of this process changes as other jobs of
+    run_shared start and finish"""
+    return _resource_share["shares"] is not None
+
+
+def _current_share():
+    if _resource_share["shares"] is not None:
+        try:
+            return _resource_share["shares"][_resource_share["key"]]
+        except (KeyError, OSError, EOFError):
+            # The job is finishing, or run_shared has stopped
+            pass
+    return _resource_share["cpus"], _resource_share["fraction"]
+
+
+def cpu_workers():
+    """Number of worker processes a job can start: the CPU share of this
+    process, or the number of CPUs minus one"""
+    cpus, _ = _current_share()
+    if cpus is not None:
+        return max(cpus, 1)
+    return max(psutil.cpu_count() - 1, 1)
+
+
+def available_memory():
+    """Memory that can be used without swapping, in bytes"""
+    return psutil.virtual_memory().available * _current_share()[1]
+
+
+def available_scratch(path=None):
+    """Free disk space where memmaps are created, in bytes"""
+    return shutil.disk_usage(path or os.getcwd()).free * _current_share()[1]
+
+
+def estimate_bin_footprint(
+    num_images,
+    image_height,
+    image_width,
+    image_channels,
+    smoothing,
+    histogram_bins=256,
+    depth_maps=False,
+    scratch_itemsize=4,
+):
+    """Predict the peak memory and scratch disk use of compute_distance_bin
+
+    Parameters
+    ----------
+    num_images : int
+        Number of images of the bin, after sampling
+    image_height : int
+        Image height
+    image_width : int
+        Image width
+    image_channels : int
+        Number of channels
+    smoothing : str
+        Smoothing method
+    histogram_bins : int
+        Number of histogram bins of the approximate methods
+    depth_maps : bool
+        The bin averages depth maps
+    scratch_itemsize : int
+        Bytes per value of the memmap of the bin
+
+    Returns
+    -------
+    tuple
+        Memory and scratch disk use, in bytes
+    """
+    pixels = image_height * image_width
+    image_bytes = pixels * image_channels * 4
+    # Loaded image, float64 accumulators and the bin sample
+    memory = 6 * image_bytes
+    scratch = 0
+    if depth_maps:
+        memory += 3 * pixels * 8
+    if smoothing in MEMMAP_SMOOTHING:
+        scratch = num_images * pixels * image_channels * scratch_itemsize
+        if smoothing == "mean_trimmed":
+            # Sorted chunk and its transposed copy
+            memory += 2 * min(scratch, TRIMMED_CHUNK_BYTES)
+        elif smoothing == "median":
+            # np.median copies one channel of the whole bin at a time
+            memory += 2 * scratch // image_channels
+        else:
+            memory += scratch
+    elif smoothing in HISTOGRAM_SMOOTHING:
+        memory += histogram_bins * pixels * image_channels * 2
+    return memory, scratch
+
+
+def max_bin_images(memory_budget, scratch_budget, num_images, *args, **kwargs):
+    """Largest number of images, up to num_images, whose bin footprint fits in
+    the budgets. The other parameters are those of estimate_bin_footprint.
+    Returns 0 if not even one image fits."""
+
+    def fits(n):
+        memory, scratch = estimate_bin_footprint(n, *args, **kwargs)
+        return memory <= memory_budget and scratch <= scratch_budget
+
+    # The footprint grows with the number of images
+    low, high = 0, num_images
+    while low < high:
+        mid = (low + high + 1) // 2
+        if fits(mid):
+            low = mid
+        else:
+            high = mid - 1
+    return low
+
+
+def max_concurrent_jobs(job_memory, memory_budget=None, max_workers=None):
+    """Number of jobs of the same size that fit in a memory budget, between
+    1 and max_workers
+
+    Parameters
+    ----------
+    job_memory : int
+        Peak memory of a job, in bytes
+    memory_budget : int
+        Memory budget, in bytes. Defaults to the available memory
+    max_workers : int
+        Maximum number of jobs. Defaults to cpu_workers()
+
+    Returns
+    -------
+    int
+        Number of concurrent jobs
+    """
+    if memory_budget is None:
+        memory_budget = available_memory()
+    if max_workers is None:
+        max_workers = cpu_workers()
+    num_jobs = int(memory_budget // max(job_memory, 1))
+    if num_jobs < 1:
+        Console.warn("You might have not enough available RAM to continue.")
+    return min(max(num_jobs, 1), max_workers)
+
+
+def run_now(function, *args):
+    """Run a function in the current process and return its result as a done
+    Future, to use in the submit function of run_scheduled without workers"""
+    future = Future()
+    try:
+        future.set_result(function(*args))
+    except Exception as e:
+        future.set_exception(e)
+    return future
+
+
+def run_scheduled(tasks, submit, memory_budget, scratch_budget, max_workers, desc):
+    """Run tasks concurrently, as long as their predicted memory and scratch
+    use fit in the budgets.
+
+    Tasks are started largest first, so that the small ones fill the
+    remaining capacity at the end. When the next task does not fit, a smaller
+    one that does is started instead. A task larger than a budget is run on
+    its own.
+
+    Parameters
+    ----------
+    tasks : list
+        Task tuples
+    submit : function
+        Starts a task given its key and returns a concurrent.futures.Future
+    memory_budget : int
+        Memory budget, in bytes
+    scratch_budget : int
+        Scratch disk budget, in bytes
+    max_workers : int
+        Maximum number of tasks running at once
+    desc : str
+        Description of the progress bar
+
+    Returns
+    -------
+    dict
+        Result of each task, by key
+    """
+    pending = sorted(tasks, key=lambda t: (t.memory, t.scratch), reverse=True)
+    running = {}
+    results = {}
+    memory_used = 0
+    scratch_used = 0
+    with tqdm(desc=desc, total=len(pending)) as pbar:
+        while pending or running:
+            i = 0
+            while i < len(pending) and len(running) < max(max_workers, 1):
+                task = pending[i]
+                fits = (
+                    memory_used + task.memory <= memory_budget
+                    and scratch_used + task.scratch <= scratch_budget
+                )
+                if fits or not running:
+                    del pending[i]
+                    running[submit(task.key)] = task
+                    memory_used += task.memory
+                    scratch_used += task.scratch
+                else:
+                    i += 1
+            done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+            for future in done:
+                task = running.pop(future)
+                memory_used -= task.memory
+                scratch_used -= task.scratch
+                results[task.key] = future.result()
+                pbar.update(1)
+    return results
+
+
+def _run_with_share(function, shares, key, args):
+    set_resource_share(shares=shares, key=key)
+    try:
+        return function(*args)
+    finally:
+        set_resource_share()
+
+
+def run_shared(function, jobs, max_concurrent, cpus=None):
+    """Run jobs concurrently in separate processes that share the CPUs,
+    memory and scratch disk of the machine.
+
+    Jobs are started heaviest first. The CPUs, memory and scratch disk are
+    shared between the running jobs in proportion to their weight, and
+    shared again whenever a job starts or finishes, so that the remaining
+    jobs take over the resources of the finished ones. Jobs use their share
+    through cpu_workers(), available_memory() and available_scratch(), and
+    follow its changes the next time they call them. With one job at a time,
+    jobs are run in order in the current process with the whole machine.
+
+    Parameters
+    ----------
+    function : function
+        Module level function that runs a job
+    jobs : list
+        Weight and argument tuple of each job
+    max_concurrent : int
+        Maximum number of jobs running at once
+    cpus : int
+        Number of CPUs to share. Defaults to cpu_workers()
+
+    Returns
+    -------
+    list
+        Result of each job, in the order of jobs
+    """
+    if max_concurrent <= 1 or len(jobs) <= 1:
+        return [function(*args) for _, args in jobs]
+    if cpus is None:
+        cpus = cpu_workers()
+    max_concurrent = min(max_concurrent, len(jobs))
+    pending = sorted(range(len(jobs)), key=lambda i: jobs[i][0], reverse=True)
+    running = {}
+    results = [None] * len(jobs)
+    # Spawned workers are not daemonic, so that jobs can start their own
+    # workers
+    context = multiprocessing.get_context("spawn")
+    with context.Manager() as manager, ProcessPoolExecutor(
+        max_concurrent, mp_context=context
+    ) as executor:
+        shares = manager.dict()
+        while pending or running:
+            started = []
+            while pending and len(running) + len(started) < max_concurrent:
+                started.append(pending.pop(0))
+            # Share the machine between the jobs that run from now on
+            active = list(running.values()) + started
+            total = sum(jobs[i][0] for i in active)
+            for i in active:
+                fraction = jobs[i][0] / total if total > 0 else 1 / len(active)
+                shares[i] = (max(int(round(cpus * fraction)), 1), fraction)
+            if running:
+                Console.info(
+                    "CPUs of the running jobs:",
+                    ", ".join(
+                        "job {} {}".format(i + 1, shares[i][0])
+                        for i in running.values()
+                    ),
+                )
+            for i in started:
+                Console.info(
+                    "Starting job", i + 1, "of", len(jobs), "with", shares[i][0], "CPUs"
+                )
+                future = executor.submit(
+                    _run_with_share, function, shares, i, jobs[i][1]
+                )
+                running[future] = i
+            done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+            for future in done:
+                i = running.pop(future)
+                del shares[i]
+                results[i] = future.result()
+    return results
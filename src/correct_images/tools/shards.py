@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (c) 2023, University of Southampton
+All rights reserved.
+Licensed under the BSD 3-Clause License.
+See LICENSE.md file in the project root for full license information.
+"""
+
+import csv
+import io
+import os
+import tarfile
+import threading
+import zipfile
+from pathlib import Path
+
+try:
+    # Try using the v2 API directly to avoid a warning from imageio >= 2.16.2
+    from imageio.v2 import imread
+except ImportError:
+    from imageio import imread
+
+from oplab import Console
+
+SHARD_FORMATS = ["tar", "zip"]
+SHARD_INDEX_FILENAME = "shards_index.csv"
+SHARD_INDEX_COLUMNS = ["relative_path", "shard", "offset", "size"]
+
+
+def _read_shard_index(folder):
+    # Map each relative path to its shard, offset and size. If a path appears
+    # several times, its last row is used
+    entries = {}
+    index_path = Path(folder) / SHARD_INDEX_FILENAME
+    if index_path.exists():
+        with index_path.open("r", newline="") as f:
+            for row in csv.DictReader(f):
+                entries[row["relative_path"]] = (
+                    row["shard"],
+                    int(row["offset"]),
+                    int(row["size"]),
+                )
+    return entries
+
+
+class ShardWriter:
+    """Append encoded images to large tar or zip shards instead of writing
+    one file per image.
+
+    Shards are named shard_000000.<format>, shard_000001.<format>, ... and a
+    new one is started when the current one exceeds max_shard_size. Each
+    image is recorded in shards_index.csv with its shard and the offset and
+    size of its data, so that it can be read back without scanning the
+    shard. Files are stored uncompressed, as images are already encoded.
+
+    Shards from previous runs are kept: a new writer starts a new shard and
+    appends to the index.
+    """
+
+    def __init__(self, folder, shard_format="tar", max_shard_size=2**30, fsync=False):
+        """Create a writer
+
+        Parameters
+        ----------
+        folder : Path
+            Output folder of the shards and their index
+        shard_format : str
+            tar or zip
+        max_shard_size : int
+            Size in bytes above which a new shard is started
+        fsync : bool
+            Flush each shard to disk when it is closed
+        """
+        if shard_format not in SHARD_FORMATS:
+            Console.quit(
+                "Shard format", shard_format, "not supported. Use", SHARD_FORMATS
+            )
+        self.folder = Path(folder)
+        self.shard_format = shard_format
+        self.max_shard_size = max_shard_size
+        self.fsync = fsync
+        self.entries = _read_shard_index(self.folder)
+        self._lock = threading.Lock()
+        self._archive = None
+        self._shard_path = None
+        self._shard_number = 0
+        for p in self.folder.glob("shard_*." + shard_format):
+            try:
+                number = int(p.stem[len("shard_") :])
+            except ValueError:
+                continue
+            self._shard_number = max(self._shard_number, number + 1)
+        self.index_path = self.folder / SHARD_INDEX_FILENAME
+        if not self.index_path.exists():
+            with self.index_path.open("w", newline="") as f:
+                csv.writer(f).writerow(SHARD_INDEX_COLUMNS)
+
+    def _open_shard(self):
+        name = "shard_{:06d}.{}".format(self._shard_number, self.shard_format)
+        self._shard_number += 1
+        self._shard_path = self.folder / name
+        if self.shard_format == "tar":
+            self._archive = tarfile.open(
+                self._shard_path, "w", format=tarfile.PAX_FORMAT
+            )
+        else:
+            self._archive = zipfile.ZipFile(
+                self._shard_path, "w", compression=zipfile.ZIP_STORED
+            )
+
+    def _close_shard(self):
+        if self._archive is None:
+            return
+        self._archive.close()
+        if self.fsync:
+            with open(self._shard_path, "r+b") as f:
+                os.fsync(f.fileno())
+        self._archive = None
+
+    def _append(self, relative_path, data):
+        # Append a file to the current shard and return the offset of its data
+        if self.shard_format == "tar":
+            info = tarfile.TarInfo(relative_path)
+            info.size = len(data)
+            self._archive.addfile(info, io.BytesIO(data))
+            blocks = -(-len(data) // tarfile.BLOCKSIZE)
+            self._archive.fileobj.flush()
+            return self._archive.offset - blocks * tarfile.BLOCKSIZE
+        self._archive.writestr(relative_path, data)
+        self._archive.fp.flush()
+        # Stored files are written right before the end of the shard
+        return self._archive.fp.tell() - len(data)
+
+    def write(self, relative_path, data):
+        """Write an encoded image
+
+        Parameters
+        ----------
+        relative_path : str
+            Logical path of the image, relative to the output folder
+        data : bytes
+            Encoded image
+
+        Returns
+        -------
+        Path
+            Logical path of the image, i.e. where it would have been written
+            without shards
+        """
+        relative_path = str(relative_path)
+        with self._lock:
+            if self._archive is None:
+                self._open_shard()
+            offset = self._append(relative_path, data)
+            entry = (self._shard_path.name, offset, len(data))
+            with self.index_path.open("a", newline="") as f:
+                csv.writer(f).writerow([relative_path, *entry])
+            self.entries[relative_path] = entry
+            if offset + len(data) >= self.max_shard_size:
+                self._close_shard()
+        return self.folder / relative_path
+
+    def exists(self, path):
+        """Check if an image, given by its logical path, is in a shard"""
+        entry = self.entries.get(os.path.relpath(path, self.folder))
+        return entry is not None and (self.folder / entry[0]).exists()
+
+    def close(self):
+        """Close the current shard"""
+        with self._lock:
+            self._close_shard()
+
+
+class ShardReader:
+    """Random access to the images written by ShardWriter"""
+
+    def __init__(self, folder):
+        """Open the shards in a folder
+
+        Parameters
+        ----------
+        folder : Path
+            Folder with the shards and their index
+        """
+        self.folder = Path(folder)
+        self.entries = _read_shard_index(self.folder)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, relative_path):
+        return str(relative_path) in self.entries
+
+    def names(self):
+        """Relative paths of the images in the shards"""
+        return list(self.entries.keys())
+
+    def read(self, relative_path):
+        """Read the encoded bytes of an image
+
+        Parameters
+        ----------
+        relative_path : str
+            Logical path of the image, e.g. from the filelist.csv
+
+        Returns
+        -------
+        bytes
+            Encoded image
+        """
+        entry = self.entries.get(str(relative_path))
+        if entry is None:
+            raise KeyError(str(relative_path) + " is not in the shards")
+        shard, offset, size = entry
+        with open(self.folder / shard, "rb") as f:
+            f.seek(offset)
+            return f.read(size)
+
+    def read_image(self, relative_path):
+        """Read and decode an image
+
+        Parameters
+        ----------
+        relative_path : str
+            Logical path of the image, e.g. from the filelist.csv
+
+        Returns
+        -------
+        numpy.ndarray
+            Decoded image
+        """
+        return imread(self.read(relative_path))